@@ -1,25 +1,87 @@
 from starlette.applications import Starlette
-from starlette.graphql import GraphQLApp
 from starlette.middleware.authentication import AuthenticationMiddleware
 
 from graphql.execution.executors.asyncio import AsyncioExecutor
 
-from .models import schema
+from .endpoints import export_products, import_products
+from .models import estimate_list_size, product_columns, product_search, schema
 from .utils.authentication import JWTAuthenticationBackend
+from .utils.complexity import CostBudget
+from .utils.metrics import (
+    MetricsMiddleware,
+    ResolverMetricsMiddleware,
+    metrics_endpoint,
+)
+from .utils.queries import PersistedQueryApp
 from config.settings import (
+    ADMIN_USERNAMES,
     DEBUG,
     DATABASE_URL,
+    DATABASE_POOL_SIZE,
     SECRET_KEY,
     JWT_ALGORITHM,
+    JWT_CACHE_SIZE,
+    JWT_CACHE_TTL,
+    MAX_BATCH_SIZE,
+    QUERY_CACHE_SIZE,
+    MAX_QUERY_COST,
+    MAX_QUERY_DEPTH,
+    MEASURED_OPERATIONS,
+    QUERY_COST_BUDGET,
+    QUERY_COST_WINDOW,
+    RESPONSE_CACHE_SIZE,
+    SLOW_QUERY_THRESHOLD,
+    SLOW_QUERY_SAMPLE_RATE,
     DatabaseMiddleware,
 )
 
 
 app = Starlette()
 app.debug = DEBUG
+authentication_backend = JWTAuthenticationBackend(
+    SECRET_KEY,
+    JWT_ALGORITHM,
+    cache_size=JWT_CACHE_SIZE,
+    cache_ttl=JWT_CACHE_TTL,
+    admins=ADMIN_USERNAMES,
+)
+app.add_middleware(AuthenticationMiddleware, backend=authentication_backend)
 app.add_middleware(
-    AuthenticationMiddleware,
-    backend=JWTAuthenticationBackend(SECRET_KEY, JWT_ALGORITHM),
+    DatabaseMiddleware, database_url=DATABASE_URL, pool_size=DATABASE_POOL_SIZE
 )
-app.add_middleware(DatabaseMiddleware, database_url=DATABASE_URL)
-app.add_route("/query", GraphQLApp(schema=schema, executor=AsyncioExecutor()))
+database_middleware = app.error_middleware.app
+# outermost, to measure the whole request
+app.add_middleware(
+    MetricsMiddleware,
+    slow_threshold=SLOW_QUERY_THRESHOLD,
+    slow_sample_rate=SLOW_QUERY_SAMPLE_RATE,
+    routes=app.routes,
+)
+graphql_app = PersistedQueryApp(
+    schema=schema,
+    executor=AsyncioExecutor(),
+    cache_size=QUERY_CACHE_SIZE,
+    response_cache_size=RESPONSE_CACHE_SIZE,
+    middleware=[ResolverMetricsMiddleware()],
+    max_cost=MAX_QUERY_COST,
+    max_depth=MAX_QUERY_DEPTH,
+    cost_budget=(
+        CostBudget(QUERY_COST_BUDGET, QUERY_COST_WINDOW)
+        if QUERY_COST_BUDGET is not None
+        else None
+    ),
+    estimate=estimate_list_size,
+    max_batch_size=MAX_BATCH_SIZE,
+    measured_operations=MEASURED_OPERATIONS,
+)
+app.add_route("/query", graphql_app)
+app.add_route("/products.{format}", export_products)
+app.add_route("/products/import", import_products, methods=["POST"])
+app.add_route("/metrics", metrics_endpoint)
+
+
+@app.on_event("startup")
+async def build_product_views():
+    # built before the worker takes requests, instead of in the first one using them
+    await product_search.prepare(database_middleware.repository)
+    await product_columns.prepare(database_middleware.repository)
@@ -0,0 +1,123 @@
+import argparse
+import asyncio
+import sys
+import typing
+
+from .app import database_middleware
+from .endpoints import iter_products
+from .utils.bulk import (
+    READERS,
+    WRITERS,
+    InvalidFile,
+    import_products,
+    iter_lines,
+)
+from config.settings import IMPORT_BATCH_SIZE
+
+
+async def _read_file(
+    file: typing.BinaryIO, size: int = 64 * 1024
+) -> typing.AsyncIterator[bytes]:
+    while True:
+        chunk = file.read(size)
+        if not chunk:
+            return
+        yield chunk
+
+
+async def _import_file(database: typing.Any, args: argparse.Namespace) -> int:
+    file = sys.stdin.buffer if args.file == "-" else open(args.file, "rb")
+    with file:
+        rows = READERS[args.format](iter_lines(_read_file(file)))
+        try:
+            async for report in import_products(database, rows, args.batch_size):
+                print(
+                    "done: " if report.done else "",
+                    f"{report.rows} rows, {report.inserted} inserted, "
+                    f"{report.updated} updated, {report.invalid} invalid",
+                    sep="",
+                    file=sys.stderr,
+                )
+        except InvalidFile as e:
+            print(f"error: {e}", file=sys.stderr)
+            return 1
+    for line, message in report.errors:
+        print(f"line {line}: {message}", file=sys.stderr)
+    if report.invalid > len(report.errors):
+        print(f"and {report.invalid - len(report.errors)} more", file=sys.stderr)
+    return 1 if report.invalid else 0
+
+
+async def _export_file(database: typing.Any, args: argparse.Namespace) -> int:
+    dump, _ = WRITERS[args.format]
+    file = sys.stdout if args.file == "-" else open(args.file, "w", newline="")
+    with file:
+        header = True
+        async for chunk in iter_products(database, args.available):
+            file.write(dump(chunk, header))
+            header = False
+        if header:
+            # the catalog is empty
+            file.write(dump([], header))
+    return 0
+
+
+async def _summarize_carts(database: typing.Any, args: argparse.Namespace) -> int:
+    async with database.session(write=True) as session:
+        users = {item.get("user") for item in await session.cart_items.all()}
+        summarized = 0
+        for user_id in sorted(users):
+            if await session.carts.get_for_user(user_id) is None:
+                await session.carts.summarize(user_id)
+                summarized += 1
+    print(f"{summarized} carts summarized", file=sys.stderr)
+    return 0
+
+
+def main(argv: typing.List[str] = None) -> int:
+    """
+    Import products from a csv or newline delimited json file to the database
+    of the settings, or export the catalog to one, by streaming them (see
+    `akara.utils.bulk`), the format told by the extension of the file or given
+    with `--format`
+
+    Also builds the summary of the carts filled before summaries were kept,
+    which otherwise get one the next time they change (see `CartTable`).
+    """
+    parser = argparse.ArgumentParser(
+        prog="python -m akara.cli",
+        description="Import products to the database, or export them",
+    )
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+    importing = commands.add_parser(
+        "import", help="import products, updating the ones with id"
+    )
+    importing.add_argument("file", help="file to read, - for the standard input")
+    importing.add_argument("--format", choices=sorted(READERS))
+    importing.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+    exporting = commands.add_parser("export", help="export the whole catalog")
+    exporting.add_argument("file", help="file to write, - for the standard output")
+    exporting.add_argument("--format", choices=sorted(WRITERS))
+    exporting.add_argument(
+        "--available", action="store_true", help="only the products in stock"
+    )
+    summarizing = commands.add_parser(
+        "carts", help="summarize the carts that lack a summary"
+    )
+    importing.set_defaults(run=_import_file)
+    exporting.set_defaults(run=_export_file)
+    summarizing.set_defaults(run=_summarize_carts)
+    args = parser.parse_args(argv)
+    if args.command != "carts" and args.format is None:
+        args.format = args.file.rpartition(".")[2].lower()
+        if args.format not in READERS:
+            parser.error("the format can't be told by the file name, use --format")
+
+    loop = asyncio.get_event_loop()
+    # the database of the settings, the one the app uses
+    return loop.run_until_complete(args.run(database_middleware.repository, args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
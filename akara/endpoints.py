@@ -0,0 +1,129 @@
+import json
+import typing
+
+from starlette import status
+from starlette.authentication import has_required_scope
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse, Response, StreamingResponse
+
+from .repositories import Repository, RequestRepository
+from .utils import bulk
+from .utils.bulk import READERS, WRITERS, InvalidFile, iter_lines
+from config.settings import IMPORT_BATCH_SIZE
+
+# amount of products read from the storage at once when exporting
+EXPORT_CHUNK_SIZE = 500
+# formats of the imported products by content type
+IMPORT_FORMATS = {"text/csv": "csv", "application/x-ndjson": "ndjson"}
+
+
+async def iter_products(
+    database: Repository, available: bool = False, chunk_size: int = EXPORT_CHUNK_SIZE
+) -> typing.AsyncIterator[typing.List[dict]]:
+    """
+    Iterate the whole catalog in chunks of products sorted by id
+
+    Every chunk is read in its own database session, continuing after the last id
+    of the previous one, so the catalog is never loaded at once and the database
+    is not held open while the chunks are consumed.
+
+    :param database Repository: database to read the products from
+    :param available bool: flag indicating if unavailable products should be
+    excluded
+    :param chunk_size int: amount of products per chunk
+    """
+    after = None
+    while True:
+        async with database.session() as session:
+            chunk = await session.products.page(available, after, chunk_size)
+
+        if chunk:
+            yield [
+                {
+                    "id": doc.doc_id,
+                    "title": doc.get("title"),
+                    "price": doc.get("price"),
+                    "inventory_count": doc.get("inventory_count"),
+                }
+                for doc in chunk
+            ]
+        if len(chunk) < chunk_size:
+            return
+        after = chunk[-1].doc_id
+
+
+async def export_products(request: Request) -> Response:
+    """
+    Stream the catalog, as newline delimited json with a product per line or as
+    csv, by the extension of the path (`/products.ndjson` or `/products.csv`)
+
+    The `available` query parameter set to `true` excludes unavailable products
+    """
+    format = request.path_params.get("format", "ndjson")
+    if format not in WRITERS:
+        return PlainTextResponse("Not Found", status_code=status.HTTP_404_NOT_FOUND)
+    dump, media_type = WRITERS[format]
+
+    available = request.query_params.get("available", "").lower() == "true"
+    database = request.database
+    if isinstance(database, RequestRepository):
+        # every chunk is read in a session of its own, not in the one of the
+        # request, which would be held open until the whole catalog is sent
+        database = database.repository
+
+    async def content() -> typing.AsyncIterator[str]:
+        header = True
+        async for chunk in iter_products(database, available):
+            yield dump(chunk, header)
+            header = False
+        if header:
+            # the catalog is empty
+            yield dump([], header)
+
+    return StreamingResponse(content(), media_type=media_type)
+
+
+async def import_products(request: Request) -> Response:
+    """
+    Import products from the body of the request, csv or newline delimited json
+    by its content type, only for admins (see `ADMIN_USERNAMES`)
+
+    Products are read as the body arrives and written in batches of
+    `IMPORT_BATCH_SIZE` (see `akara.utils.bulk.import_products`). The response
+    streams the progress as newline delimited json, the report of the import
+    after every batch, the last one with the errors of the invalid rows.
+    """
+    if not has_required_scope(request, ["authenticated"]):
+        return PlainTextResponse(
+            "you must be logged in", status_code=status.HTTP_401_UNAUTHORIZED
+        )
+    if not has_required_scope(request, ["admin"]):
+        return PlainTextResponse(
+            "only admins can import products", status_code=status.HTTP_403_FORBIDDEN
+        )
+
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    format = IMPORT_FORMATS.get(content_type.lower())
+    if format is None:
+        return PlainTextResponse(
+            f"Unsupported Media Type, use {' or '.join(IMPORT_FORMATS)}",
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+        )
+
+    rows = READERS[format](iter_lines(request.stream()))
+    reports = bulk.import_products(request.database, rows, IMPORT_BATCH_SIZE)
+    try:
+        # files that can't be read are rejected before the first batch
+        report = await reports.__anext__()
+    except InvalidFile as e:
+        return PlainTextResponse(str(e), status_code=status.HTTP_400_BAD_REQUEST)
+
+    async def progress() -> typing.AsyncIterator[str]:
+        yield json.dumps(report.to_json()) + "\n"
+        try:
+            async for update in reports:
+                yield json.dumps(update.to_json()) + "\n"
+        except InvalidFile as e:
+            yield json.dumps({"error": str(e)}) + "\n"
+
+    return StreamingResponse(progress(), media_type="application/x-ndjson")
@@ -1,10 +1,23 @@
+import typing
+
 import graphene
 from graphql import GraphQLError
 
+from config.settings import MAX_PAGE_SIZE, SEARCH_CACHE_SIZE
+
 from .types import *
 from .mutations import *
-from ..utils.database import Q
 from ..utils.authentication import requires
+from ..utils.cache import depends_on
+from ..utils.columns import ProductColumnsView
+from ..utils.loaders import get_loader
+from ..utils.search import ProductSearch
+from ..utils.selection import selected_fields
+
+# index of the titles of the products, see `Query.search_products`
+product_search = ProductSearch(cache_size=SEARCH_CACHE_SIZE)
+# products by column, see `Query.products` and `Query.catalog_stats`
+product_columns = ProductColumnsView()
 
 
 class Query(graphene.ObjectType):
@@ -12,25 +25,124 @@ class Query(graphene.ObjectType):
         graphene.NonNull(Product),
         required=True,
         available=graphene.Boolean(default_value=False),
+        min_price=graphene.Float(),
+        max_price=graphene.Float(),
+    )
+    products_connection = graphene.Field(
+        graphene.NonNull(ProductConnection),
+        available=graphene.Boolean(default_value=False),
+        first=graphene.Int(),
+        after=graphene.String(),
+    )
+    search_products = graphene.Field(
+        graphene.NonNull(ProductConnection),
+        query=graphene.String(required=True),
+        first=graphene.Int(),
+        after=graphene.String(),
     )
     product = graphene.Field(Product, id=graphene.ID(required=True))
+    catalog_stats = graphene.Field(graphene.NonNull(CatalogStats))
     cart = graphene.Field(Cart)
     user = graphene.Field(User)
 
-    async def resolve_products(_, info, available: bool):
+    async def resolve_products(
+        _, info, available: bool, min_price: float = None, max_price: float = None
+    ):
         """
         Obtain the list of all products
 
         :param available bool: flag indicating if unavailable products should be
         excluded from results
+        :param min_price float: only the products that cost at least this
+        :param max_price float: only the products that cost at most this
+        """
+        depends_on(info.context, "products")
+        request = info.context.get("request")
+        columns = await product_columns.prepare(request.database)
+
+        return [
+            Product.from_columns(columns, row)
+            for row in columns.rows(available, min_price, max_price)
+        ]
+
+    async def resolve_products_connection(
+        _, info, available: bool, first: int = None, after: str = None
+    ):
+        """
+        Obtain a page of products, sorted by id
+
+        :param available bool: flag indicating if unavailable products should be
+        excluded from results
+        :param first int: size of the page, at most `MAX_PAGE_SIZE`, which is also
+        the default
+        :param after str: cursor of the last product of the previous page
         """
+        if first is not None and first < 0:
+            raise GraphQLError("first cannot be negative")
+        first = MAX_PAGE_SIZE if first is None else min(first, MAX_PAGE_SIZE)
+
+        depends_on(info.context, "products")
         request = info.context.get("request")
-        async with request.database as db:
-            products = db.table("products").search(
-                Q.inventory_count > 0 if available else Q
-            )
+        fields = Product.document_fields(selected_fields(info, "edges", "node"))
+        async with request.database.session() as session:
+            # take an extra product to know if there's a next page
+            products = await session.products.page(available, after, first + 1, fields)
+
+        edges = [
+            ProductConnection.Edge(node=await Product.from_doc(doc), cursor=doc.doc_id)
+            for doc in products[:first]
+        ]
+        return ProductConnection(
+            edges=edges,
+            page_info=graphene.relay.PageInfo(
+                has_next_page=len(products) > first,
+                has_previous_page=after is not None,
+                start_cursor=edges[0].cursor if edges else None,
+                end_cursor=edges[-1].cursor if edges else None,
+            ),
+        )
+
+    async def resolve_search_products(
+        _, info, query: str, first: int = None, after: str = None
+    ):
+        """
+        Search products by title, the most relevant first (see `SearchIndex`)
 
-        return [await Product.from_doc(doc) for doc in products]
+        :param query str: words the titles must have, the last one can be
+        incomplete
+        :param first int: size of the page, at most `MAX_PAGE_SIZE`, which is also
+        the default
+        :param after str: cursor of the last product of the previous page
+        """
+        if first is not None and first < 0:
+            raise GraphQLError("first cannot be negative")
+        first = MAX_PAGE_SIZE if first is None else min(first, MAX_PAGE_SIZE)
+
+        depends_on(info.context, "products")
+        request = info.context.get("request")
+        ids = await product_search.search(request.database, query)
+        start = 0
+        if after is not None:
+            try:
+                start = ids.index(after) + 1
+            except ValueError:
+                raise GraphQLError("the cursor is not a result of the search")
+
+        # the products are only read if any field besides their id is selected
+        loader = get_loader(info.context, "products")
+        edges = [
+            ProductConnection.Edge(node=Product.lazy(doc_id, loader), cursor=doc_id)
+            for doc_id in ids[start : start + first]
+        ]
+        return ProductConnection(
+            edges=edges,
+            page_info=graphene.relay.PageInfo(
+                has_next_page=start + first < len(ids),
+                has_previous_page=start > 0,
+                start_cursor=edges[0].cursor if edges else None,
+                end_cursor=edges[-1].cursor if edges else None,
+            ),
+        )
 
     async def resolve_product(self, info, id: str):
         """
@@ -38,16 +150,23 @@ class Query(graphene.ObjectType):
 
         :param id str: id of the product to query
         """
-        request = info.context.get("request")
-        async with request.database as db:
-            products = db.table("products")
-
-            product = products.get(doc_id=id)
-            if not product:
-                return None
+        depends_on(info.context, "products", id)
+        product = await get_loader(info.context, "products").load(id)
+        if not product:
+            return None
 
         return await Product.from_doc(product)
 
+    async def resolve_catalog_stats(self, info):
+        """
+        Obtain the aggregates of the whole catalog
+        """
+        depends_on(info.context, "products")
+        request = info.context.get("request")
+        stats = CatalogStats()
+        stats.columns = await product_columns.prepare(request.database)
+        return stats
+
     @requires("authenticated", message="you must be logged in to access the cart")
     async def resolve_cart(self, info):
         """
@@ -55,14 +174,12 @@ class Query(graphene.ObjectType):
         """
         request = info.context.get("request")
         user = request.user
-        async with request.database as db:
-            cart_items = db.table("cart_items")
+        async with request.database.session() as session:
+            cart = await session.carts.get_for_user(user.id)
+        if not cart:
+            return None
 
-            cart = cart_items.search(Q.user == user.id)
-            if not cart:
-                return None
-
-        return await Cart.from_doc(cart, request.database)
+        return await Cart.from_doc(cart, get_loader(info.context, "products"))
 
     @requires("authenticated", message="you must be loged in to access your user data")
     async def resolve_user(self, info):
@@ -78,7 +195,32 @@ class Mutation(graphene.ObjectType):
     login = Login.Field()
     addToCart = AddToCart.Field()
     removeFromCart = RemoveFromCart.Field()
+    updateCart = UpdateCart.Field()
     completeCart = CompleteCart.Field()
 
 
 schema = graphene.Schema(query=Query, mutation=Mutation)
+
+
+def estimate_list_size(
+    field: str, arguments: dict, table_size: typing.Callable[[str], int]
+) -> typing.Optional[int]:
+    """
+    Estimate the amount of items returned by a field of the schema, to know the
+    cost of the operations (see `operation_cost`)
+
+    :param field str: name of the field, as `Type.field`
+    :param arguments dict: arguments the field is resolved with
+    :param table_size: function that returns the amount of documents of a table
+    :returns: the amount of items, `None` if it can't be estimated
+    """
+    if field == "Query.products":
+        return table_size("products")
+    if field in ("Query.productsConnection", "Query.searchProducts"):
+        first = arguments.get("first")
+        first = MAX_PAGE_SIZE if first is None else min(max(first, 0), MAX_PAGE_SIZE)
+        return min(first, table_size("products"))
+    if field == "ProductConnection.edges":
+        # the connection already counts as many times as the size of the page
+        return 1
+    return None
@@ -8,3 +8,12 @@ class UserInput(graphene.InputObjectType):
 
     username = graphene.String(required=True)
     password = graphene.String(required=True)
+
+
+class CartItemInput(graphene.InputObjectType):
+    """
+    Amount of a product to have in the shopping cart
+    """
+
+    productId = graphene.ID(required=True)
+    amount = graphene.Int(required=True)
@@ -1,17 +1,54 @@
+import typing
 from datetime import datetime, timedelta
 
 import graphene
 import jwt
 from graphql import GraphQLError
 
-from config.settings import SECRET_KEY, JWT_ALGORITHM, JWT_EXPIRATION_DAYS
+from config.settings import (
+    SECRET_KEY,
+    JWT_ALGORITHM,
+    JWT_EXPIRATION_DAYS,
+    WRITE_ATTEMPTS,
+)
 
 from .inputs import *
 from .types import *
-from ..utils.database import Q
 from ..utils.authentication import requires
+from ..utils.loaders import get_loader
+from ..utils.password import needs_rehash
+from ..utils.storage import ConflictError
 
-__all__ = ("Signup", "Login", "AddToCart", "RemoveFromCart", "CompleteCart")
+__all__ = (
+    "Signup",
+    "Login",
+    "AddToCart",
+    "RemoveFromCart",
+    "UpdateCart",
+    "CompleteCart",
+)
+
+UPDATE_FAILED = "the cart couldn't be updated, please try again"
+
+
+async def retry_conflicts(write: typing.Callable, message: str) -> typing.Any:
+    """
+    Run a function that writes to the database, starting over when another
+    request changes the same documents before it commits
+
+    Mutations check and update documents optimistically, so their writes must be
+    done in a session of their own, opened by the function.
+
+    :param write: coroutine function without arguments
+    :param message str: error given when all the attempts conflicted
+    :returns: what the function returns
+    """
+    for _ in range(WRITE_ATTEMPTS):
+        try:
+            return await write()
+        except ConflictError:
+            continue
+    raise GraphQLError(message)
 
 
 class Signup(graphene.Mutation):
@@ -34,16 +71,15 @@ class Signup(graphene.Mutation):
             raise GraphQLError("username and password cannot be empty strings")
 
         user = User(username=input.username)
+        # hashed before opening the database, the session can't wait for it
+        await user.set_password_async(input.password)
 
         request = info.context["request"]
-        async with request.database as db:
-            users = db.table("users")
-
-            if users.get(Q.username == user.username):
+        async with request.database.session(write=True) as session:
+            if await session.users.get_by_username(user.username):
                 raise GraphQLError("username is alredy taken")
 
-            user.set_password(input.password)
-            user.id = users.insert(await user.to_doc())
+            user.id = await session.users.insert(await user.to_doc())
 
         return Signup(
             token=jwt.encode(
@@ -76,16 +112,24 @@ class Login(graphene.Mutation):
     async def mutate(root, info, username: str, password: str) -> "Login":
         request = info.context["request"]
 
-        async with request.database as db:
-            users = db.table("users")
+        async with request.database.session() as session:
+            user = await session.users.get_by_username(username)
+        if not user:
+            raise GraphQLError("user does not exist")
 
-            user = users.get(Q.username == username)
-            if not user:
-                raise GraphQLError("user does not exist")
+        user = await User.from_doc(user)
 
-            user = await User.from_doc(user)
-            if not user.check_password(password):
-                raise GraphQLError("incorrect password")
+        if not await user.check_password_async(password):
+            raise GraphQLError("incorrect password")
+
+        if needs_rehash(user.password_hash):
+            # update hashes made with a weaker function, now that the password is known
+            password_hash = user.password_hash
+            await user.set_password_async(password)
+            async with request.database.session(write=True) as session:
+                await session.users.update_password(
+                    username, password_hash, user.password_hash
+                )
 
         return Login(
             token=jwt.encode(
@@ -119,42 +163,51 @@ class AddToCart(graphene.Mutation):
     async def mutate(root, info, productId: str, amount: int):
         request = info.context["request"]
         user = request.user
-
-        async with request.database as db:
-            products = db.table("products")
-            cart_items = db.table("cart_items")
-
-            product = products.get(doc_id=productId)
-            if not product:
-                raise GraphQLError("product does not exists")
-
-            product = await Product.from_doc(product)
-
-            # get the cart item, there must be only one, given that the convination of user
-            # and product is used both for queryng and storing
-            item = cart_items.get((Q.user == user.id) & (Q.product == productId))
-            current_order = 0
-            if item:
-                current_order = item.get("amount")
-
-            if product.inventory_count < amount + current_order:
-                raise GraphQLError(
-                    "there's not enougth availability to fullfil your order"
+        loader = get_loader(info.context, "products")
+
+        async def add() -> tuple:
+            async with request.database.session(write=True) as session:
+                cart_items = session.cart_items
+
+                # read in the same session, the price is added to the cart
+                (product,) = await session.products.get_many([productId])
+                if not product:
+                    raise GraphQLError("product does not exists")
+
+                # get the cart item, there must be only one, given that the
+                # convination of user and product is used both for queryng and storing
+                item = await cart_items.get_item(user.id, productId)
+                current_order = 0
+                if item:
+                    current_order = item.get("amount")
+
+                if product.get("inventory_count") < amount + current_order:
+                    raise GraphQLError(
+                        "there's not enougth availability to fullfil your order"
+                    )
+
+                if not item:
+                    item = CartItem(
+                        product=Product.lazy(productId, loader), amount=amount
+                    )
+                    item.user_id = user.id
+                    await cart_items.insert(await item.to_doc())
+                    new_lines = 1
+                else:
+                    item["amount"] += amount
+                    await cart_items.update_many([item])
+                    new_lines = 0
+
+                # the summary of the cart is updated along with its items
+                await session.carts.add(
+                    user.id, new_lines, product.get("price") * amount
                 )
+                cart = await session.carts.get_for_user(user.id)
+            return product, cart
 
-            if not item:
-                item = CartItem(product=product, amount=amount)
-                item.user_id = user.id
-                cart_items.insert(await item.to_doc())
-            else:
-                item["amount"] += amount
-                cart_items.write_back([item])
-
-            # the cart is the list of cart items associated to a user
-            # there's not explicit model for the cart in the storage
-            cart = cart_items.search(Q.user == user.id)
-
-        return await Cart.from_doc(cart, request.database)
+        product, cart = await retry_conflicts(add, UPDATE_FAILED)
+        loader.prime(productId, product)
+        return await Cart.from_doc(cart, loader)
 
 
 class RemoveFromCart(graphene.Mutation):
@@ -178,39 +231,138 @@ class RemoveFromCart(graphene.Mutation):
     async def mutate(root, info, productId: str, amount: int = None):
         request = info.context["request"]
         user = request.user
+        loader = get_loader(info.context, "products")
 
-        async with request.database as db:
-            products = db.table("products")
-            cart_items = db.table("cart_items")
+        async def remove() -> tuple:
+            async with request.database.session(write=True) as session:
+                cart_items = session.cart_items
 
-            product = products.get(doc_id=productId)
-            if not product:
-                raise GraphQLError("product does not exists")
+                (product,) = await session.products.get_many([productId])
+                if not product:
+                    raise GraphQLError("product does not exists")
 
-            product = await Product.from_doc(product)
+                item = await cart_items.get_item(user.id, productId)
 
-            item = cart_items.get((Q.user == user.id) & (Q.product == productId))
+                if not item:
+                    raise GraphQLError("cannot remove item from empty cart")
 
-            if not item:
-                raise GraphQLError("cannot remove item from empty cart")
+                current_order = item.get("amount")
+                if not amount or current_order == amount:
+                    await cart_items.remove([item.doc_id])
+                    await session.carts.add(
+                        user.id, -1, -product.get("price") * current_order
+                    )
+                else:
+                    if current_order < amount:
+                        raise GraphQLError("cannot remove more items than where added")
+
+                    item["amount"] -= amount
+                    await cart_items.update_many([item])
+                    await session.carts.add(user.id, 0, -product.get("price") * amount)
+
+                cart = await session.carts.get_for_user(user.id)
+            return product, cart
+
+        product, cart = await retry_conflicts(remove, UPDATE_FAILED)
+        loader.prime(productId, product)
+        if not cart:
+            return None
+        return await Cart.from_doc(cart, loader)
 
-            current_order = item.get("amount")
-            if not amount or current_order == amount:
-                cart_items.remove(doc_ids=[item.doc_id])
-            else:
-                if current_order < amount:
-                    raise GraphQLError("cannot remove more items than where added")
 
-                item["amount"] -= amount
-                cart_items.write_back([item])
+class UpdateCart(graphene.Mutation):
+    """
+    Mutation to set the amount of several products in the shopping cart at once
 
-            # the cart is the list of cart items associated to a user
-            # there's not explicit model for the cart in the storage
-            cart = cart_items.search(Q.user == user.id)
+    Either every item is updated or, if any of them is not valid, nothing changes.
+
+    :param items list: products and the amount of each one the cart must have,
+    products with amount 0 are removed from the cart, and products not present
+    are kept as they are
+    :return: the current state of the cart
+    """
+
+    class Arguments:
+        items = graphene.List(graphene.NonNull(CartItemInput), required=True)
+
+    Output = Cart
+
+    @staticmethod
+    @requires("authenticated", message="you must be logged in to access the cart")
+    async def mutate(root, info, items: typing.List[CartItemInput]):
+        request = info.context["request"]
+        user = request.user
+        loader = get_loader(info.context, "products")
+
+        amounts = {}
+        for item in items:
+            if item.productId in amounts:
+                raise GraphQLError("each product can only be updated once")
+            if item.amount < 0:
+                raise GraphQLError("amount cannot be negative")
+            amounts[item.productId] = item.amount
+
+        async def update() -> tuple:
+            async with request.database.session(write=True) as session:
+                cart_items = session.cart_items
+
+                # check every item before modifying anything
+                cart_products = await session.products.get_many(amounts)
+                for product, amount in zip(cart_products, amounts.values()):
+                    if not product:
+                        raise GraphQLError("product does not exists")
+                    if product.get("inventory_count") < amount:
+                        raise GraphQLError(
+                            "there's not enougth availability to fullfil your order"
+                        )
+
+                cart = {
+                    item.get("product"): item
+                    for item in await cart_items.for_user(user.id)
+                }
+                removed, changed, added = [], [], []
+                price = 0
+                for product, (product_id, amount) in zip(
+                    cart_products, amounts.items()
+                ):
+                    item = cart.get(product_id)
+                    current_order = item.get("amount") if item is not None else 0
+                    price += product.get("price") * (amount - current_order)
+                    if item is None:
+                        if amount:
+                            added.append(
+                                {
+                                    "product": product_id,
+                                    "amount": amount,
+                                    "user": user.id,
+                                }
+                            )
+                    elif not amount:
+                        removed.append(item.doc_id)
+                    elif item.get("amount") != amount:
+                        item["amount"] = amount
+                        changed.append(item)
+
+                # all the changes are committed together when the session ends
+                if removed:
+                    await cart_items.remove(removed)
+                if changed:
+                    await cart_items.update_many(changed)
+                if added:
+                    await cart_items.insert_many(added)
+                await session.carts.add(user.id, len(added) - len(removed), price)
+
+                cart = await session.carts.get_for_user(user.id)
+            return cart_products, cart
+
+        cart_products, cart = await retry_conflicts(update, UPDATE_FAILED)
+        # the products were just read, avoid loading them again for the cart
+        for product in cart_products:
+            loader.prime(product.doc_id, product)
 
         if not cart:
             return None
-        return await Cart.from_doc(cart, request.database)
+        return await Cart.from_doc(cart, loader)
 
 
 class CompleteCart(graphene.Mutation):
@@ -230,32 +382,64 @@ class CompleteCart(graphene.Mutation):
         request = info.context["request"]
         user = request.user
 
-        async with request.database as db:
-            products = db.table("products")
-            cart_items = db.table("cart_items")
+        # stock is checked and updated optimistically, if another request changes
+        # the same products before this one commits, the checkout starts over
+        charged, bought_products = await retry_conflicts(
+            lambda: CompleteCart.checkout(request.database, user.id),
+            "the cart couldn't be processed, please try again",
+        )
+
+        # keep the products loaded by other fields of the request up to date
+        loader = get_loader(info.context, "products")
+        for product in bought_products:
+            loader.prime(product.doc_id, product)
+
+        return CompleteCart(success=True, charged=charged)
 
-            cart = cart_items.search(Q.user == user.id)
+    @staticmethod
+    async def checkout(database, user_id: str) -> tuple:
+        """
+        Charge the cart of a user and update the stock of its products
+
+        Everything is written in a single session, so either the whole cart is
+        bought or nothing changes.
+
+        :returns: the charged amount and the updated products
+        :raises ConflictError: if another request changed the products meanwhile
+        """
+        async with database.session(write=True) as session:
+            cart = await session.cart_items.for_user(user_id)
             if not cart:
                 raise GraphQLError("cart is empty")
 
+            cart_products = await session.products.get_many(
+                item.get("product") for item in cart
+            )
+
+            # check every item before modifying anything
+            for item, product in zip(cart, cart_products):
+                if not product:
+                    raise GraphQLError("product does not exists")
+                if product.get("inventory_count") < item.get("amount"):
+                    raise GraphQLError(
+                        "there's not enougth availability to fullfil your order"
+                    )
+
             # store total charged value
             charged = 0
-            # store modified products and their ids in order to execute a batch update later
-            bought_products_ids = []
+            # store modified products in order to execute a batch update later
             bought_products = []
-            for item in cart:
-                product = products.get(doc_id=item.get("product"))
-
+            for item, product in zip(cart, cart_products):
                 amount = item.get("amount")
                 product["inventory_count"] -= amount
                 charged += product.get("price") * amount
 
-                bought_products_ids.append(product.doc_id)
                 bought_products.append(product)
 
             # make batch update of bought products
-            products.write_back(bought_products, doc_ids=bought_products_ids)
+            await session.products.update_many(bought_products)
             # clear the cart
-            cart_items.remove(doc_ids=[item.doc_id for item in cart])
+            await session.cart_items.remove([item.doc_id for item in cart])
+            await session.carts.add(user_id, -len(cart), 0)
 
-        return CompleteCart(success=True, charged=charged)
+        return charged, bought_products
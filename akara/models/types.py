@@ -1,17 +1,37 @@
+import math
 import typing
 
 import graphene
+from graphene.utils.str_converters import to_camel_case
 from tinydb.database import Document
-from aiotinydb import AIOTinyDB
 from starlette.authentication import BaseUser
 
-from ..utils.password import hash_password, verify_password
+from config.settings import LOW_STOCK_THRESHOLD
 
-__all__ = ("Product", "CartItem", "Cart", "User")
+from ..repositories.base import PRICE_DIGITS
+from ..utils.columns import MISSING_COUNT, ProductColumns
+from ..utils.loaders import DocumentLoader
+from ..utils.password import (
+    hash_password,
+    hash_password_async,
+    verify_password,
+    verify_password_async,
+)
+
+__all__ = (
+    "Product",
+    "ProductConnection",
+    "CatalogStats",
+    "CartItem",
+    "Cart",
+    "User",
+)
 
 
 class TinyDbSerializale:
-    async def from_doc(self, doc: Document, database: AIOTinyDB = None) -> typing.Any:
+    async def from_doc(
+        self, doc: Document, loader: DocumentLoader = None
+    ) -> typing.Any:
         raise NotImplementedError()
 
     async def to_doc(self) -> Document:
@@ -19,11 +39,22 @@ class TinyDbSerializale:
 
 
 class Product(graphene.ObjectType, TinyDbSerializale):
+    """
+    Product of the catalog
+
+    Products can be lazy (see `Product.lazy`), and then only their id is known
+    until any other field is resolved, which loads them through the loader of
+    the request.
+    """
+
     id = graphene.ID(required=True)
     title = graphene.String(required=True)
     price = graphene.Float(required=True)
     inventory_count = graphene.Int(required=True)
 
+    # loader of the product, only for lazy products
+    loader = None  # type: DocumentLoader
+
     async def to_doc(self) -> dict:
         return {
             "title": self.title,
@@ -40,15 +71,104 @@ class Product(graphene.ObjectType, TinyDbSerializale):
             inventory_count=doc.get("inventory_count"),
         )
 
+    @staticmethod
+    def from_columns(columns: ProductColumns, row: int) -> "Product":
+        price = columns.prices[row]
+        count = columns.inventory_counts[row]
+        return Product(
+            id=columns.ids[row],
+            title=columns.titles[row],
+            price=None if math.isnan(price) else price,
+            inventory_count=None if count == MISSING_COUNT else count,
+        )
+
+    @staticmethod
+    def lazy(doc_id: str, loader: DocumentLoader) -> "Product":
+        """
+        Create a product that is only loaded if any field besides its id is
+        resolved
+        """
+        product = Product(id=doc_id)
+        product.loader = loader
+        return product
+
+    @staticmethod
+    def document_fields(selection: typing.Iterable[str]) -> typing.List[str]:
+        """
+        Obtain the fields of the documents needed to resolve a selection of
+        fields of products (see `selected_fields`)
+        """
+        selection = set(selection)
+        return [
+            name
+            for name in Product._meta.fields
+            if name != "id" and to_camel_case(name) in selection
+        ]
+
+    def _resolve(self, field: str) -> typing.Any:
+        if self.loader is None:
+            return getattr(self, field)
+        return self._load(field)
+
+    async def _load(self, field: str) -> typing.Any:
+        document = await self.loader.load(self.id)
+        return document.get(field) if document is not None else None
+
+    def resolve_title(self, info) -> typing.Any:
+        return self._resolve("title")
+
+    def resolve_price(self, info) -> typing.Any:
+        return self._resolve("price")
+
+    def resolve_inventory_count(self, info) -> typing.Any:
+        return self._resolve("inventory_count")
+
+
+class ProductConnection(graphene.relay.Connection):
+    """
+    Page of products, the cursors are the ids of the products
+    """
+
+    class Meta:
+        node = Product
+
+
+class CatalogStats(graphene.ObjectType):
+    """
+    Aggregates of the whole catalog, computed over its columns (see
+    `ProductColumns`)
+    """
+
+    total_inventory_value = graphene.Float(required=True)
+    low_stock = graphene.Int(
+        required=True, threshold=graphene.Int(default_value=LOW_STOCK_THRESHOLD)
+    )
+
+    # columns of the products of the catalog
+    columns = None  # type: ProductColumns
+
+    def resolve_total_inventory_value(self, info) -> float:
+        """
+        Obtain what all the products in stock are worth together
+        """
+        return round(self.columns.total_inventory_value(), PRICE_DIGITS)
+
+    def resolve_low_stock(self, info, threshold: int) -> int:
+        """
+        Count the products in stock with at most `threshold` units left
+        """
+        return self.columns.low_stock(threshold)
+
 
 class CartItem(graphene.ObjectType, TinyDbSerializale):
     product = graphene.Field(Product, required=True)
     amount = graphene.Int(required=True, default_value=1)
 
     @staticmethod
-    async def from_doc(doc: Document) -> "CartItem":
+    async def from_doc(doc: Document, loader: DocumentLoader) -> "CartItem":
+        # the product is only loaded if any of its fields is requested
         return CartItem(
-            product=await Product.from_doc(doc.get("product")), amount=doc.get("amount")
+            product=Product.lazy(doc.get("product"), loader), amount=doc.get("amount")
         )
 
     async def to_doc(self) -> dict:
@@ -56,22 +176,40 @@ class CartItem(graphene.ObjectType, TinyDbSerializale):
 
 
 class Cart(graphene.ObjectType, TinyDbSerializale):
+    """
+    Shopping cart of a user, built from the summary of the cart (see
+    `CartTable`), so its price is known without reading its items or their
+    products, which are only read when `products` is requested
+    """
+
     products = graphene.List(graphene.NonNull(CartItem), required=True)
     price = graphene.Float(required=True)
 
     @staticmethod
-    async def from_doc(docs: typing.List[Document], database: AIOTinyDB) -> "Cart":
-        price = 0
-        products = []
-        for doc in docs:
-            async with database as db:
-                product = db.table("products").get(doc_id=doc.get("product"))
-            amount = doc.get("amount")
-            price += product.get("price") * amount
-            products.append(
-                CartItem(product=await Product.from_doc(product), amount=amount)
-            )
-        return Cart(products=products, price=price)
+    async def from_doc(
+        doc: Document,
+        loader: DocumentLoader,
+        items: typing.List[Document] = None,
+    ) -> "Cart":
+        """
+        :param doc Document: summary of the cart
+        :param loader DocumentLoader: loader of the products
+        :param items list: items of the cart, if they were already read
+        """
+        cart = Cart(price=doc.get("price"))
+        cart.user_id = doc.get("user")
+        cart.items = items
+        cart.loader = loader
+        return cart
+
+    async def resolve_products(self, info) -> typing.List[CartItem]:
+        items = self.items
+        if items is None:
+            request = info.context["request"]
+            async with request.database.session() as session:
+                items = await session.cart_items.for_user(self.user_id)
+
+        return [await CartItem.from_doc(doc, self.loader) for doc in items]
 
 
 class User(graphene.ObjectType, BaseUser, TinyDbSerializale):
@@ -92,6 +230,12 @@ class User(graphene.ObjectType, BaseUser, TinyDbSerializale):
     def check_password(self, password: str) -> bool:
         return verify_password(password, self.password_hash)
 
+    async def set_password_async(self, password: str) -> None:
+        self.password_hash = await hash_password_async(password)
+
+    async def check_password_async(self, password: str) -> bool:
+        return await verify_password_async(password, self.password_hash)
+
     @staticmethod
     async def from_doc(doc: Document) -> "User":
         user = User(id=doc.doc_id, username=doc.get("username"))
@@ -107,4 +251,3 @@ class User(graphene.ObjectType, BaseUser, TinyDbSerializale):
 
     def to_json(self) -> dict:
         return {"username": self.username, "id": self.id}
-
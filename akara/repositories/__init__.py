@@ -0,0 +1,88 @@
+from urllib.parse import parse_qsl
+
+from starlette.datastructures import DatabaseURL
+from starlette.types import ASGIApp, ASGIInstance, Receive, Scope, Send
+
+from ..utils.database import TransactionalTinyDB
+from ..utils.metrics import get_metrics
+from ..utils.segments import SegmentStorage
+from ..utils.storage import WriteAheadLogStorage
+from .base import *
+from .sqlite import SqliteRepository
+from .tinydb import TinyDbRepository
+
+
+def create_repository(database_url: DatabaseURL, pool_size: int = 5) -> Repository:
+    """
+    Create the repository of a database url
+
+    `tinydb://path/to/database` keeps the database in TinyDB, by default in a
+    `WriteAheadLogStorage` for the life of the worker. Adding `?storage=json` to
+    the url uses the plain json storage instead, which reads and writes the whole
+    file on every access, and `?storage=segments` keeps the database in a
+    memory-mapped segment file instead of json (see `SegmentStorage`).
+
+    `sqlite://path/to/database` keeps it in SQLite, with a pool of `pool_size`
+    connections (see `SqliteRepository`).
+
+    :raises ValueError: if the database is not supported
+    """
+    # relative paths are parsed as `<dialect>://<hostname>/<path>`, absolute
+    # ones as `<dialect>:///<path>`
+    path = (database_url.hostname or "") + database_url.path
+    options = dict(parse_qsl(database_url.query))
+
+    if database_url.dialect == "sqlite":
+        return SqliteRepository(path, pool_size=pool_size)
+    if database_url.dialect != "tinydb":
+        raise ValueError(f"unsupported database {database_url.dialect}")
+
+    if options.get("storage") == "json":
+        database = TransactionalTinyDB(path)
+    elif options.get("storage") == "segments":
+        database = TransactionalTinyDB(storage=SegmentStorage(path))
+    else:
+        database = TransactionalTinyDB(storage=WriteAheadLogStorage(path))
+    return TinyDbRepository(database)
+
+
+class DatabaseMiddleware:
+    """
+    Starlette middleware to provide the repository of the database
+
+    The backend is chosen by the dialect of `database_url` (see
+    `create_repository`), and resolvers work with it the same way whatever it
+    is. The sessions of a request that only read share a single one, which is
+    closed when the request ends (see `RequestRepository`). When the request is
+    measured (see `MetricsMiddleware`) its sessions are measured too.
+
+    Example
+    -------
+    ```
+    async with request.database.session(write=True) as session:
+        await session.products.insert({ ... })
+    ```
+    """
+
+    def __init__(
+        self, app: ASGIApp, database_url: DatabaseURL, pool_size: int = 5
+    ) -> None:
+        self.app = app
+        self.repository = create_repository(database_url, pool_size)
+
+    def __call__(self, scope: Scope) -> ASGIInstance:
+        metrics = get_metrics(scope)
+        if metrics is not None:
+            database = RequestRepository(MeasuredRepository(self.repository, metrics))
+        else:
+            database = RequestRepository(self.repository)
+        scope["database"] = database
+        instance = self.app(scope)
+
+        async def asgi(receive: Receive, send: Send) -> None:
+            try:
+                await instance(receive, send)
+            finally:
+                await database.close()
+
+        return asgi
@@ -0,0 +1,517 @@
+import asyncio
+import time
+import typing
+
+from tinydb.database import Document
+
+from ..utils.metrics import RequestMetrics
+
+# decimals kept of the total price of carts, which is updated incrementally, so
+# the rounding errors of floats don't add up
+PRICE_DIGITS = 6
+
+__all__ = (
+    "Table",
+    "ProductTable",
+    "UserTable",
+    "CartItemTable",
+    "CartTable",
+    "Session",
+    "Repository",
+    "MeasuredSession",
+    "MeasuredRepository",
+    "RequestRepository",
+    "shared_repository",
+)
+
+
+class Table:
+    """
+    Documents of a table, read and written through a session (see `Session`)
+
+    Whatever the backend, documents are `Document` instances, dicts that carry
+    their id in `doc_id`, so models are built from them with `from_doc` and
+    stored with `to_doc`.
+    """
+
+    session = None  # type: Session
+
+    async def get_many(
+        self, doc_ids: typing.Iterable[str]
+    ) -> typing.List[typing.Optional[Document]]:
+        """
+        Get several documents by id
+
+        :returns: the documents in the same order of `doc_ids`, with `None` in
+        place of the ones that don't exist
+        """
+        raise NotImplementedError()
+
+    async def all(self) -> typing.List[Document]:
+        """
+        Get every document of the table, in the order they were inserted
+        """
+        raise NotImplementedError()
+
+    async def count(self) -> int:
+        """
+        Obtain the amount of documents of the table
+        """
+        raise NotImplementedError()
+
+    async def insert(self, document: dict) -> str:
+        """
+        Insert a document
+
+        :returns: the id given to the document
+        """
+        raise NotImplementedError()
+
+    async def insert_many(self, documents: typing.List[dict]) -> typing.List[str]:
+        """
+        Insert several documents
+
+        :returns: the ids given to the documents, in the same order
+        """
+        raise NotImplementedError()
+
+    async def update_many(self, documents: typing.List[Document]) -> None:
+        """
+        Write back documents that were read from the table, by `doc_id`
+        """
+        raise NotImplementedError()
+
+    async def remove(self, doc_ids: typing.List[str]) -> None:
+        """
+        Remove documents by id
+        """
+        raise NotImplementedError()
+
+
+class ProductTable(Table):
+    async def search(
+        self, available: bool = False, fields: typing.Iterable[str] = None
+    ) -> typing.List[Document]:
+        """
+        Get every product, in the order they were inserted
+
+        :param available bool: flag indicating if unavailable products should be
+        excluded
+        :param fields: fields of the documents to read, all of them if `None`,
+        though backends that keep the documents in memory may read all anyway
+        """
+        raise NotImplementedError()
+
+    async def page(
+        self,
+        available: bool = False,
+        after: str = None,
+        limit: int = None,
+        fields: typing.Iterable[str] = None,
+    ) -> typing.List[Document]:
+        """
+        Get products sorted by id
+
+        :param available bool: flag indicating if unavailable products should be
+        excluded
+        :param after str: id of the product to start after, the first one if `None`
+        :param limit int: maximum amount of products, all of them if `None`
+        :param fields: fields of the documents to read, as in `search`
+        """
+        raise NotImplementedError()
+
+    async def reprice_carts(
+        self,
+        previous: typing.List[typing.Optional[Document]],
+        documents: typing.List[Document],
+    ) -> None:
+        """
+        Update the total price of the carts that have products whose price changed
+
+        Must be called by `update_many` with the products as they were before.
+        """
+        changes = {
+            document.doc_id: (document.get("price") or 0) - (before.get("price") or 0)
+            for before, document in zip(previous, documents)
+            if before is not None and before.get("price") != document.get("price")
+        }
+        totals = {}
+        for product_id, change in changes.items():
+            for item in await self.session.cart_items.for_product(product_id):
+                user_id = item.get("user")
+                totals[user_id] = totals.get(user_id, 0) + change * item.get("amount")
+        for user_id, total in totals.items():
+            await self.session.carts.add(user_id, 0, total)
+
+
+class UserTable(Table):
+    async def get_by_username(self, username: str) -> typing.Optional[Document]:
+        """
+        Get a user by username, `None` if there's no such user
+        """
+        raise NotImplementedError()
+
+    async def update_password(
+        self, username: str, password_hash: str, new_password_hash: str
+    ) -> bool:
+        """
+        Replace the password hash of a user, unless it changed since it was read
+
+        :param password_hash str: hash the user must still have
+        :returns: if the password was updated
+        """
+        raise NotImplementedError()
+
+
+class CartItemTable(Table):
+    async def for_user(self, user_id: str) -> typing.List[Document]:
+        """
+        Get the cart of a user, as the list of its items
+        """
+        raise NotImplementedError()
+
+    async def get_item(
+        self, user_id: str, product_id: str
+    ) -> typing.Optional[Document]:
+        """
+        Get the item of a product in the cart of a user, `None` if it's not there
+        """
+        raise NotImplementedError()
+
+    async def for_product(self, product_id: str) -> typing.List[Document]:
+        """
+        Get the items of a product in the carts of every user
+        """
+        raise NotImplementedError()
+
+
+class CartTable(Table):
+    """
+    Summary of the cart of every user, with its amount of items (`lines`) and
+    its total `price`, kept up to date as the cart changes so it's known without
+    reading the cart items nor their products
+    """
+
+    async def get_for_user(self, user_id: str) -> typing.Optional[Document]:
+        """
+        Get the summary of the cart of a user, `None` if the cart is empty
+        """
+        raise NotImplementedError()
+
+    async def add(self, user_id: str, lines: int, price: float) -> None:
+        """
+        Add items and price to the summary of the cart of a user, negative
+        amounts subtract them
+
+        The summary is removed when the cart has no items left. Must be called
+        once the items of the cart have changed: carts without a summary, like
+        the ones filled before summaries were kept, get one built from them.
+        """
+        summary = await self.get_for_user(user_id)
+        if summary is None:
+            await self.summarize(user_id)
+            return
+
+        summary["lines"] += lines
+        if summary["lines"] <= 0:
+            await self.remove([summary.doc_id])
+        else:
+            summary["price"] = round(summary["price"] + price, PRICE_DIGITS)
+            await self.update_many([summary])
+
+    async def summarize(self, user_id: str) -> typing.Optional[Document]:
+        """
+        Build the summary of the cart of a user from its items and the price of
+        their products, for carts that don't have one
+
+        :returns: the summary, `None` if the cart is empty
+        """
+        items = await self.session.cart_items.for_user(user_id)
+        if not items:
+            return None
+        products = await self.session.products.get_many(
+            item.get("product") for item in items
+        )
+        price = sum(
+            (product.get("price") or 0) * item.get("amount")
+            for item, product in zip(items, products)
+            if product is not None
+        )
+        await self.insert(
+            {"user": user_id, "lines": len(items), "price": round(price, PRICE_DIGITS)}
+        )
+        return await self.get_for_user(user_id)
+
+
+class Session:
+    """
+    Unit of work with the database of a `Repository`
+
+    Tables are only available inside the session, as `products`, `users`,
+    `cart_items` and `carts`. Every session is a transaction: changes are
+    committed when it ends without errors, or discarded otherwise, and it may
+    fail to commit with a `ConflictError` if another session changed the same
+    documents meanwhile.
+
+    Example
+    -------
+    ```
+    async with request.database.session(write=True) as session:
+        user = await session.users.get_by_username(username)
+    ```
+    """
+
+    products = None  # type: ProductTable
+    users = None  # type: UserTable
+    cart_items = None  # type: CartItemTable
+    carts = None  # type: CartTable
+
+    def table(self, name: str) -> Table:
+        """
+        Obtain a table of the session by name
+        """
+        return getattr(self, name)
+
+    @property
+    def documents_read(self) -> int:
+        """
+        Number of documents read in the session, not counting the ones read by
+        other sessions that overlap with it
+        """
+        return 0
+
+    async def __aenter__(self) -> "Session":
+        raise NotImplementedError()
+
+    async def __aexit__(self, exc_type, exc, traceback) -> None:
+        raise NotImplementedError()
+
+
+class Repository:
+    """
+    Database of the application, independent of how it's stored
+    """
+
+    # if a session can stay open while other sessions start and end
+    concurrent_sessions = True
+
+    def session(self, write: bool = False) -> Session:
+        """
+        Start a session with the database
+
+        :param write bool: flag indicating if the session is going to write,
+        which lets backends that lock take the lock from the start
+        """
+        raise NotImplementedError()
+
+    def subscribe(self, callback: typing.Callable) -> bool:
+        """
+        Register a function to be called when documents change, see
+        `TableStorage.subscribe`
+
+        :returns: if the repository supports change notifications
+        """
+        return False
+
+    async def catch_up(self) -> None:
+        """
+        Notify the subscribers of the changes made by other workers, as sessions
+        do when they start, without starting one if the repository can
+        """
+        async with self.session():
+            pass
+
+
+class MeasuredSession:
+    """
+    Session that counts itself, and the documents it reads, in the metrics of a
+    request
+    """
+
+    def __init__(self, session: Session, metrics: RequestMetrics):
+        self.session = session
+        self.metrics = metrics
+        self._start = None
+
+    async def __aenter__(self) -> Session:
+        self.metrics.storage_opens += 1
+        self._start = time.perf_counter()
+        return await self.session.__aenter__()
+
+    async def __aexit__(self, exc_type, exc, traceback) -> None:
+        try:
+            await self.session.__aexit__(exc_type, exc, traceback)
+        finally:
+            # the session counts only its own reads, even after it ends
+            self.metrics.documents_scanned += self.session.documents_read
+            self.metrics.add_phase("storage", time.perf_counter() - self._start)
+
+
+class MeasuredRepository:
+    """
+    Wrapper of the repository of a request that measures its sessions
+
+    Counts the sessions opened and the documents read by them, and the time they
+    take, in the metrics of the request (see `MetricsMiddleware`).
+
+    :param repository Repository: repository shared by all the requests
+    :param metrics RequestMetrics: metrics of the request
+    """
+
+    def __init__(self, repository: Repository, metrics: RequestMetrics):
+        self.repository = repository
+        self.metrics = metrics
+
+    def session(self, write: bool = False) -> MeasuredSession:
+        return MeasuredSession(self.repository.session(write), self.metrics)
+
+    def __getattr__(self, name: str) -> typing.Any:
+        return getattr(self.repository, name)
+
+
+def shared_repository(database: typing.Any) -> Repository:
+    """
+    Obtain the repository shared by all the requests from the one of a request,
+    which may be a wrapper of it (see `RequestRepository`)
+    """
+    while hasattr(database, "repository"):
+        database = database.repository
+    return database
+
+
+class _Snapshot:
+    """
+    Read session shared by the sessions of a `RequestRepository`
+    """
+
+    def __init__(self, manager: typing.Any):
+        # what opens the session, which may be a wrapper like `MeasuredSession`
+        self.manager = manager
+        self.opening = asyncio.ensure_future(manager.__aenter__())
+        # sessions of the request using it
+        self.users = 0
+
+    @property
+    def session(self) -> Session:
+        return self.opening.result()
+
+    async def close(self) -> None:
+        try:
+            await self.opening
+        except Exception:
+            # it never opened
+            return
+        await self.manager.__aexit__(None, None, None)
+
+
+class RequestSession:
+    """
+    Session of a request that reads from its snapshot, see `RequestRepository`
+    """
+
+    def __init__(self, database: "RequestRepository"):
+        self.database = database
+        self._snapshot = None
+
+    async def __aenter__(self) -> Session:
+        self._snapshot = await self.database._acquire()
+        return self._snapshot.session
+
+    async def __aexit__(self, exc_type, exc, traceback) -> None:
+        await self.database._release(self._snapshot)
+
+
+class RequestWriteSession:
+    """
+    Session of a request that writes, see `RequestRepository`
+    """
+
+    def __init__(self, database: "RequestRepository"):
+        self.database = database
+        self.session = database.repository.session(write=True)
+
+    async def __aenter__(self) -> Session:
+        # the snapshot is not needed anymore, and repositories with a limited
+        # amount of connections may need the one it holds to write
+        await self.database.close()
+        return await self.session.__aenter__()
+
+    async def __aexit__(self, exc_type, exc, traceback) -> None:
+        await self.session.__aexit__(exc_type, exc, traceback)
+        if exc_type is None:
+            # the reads that follow must see what was written
+            await self.database.close()
+
+
+class RequestRepository:
+    """
+    Wrapper of the repository of a request whose reads share a single session
+
+    The first session that only reads opens a session of the repository, the
+    snapshot of the request, and the ones that follow reuse it, so the storage
+    is opened once for all the resolvers. It's closed when the request ends
+    (see `close`), or as soon as a session that writes commits, and then the
+    next read opens a new one that sees what was written.
+
+    Whether the resolvers all see the same data depends on the repository: on
+    SQLite the snapshot is a transaction, which doesn't see what others commit
+    meanwhile, while TinyDB sessions read the tables of the storage as they
+    are, so the snapshot sees what other requests of the worker commit while
+    it's open.
+
+    Sessions that write are sessions of the repository as usual, so each one
+    is committed by itself when it ends and can be retried when it conflicts
+    (see `ConflictError`): they can't stay open for the rest of the request,
+    since that would hold the lock of the database meanwhile.
+
+    Repositories whose sessions can't overlap (see `concurrent_sessions`) are
+    used as they are.
+
+    :param repository Repository: repository shared by all the requests, or a
+    wrapper of it, like `MeasuredRepository`
+    """
+
+    def __init__(self, repository: Repository):
+        self.repository = repository
+        self._snapshot = None  # type: typing.Optional[_Snapshot]
+
+    def session(
+        self, write: bool = False
+    ) -> typing.Union[RequestSession, RequestWriteSession, Session]:
+        if not self.repository.concurrent_sessions:
+            return self.repository.session(write)
+        if write:
+            return RequestWriteSession(self)
+        return RequestSession(self)
+
+    async def _acquire(self) -> _Snapshot:
+        snapshot = self._snapshot
+        if snapshot is None:
+            snapshot = self._snapshot = _Snapshot(self.repository.session())
+        snapshot.users += 1
+        try:
+            await asyncio.shield(snapshot.opening)
+        except BaseException:
+            snapshot.users -= 1
+            if self._snapshot is snapshot and snapshot.opening.done():
+                # it failed to open, the next session tries again
+                self._snapshot = None
+            raise
+        return snapshot
+
+    async def _release(self, snapshot: _Snapshot) -> None:
+        snapshot.users -= 1
+        if snapshot.users == 0 and snapshot is not self._snapshot:
+            await snapshot.close()
+
+    async def close(self) -> None:
+        """
+        Close the snapshot of the request, if it's open, as soon as no session
+        is using it
+        """
+        snapshot, self._snapshot = self._snapshot, None
+        if snapshot is not None and snapshot.users == 0:
+            await snapshot.close()
+
+    def __getattr__(self, name: str) -> typing.Any:
+        return getattr(self.repository, name)
@@ -0,0 +1,569 @@
+import asyncio
+import collections
+import os
+import sqlite3
+import typing
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from tinydb.database import Document
+
+from ..utils.storage import ConflictError
+from .base import (
+    CartItemTable,
+    CartTable,
+    ProductTable,
+    Repository,
+    Session,
+    Table,
+    UserTable,
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+    id TEXT PRIMARY KEY,
+    title TEXT,
+    price REAL,
+    inventory_count INTEGER
+);
+CREATE INDEX IF NOT EXISTS products_inventory_count ON products (inventory_count);
+CREATE INDEX IF NOT EXISTS products_price ON products (price);
+
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    username TEXT NOT NULL UNIQUE,
+    password_hash TEXT
+);
+
+CREATE TABLE IF NOT EXISTS cart_items (
+    id TEXT PRIMARY KEY,
+    user TEXT NOT NULL,
+    product TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    UNIQUE (user, product)
+);
+CREATE INDEX IF NOT EXISTS cart_items_product ON cart_items (product);
+
+CREATE TABLE IF NOT EXISTS carts (
+    id TEXT PRIMARY KEY,
+    user TEXT NOT NULL UNIQUE,
+    lines INTEGER NOT NULL,
+    price REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    doc_id TEXT NOT NULL
+);
+"""
+
+# every change of the tables is recorded in `changes`, see `SqliteRepository`
+SCHEMA += "".join(
+    f"""
+CREATE TRIGGER IF NOT EXISTS {name}_{event.lower()} AFTER {event} ON {name}
+BEGIN
+    INSERT INTO changes (name, doc_id) VALUES ('{name}', {row}.id);
+END;
+"""
+    for name in ("products", "users", "cart_items", "carts")
+    for event, row in (("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD"))
+)
+
+# ids bound to a single statement at most, older versions of sqlite allow 999
+MAX_VARIABLES = 500
+
+
+class ConnectionPool:
+    """
+    Connections to a SQLite database shared by the sessions of a worker
+
+    At most `size` connections are opened, sessions that find all of them busy
+    wait for one to be released, for `timeout` seconds at most. Statements run
+    in a thread per connection, so they never block the event loop, not even
+    while waiting for the lock of another worker. Connections are opened again
+    after a fork, since they can't be shared between processes.
+
+    :param path str: path of the database file, created if it doesn't exist
+    :param size int: maximum number of connections
+    :param timeout float: seconds to wait for other connections to release the
+    database, or for a connection of the pool, before failing with a
+    `ConflictError`
+    """
+
+    def __init__(self, path: str, size: int = 5, timeout: float = 5.0):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._pid = None
+        self._executor = None
+        self._idle = []
+        self._opened = 0
+        self._waiters = collections.deque()
+
+    def _check_process(self) -> None:
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._executor = ThreadPoolExecutor(max_workers=self.size)
+            self._idle = []
+            self._opened = 0
+            self._waiters.clear()
+
+    def connect(self) -> sqlite3.Connection:
+        """
+        Open a new connection, creating the tables if they don't exist
+        """
+        connection = sqlite3.connect(
+            self.path,
+            timeout=self.timeout,
+            # transactions are started and ended explicitly by the sessions
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        # readers don't block the writer nor the other way around
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA synchronous = NORMAL")
+        connection.executescript(SCHEMA)
+        return connection
+
+    async def run(self, function: typing.Callable, *args: typing.Any) -> typing.Any:
+        """
+        Run a function in the threads of the pool
+        """
+        self._check_process()
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, partial(function, *args))
+
+    async def acquire(self) -> sqlite3.Connection:
+        """
+        Obtain a connection, which must be given back with `release`
+
+        :raises ConflictError: if no connection is released within `timeout`
+        """
+        self._check_process()
+        if self._idle:
+            return self._idle.pop()
+        if self._opened < self.size:
+            self._opened += 1
+            try:
+                return await self.run(self.connect)
+            except BaseException:
+                self._opened -= 1
+                raise
+
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            return await asyncio.wait_for(waiter, self.timeout)
+        except asyncio.TimeoutError:
+            # e.g. the sessions holding the connections wait for this one
+            raise ConflictError("no connection of the pool was released")
+        except asyncio.CancelledError:
+            # the connection may have been given right before the cancellation
+            if waiter.done() and not waiter.cancelled():
+                self.release(waiter.result())
+            raise
+
+    def release(self, connection: sqlite3.Connection) -> None:
+        """
+        Give back a connection that is not in a transaction
+        """
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(connection)
+                return
+        self._idle.append(connection)
+
+    def discard(self, connection: sqlite3.Connection) -> None:
+        """
+        Close a connection that can't be used anymore instead of giving it back
+        """
+        self._opened -= 1
+        connection.close()
+
+    def close(self) -> None:
+        """
+        Close the idle connections
+        """
+        while self._idle:
+            self.discard(self._idle.pop())
+
+
+class SqliteTable(Table):
+    # name of the table and fields of its documents, which are also its columns
+    name = ""
+    fields = ()  # type: typing.Tuple[str, ...]
+
+    def __init__(self, session: "SqliteSession"):
+        self.session = session
+
+    async def _select(
+        self,
+        where: str = "",
+        parameters: typing.Sequence = (),
+        suffix: str = "",
+        fields: typing.Iterable[str] = None,
+    ) -> typing.List[Document]:
+        if fields is None:
+            fields = self.fields
+        else:
+            selected = set(fields)
+            fields = tuple(field for field in self.fields if field in selected)
+        columns = ", ".join(("id",) + fields)
+        rows = await self.session.execute(
+            f"SELECT {columns} FROM {self.name} {where} {suffix}", parameters
+        )
+        self.session._documents_read += len(rows)
+        return [Document(dict(zip(fields, row[1:])), row[0]) for row in rows]
+
+    async def get_many(
+        self, doc_ids: typing.Iterable[str]
+    ) -> typing.List[typing.Optional[Document]]:
+        doc_ids = list(doc_ids)
+        documents = {}
+        for start in range(0, len(doc_ids), MAX_VARIABLES):
+            chunk = doc_ids[start : start + MAX_VARIABLES]
+            placeholders = ", ".join("?" * len(chunk))
+            for document in await self._select(f"WHERE id IN ({placeholders})", chunk):
+                documents[document.doc_id] = document
+        return [documents.get(doc_id) for doc_id in doc_ids]
+
+    async def all(self) -> typing.List[Document]:
+        return await self._select(suffix="ORDER BY rowid")
+
+    async def count(self) -> int:
+        rows = await self.session.execute(f"SELECT COUNT(*) FROM {self.name}")
+        return rows[0][0]
+
+    async def insert(self, document: dict) -> str:
+        return (await self.insert_many([document]))[0]
+
+    async def insert_many(self, documents: typing.List[dict]) -> typing.List[str]:
+        doc_ids = [uuid.uuid4().hex for _ in documents]
+        placeholders = ", ".join("?" * (len(self.fields) + 1))
+        await self.session.modify(
+            f"INSERT INTO {self.name} (id, {', '.join(self.fields)}) "
+            f"VALUES ({placeholders})",
+            [
+                (doc_id, *(document.get(field) for field in self.fields))
+                for doc_id, document in zip(doc_ids, documents)
+            ],
+            many=True,
+        )
+        return doc_ids
+
+    async def update_many(self, documents: typing.List[Document]) -> None:
+        assignments = ", ".join(f"{field} = ?" for field in self.fields)
+        await self.session.modify(
+            f"UPDATE {self.name} SET {assignments} WHERE id = ?",
+            [
+                (*(document.get(field) for field in self.fields), document.doc_id)
+                for document in documents
+            ],
+            many=True,
+        )
+
+    async def remove(self, doc_ids: typing.List[str]) -> None:
+        await self.session.modify(
+            f"DELETE FROM {self.name} WHERE id = ?",
+            [(doc_id,) for doc_id in doc_ids],
+            many=True,
+        )
+
+
+class SqliteProductTable(SqliteTable, ProductTable):
+    name = "products"
+    fields = ("title", "price", "inventory_count")
+
+    async def search(
+        self, available: bool = False, fields: typing.Iterable[str] = None
+    ) -> typing.List[Document]:
+        where = "WHERE inventory_count > 0" if available else ""
+        return await self._select(where, suffix="ORDER BY rowid", fields=fields)
+
+    async def page(
+        self,
+        available: bool = False,
+        after: str = None,
+        limit: int = None,
+        fields: typing.Iterable[str] = None,
+    ) -> typing.List[Document]:
+        conditions, parameters = [], []
+        if available:
+            conditions.append("inventory_count > 0")
+        if after is not None:
+            conditions.append("id > ?")
+            parameters.append(after)
+        where = "WHERE " + " AND ".join(conditions) if conditions else ""
+        # a negative limit is no limit
+        parameters.append(-1 if limit is None else limit)
+        return await self._select(where, parameters, "ORDER BY id LIMIT ?", fields)
+
+    async def update_many(self, documents: typing.List[Document]) -> None:
+        previous = await self.get_many(document.doc_id for document in documents)
+        await super().update_many(documents)
+        await self.reprice_carts(previous, documents)
+
+
+class SqliteUserTable(SqliteTable, UserTable):
+    name = "users"
+    fields = ("username", "password_hash")
+
+    async def get_by_username(self, username: str) -> typing.Optional[Document]:
+        users = await self._select("WHERE username = ?", (username,))
+        return users[0] if users else None
+
+    async def update_password(
+        self, username: str, password_hash: str, new_password_hash: str
+    ) -> bool:
+        updated = await self.session.modify(
+            "UPDATE users SET password_hash = ? WHERE username = ? AND password_hash = ?",
+            (new_password_hash, username, password_hash),
+        )
+        return updated > 0
+
+
+class SqliteCartItemTable(SqliteTable, CartItemTable):
+    name = "cart_items"
+    fields = ("user", "product", "amount")
+
+    async def for_user(self, user_id: str) -> typing.List[Document]:
+        return await self._select("WHERE user = ?", (user_id,), "ORDER BY rowid")
+
+    async def get_item(
+        self, user_id: str, product_id: str
+    ) -> typing.Optional[Document]:
+        items = await self._select(
+            "WHERE user = ? AND product = ?", (user_id, product_id)
+        )
+        return items[0] if items else None
+
+    async def for_product(self, product_id: str) -> typing.List[Document]:
+        return await self._select("WHERE product = ?", (product_id,))
+
+
+class SqliteCartTable(SqliteTable, CartTable):
+    name = "carts"
+    fields = ("user", "lines", "price")
+
+    async def get_for_user(self, user_id: str) -> typing.Optional[Document]:
+        carts = await self._select("WHERE user = ?", (user_id,))
+        return carts[0] if carts else None
+
+
+class SqliteSession(Session):
+    """
+    Transaction on a connection of the pool
+
+    Sessions that write take the lock of the database as soon as they start, so
+    they wait for each other instead of failing when they commit, and the ones
+    that only read see the database as it was when they first read it.
+    """
+
+    def __init__(self, repository: "SqliteRepository", write: bool = False):
+        self.repository = repository
+        self.pool = repository.pool
+        self.write = write
+        self.connection = None
+        self._documents_read = 0
+        # statement being run, which may outlive a cancelled session
+        self._running = None
+
+    @property
+    def documents_read(self) -> int:
+        return self._documents_read
+
+    async def _run(self, function: typing.Callable, *args: typing.Any) -> typing.Any:
+        self._running = asyncio.ensure_future(self.pool.run(function, *args))
+        try:
+            return await asyncio.shield(self._running)
+        except sqlite3.OperationalError as e:
+            if "locked" in str(e) or "busy" in str(e):
+                raise ConflictError(str(e)) from e
+            raise
+
+    async def execute(
+        self, sql: str, parameters: typing.Sequence = ()
+    ) -> typing.List[tuple]:
+        """
+        Run a query
+
+        :returns: the rows it returns
+        """
+
+        def execute(connection: sqlite3.Connection) -> list:
+            return connection.execute(sql, parameters).fetchall()
+
+        return await self._run(execute, self.connection)
+
+    async def modify(
+        self, sql: str, parameters: typing.Sequence = (), many: bool = False
+    ) -> int:
+        """
+        Run a statement that changes the database, or a batch of them when `many`
+
+        :returns: the amount of rows changed
+        """
+
+        def modify(connection: sqlite3.Connection) -> int:
+            if many:
+                return connection.executemany(sql, parameters).rowcount
+            return connection.execute(sql, parameters).rowcount
+
+        if many and not parameters:
+            return 0
+        return await self._run(modify, self.connection)
+
+    async def __aenter__(self) -> "SqliteSession":
+        self.connection = await self.pool.acquire()
+        try:
+            await self.modify("BEGIN IMMEDIATE" if self.write else "BEGIN")
+            await self.repository.read_changes(self)
+        except BaseException:
+            await self._close()
+            raise
+        self.products = SqliteProductTable(self)
+        self.users = SqliteUserTable(self)
+        self.cart_items = SqliteCartItemTable(self)
+        self.carts = SqliteCartTable(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback) -> None:
+        if exc_type is None:
+            try:
+                if self.write:
+                    await self.repository.prune(self)
+                await self.modify("COMMIT")
+            except BaseException:
+                await self._close()
+                raise
+            self.pool.release(self.connection)
+        else:
+            await self._close()
+
+    async def _close(self) -> None:
+        """
+        Roll back the transaction, if any, and give back the connection
+        """
+        connection, self.connection = self.connection, None
+        try:
+            if self._running is not None and not self._running.done():
+                # a statement of a cancelled session, which must end first
+                await asyncio.wait([self._running])
+            if connection.in_transaction:
+                await self.pool.run(connection.rollback)
+        except BaseException:
+            self.pool.discard(connection)
+            raise
+        self.pool.release(connection)
+
+
+class SqliteRepository(Repository):
+    """
+    Repository kept in a SQLite database
+
+    Every worker keeps its own pool of connections (see `ConnectionPool`), and
+    products are indexed by inventory and price, users by username, cart items
+    by user and product and carts by user.
+
+    Changes are recorded by triggers in the `changes` table, and while someone
+    is subscribed (see `subscribe`) every session starts by reading the ones
+    made since the last session, by any worker, and notifying them. Only the
+    last `keep_changes` are kept, workers that fall further behind are notified
+    that the whole database may have changed.
+
+    :param path str: path of the database file
+    :param pool_size int: maximum connections of the worker
+    :param timeout float: seconds a session waits for other workers to commit
+    :param keep_changes int: amount of changes kept for the workers to catch up
+    """
+
+    # write sessions between removals of the changes that aren't kept
+    prune_interval = 1000
+
+    def __init__(
+        self,
+        path: str,
+        pool_size: int = 5,
+        timeout: float = 5.0,
+        keep_changes: int = 10000,
+    ):
+        self.pool = ConnectionPool(path, pool_size, timeout)
+        self.keep_changes = keep_changes
+        self._listeners = []
+        # last change notified, `None` until the first session after subscribing
+        self._sequence = None
+        self._writes = 0
+
+    def session(self, write: bool = False) -> SqliteSession:
+        return SqliteSession(self, write)
+
+    def subscribe(self, callback: typing.Callable) -> bool:
+        self._listeners.append(callback)
+        return True
+
+    async def catch_up(self) -> None:
+        if not self._listeners:
+            return
+        # reading the changes needs a connection but not a transaction
+        session = SqliteSession(self)
+        session.connection = await self.pool.acquire()
+        try:
+            await self.read_changes(session)
+        finally:
+            await session._close()
+
+    async def read_changes(self, session: SqliteSession) -> None:
+        """
+        Notify the changes made since the last session that caught up
+        """
+        if not self._listeners:
+            return
+
+        start = self._sequence
+        if start is None:
+            rows = await session.execute("SELECT MAX(seq) FROM changes")
+            last = rows[0][0] or 0
+        else:
+            rows = await session.execute(
+                "SELECT seq, name, doc_id FROM changes WHERE seq > ? ORDER BY seq",
+                (start,),
+            )
+            if not rows:
+                return
+            last = rows[-1][0]
+
+        # other sessions may have caught up while reading
+        current = self._sequence
+        if current is not None and last <= current:
+            return
+        self._sequence = last
+
+        # the changes in between may have been removed already
+        if start is None or rows[0][0] != start + 1:
+            for listener in list(self._listeners):
+                listener(None, None)
+            return
+
+        changes = {}
+        for seq, name, doc_id in rows:
+            if seq > current:
+                changes.setdefault(name, {})[doc_id] = None
+        for listener in list(self._listeners):
+            for name, doc_ids in changes.items():
+                listener(name, list(doc_ids))
+
+    async def prune(self, session: SqliteSession) -> None:
+        """
+        Remove the changes that aren't kept anymore, once every `prune_interval`
+        write sessions
+        """
+        self._writes += 1
+        if self._writes % self.prune_interval == 0:
+            await session.modify(
+                "DELETE FROM changes WHERE seq <= "
+                "(SELECT MAX(seq) FROM changes) - ?",
+                (self.keep_changes,),
+            )
@@ -0,0 +1,173 @@
+import itertools
+import typing
+
+from tinydb.database import Document
+
+from ..utils.database import Q, TransactionalTinyDB, UuidTable
+from ..utils.storage import TableStorage
+from .base import (
+    CartItemTable,
+    CartTable,
+    ProductTable,
+    Repository,
+    Session,
+    Table,
+    UserTable,
+)
+
+
+class TinyDbTable(Table):
+    def __init__(self, session: "TinyDbSession", table: UuidTable):
+        self.session = session
+        self.table = table
+
+    async def get_many(
+        self, doc_ids: typing.Iterable[str]
+    ) -> typing.List[typing.Optional[Document]]:
+        return self.table.get_multiple(doc_ids)
+
+    async def all(self) -> typing.List[Document]:
+        return self.table.all()
+
+    async def count(self) -> int:
+        return len(self.table)
+
+    async def insert(self, document: dict) -> str:
+        return self.table.insert(document)
+
+    async def insert_many(self, documents: typing.List[dict]) -> typing.List[str]:
+        return self.table.insert_multiple(documents)
+
+    async def update_many(self, documents: typing.List[Document]) -> None:
+        self.table.write_back(documents)
+
+    async def remove(self, doc_ids: typing.List[str]) -> None:
+        self.table.remove(doc_ids=doc_ids)
+
+
+class TinyDbProductTable(TinyDbTable, ProductTable):
+    async def search(
+        self, available: bool = False, fields: typing.Iterable[str] = None
+    ) -> typing.List[Document]:
+        # documents are kept in memory whole, `fields` wouldn't save anything
+        if available:
+            return self.table.search(Q.inventory_count > 0)
+        return self.table.all()
+
+    async def page(
+        self,
+        available: bool = False,
+        after: str = None,
+        limit: int = None,
+        fields: typing.Iterable[str] = None,
+    ) -> typing.List[Document]:
+        products = self.table.ordered(
+            Q.inventory_count > 0 if available else None, after=after
+        )
+        return list(itertools.islice(products, limit))
+
+    async def update_many(self, documents: typing.List[Document]) -> None:
+        previous = await self.get_many(document.doc_id for document in documents)
+        await super().update_many(documents)
+        await self.reprice_carts(previous, documents)
+
+
+class TinyDbUserTable(TinyDbTable, UserTable):
+    async def get_by_username(self, username: str) -> typing.Optional[Document]:
+        return self.table.get(Q.username == username)
+
+    async def update_password(
+        self, username: str, password_hash: str, new_password_hash: str
+    ) -> bool:
+        updated = self.table.update(
+            {"password_hash": new_password_hash},
+            (Q.username == username) & (Q.password_hash == password_hash),
+        )
+        return bool(updated)
+
+
+class TinyDbCartItemTable(TinyDbTable, CartItemTable):
+    async def for_user(self, user_id: str) -> typing.List[Document]:
+        return self.table.search(Q.user == user_id)
+
+    async def get_item(
+        self, user_id: str, product_id: str
+    ) -> typing.Optional[Document]:
+        return self.table.get((Q.user == user_id) & (Q.product == product_id))
+
+    async def for_product(self, product_id: str) -> typing.List[Document]:
+        return self.table.search(Q.product == product_id)
+
+
+class TinyDbCartTable(TinyDbTable, CartTable):
+    async def insert(self, document: dict) -> str:
+        # summaries are given the id of their user, so sessions summarizing the
+        # same cart concurrently conflict instead of keeping two of them
+        doc_id = document["user"]
+        self.table.write_back([document], [doc_id])
+        return doc_id
+
+    async def get_for_user(self, user_id: str) -> typing.Optional[Document]:
+        return self.table.get(Q.user == user_id)
+
+
+class TinyDbSession(Session):
+    def __init__(self, database: TransactionalTinyDB):
+        # a database of its own, sessions can overlap
+        self.database = database.session()
+
+        # session of the storage, kept after the session ends to count its reads
+        self.storage = None  # type: typing.Optional[TableStorage]
+
+    @property
+    def documents_read(self) -> int:
+        if isinstance(self.storage, TableStorage):
+            return self.storage.documents_read
+        return 0
+
+    async def __aenter__(self) -> "TinyDbSession":
+        db = await self.database.__aenter__()
+        self.storage = db._storage
+        self.products = TinyDbProductTable(self, db.table("products"))
+        self.users = TinyDbUserTable(self, db.table("users"))
+        self.cart_items = TinyDbCartItemTable(self, db.table("cart_items"))
+        self.carts = TinyDbCartTable(self, db.table("carts"))
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback) -> None:
+        await self.database.__aexit__(exc_type, exc, traceback)
+
+
+class TinyDbRepository(Repository):
+    """
+    Repository kept in a TinyDB database
+
+    The tables of a session are only valid until it ends. Sessions share the
+    same storage, and the one that writes must not wait for anything else than
+    its tables, since others can't write until it ends (see `Transaction`).
+
+    :param database TransactionalTinyDB: database shared by all the sessions
+    """
+
+    def __init__(self, database: TransactionalTinyDB):
+        self.database = database
+
+    @property
+    def concurrent_sessions(self) -> bool:
+        # other storages read and write the whole file in every session, so the
+        # sessions that overlap would overwrite the changes of each other
+        return isinstance(self.database._storage_cls, TableStorage)
+
+    def session(self, write: bool = False) -> TinyDbSession:
+        # sessions of a `TableStorage` are transactions whether they write or not
+        return TinyDbSession(self.database)
+
+    def subscribe(self, callback: typing.Callable) -> bool:
+        return self.database.subscribe(callback)
+
+    async def catch_up(self) -> None:
+        storage = self.database._storage_cls
+        if not isinstance(storage, TableStorage):
+            return await super().catch_up()
+        # refreshing the storage notifies the changes it finds
+        await storage.__aenter__()
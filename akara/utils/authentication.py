@@ -1,5 +1,7 @@
 import asyncio
 import functools
+import hashlib
+import time
 import typing
 
 import jwt
@@ -13,6 +15,8 @@ from starlette.authentication import (
 )
 
 from ..models import User
+from .cache import LRUCache
+from .metrics import get_metrics
 
 
 def requires(
@@ -60,12 +64,35 @@ def requires(
 class JWTAuthenticationBackend(AuthenticationBackend):
     """
     Authentication backend that uses JWT as authentication tokens
+
+    Verified tokens are kept in a LRU cache, by digest, with the credentials and
+    user they authenticate, so a client sending the same token again isn't
+    verified twice. Entries expire after `cache_ttl` seconds or when the token
+    does, whatever comes first, and the cache counts its hits and misses (see
+    `LRUCache.stats`).
+
+    :param secret_key str: key used to sign the tokens
+    :param algorithm str: algorithm used to sign the tokens
+    :param prefix str: scheme of the authorization header
+    :param cache_size int: maximum number of cached tokens, 0 disables the cache
+    :param cache_ttl float: maximum seconds a token is kept in the cache
+    :param admins: usernames of the users that get the `admin` scope too
     """
 
-    def __init__(self, secret_key: str, algorithm: str, prefix: str = "Bearer"):
+    def __init__(
+        self,
+        secret_key: str,
+        algorithm: str,
+        prefix: str = "Bearer",
+        cache_size: int = 1024,
+        cache_ttl: float = 300,
+        admins: typing.Iterable[str] = (),
+    ):
         self.secret_key = secret_key
         self.algorithm = algorithm
         self.prefix = prefix
+        self.cache = LRUCache(maxsize=cache_size, ttl=cache_ttl)
+        self.admins = frozenset(admins)
 
     @classmethod
     def get_token_from_header(cls, authorization: str, prefix: str) -> str:
@@ -91,15 +118,48 @@ class JWTAuthenticationBackend(AuthenticationBackend):
         if "Authorization" not in request.headers:
             return
 
+        start = time.perf_counter()
+        try:
+            return self.verify(request)
+        finally:
+            metrics = get_metrics(request)
+            if metrics is not None:
+                metrics.add_phase("authentication", time.perf_counter() - start)
+
+    def verify(self, request):
+        """
+        Obtain the credentials and user authenticated by the token of a request
+
+        :raises AuthenticationError: if the token is not valid
+        """
+
         auth = request.headers["Authorization"]
         token = self.get_token_from_header(authorization=auth, prefix=self.prefix)
+
+        key = hashlib.sha256(token.encode()).digest()
+        result = self.cache.get(key)
+        if result is not None:
+            return result
+
         try:
             payload = jwt.decode(
-                token, key=self.secret_key, algorithms=(self.algorithm,)
+                token,
+                key=self.secret_key,
+                algorithms=(self.algorithm,),
+                # tokens that never expire are not accepted, as `require` in
+                # newer versions of pyjwt
+                options={"require_exp": True, "require": ["exp"]},
             )
         except jwt.PyJWTError as e:
             raise AuthenticationError(str(e))
 
-        # removes 'exp' key to create user object only with relevant data
-        del payload["exp"]
-        return (AuthCredentials(["authenticated"]), User.from_json(payload))
+        # removes 'exp' key to create user object only with relevant data, the
+        # token is cached until then, or for `cache_ttl` if it's sooner
+        expires = payload.pop("exp")
+        user = User.from_json(payload)
+        scopes = ["authenticated"]
+        if user.username in self.admins:
+            scopes.append("admin")
+        result = (AuthCredentials(scopes), user)
+        self.cache.set(key, result, expires=expires)
+        return result
@@ -0,0 +1,322 @@
+import codecs
+import csv
+import io
+import json
+import math
+import typing
+
+# fields of the products that are imported and exported, besides the id
+FIELDS = ("title", "price", "inventory_count")
+# longest line accepted when importing, so a file without line breaks isn't read
+# into memory whole
+MAX_LINE_LENGTH = 1024**2
+# invalid rows whose errors are reported, the rest are only counted
+MAX_REPORTED_ERRORS = 100
+
+Row = typing.Tuple[int, typing.Union[dict, "InvalidRow"]]
+
+
+class InvalidFile(ValueError):
+    """
+    The file being imported can't be read, e.g. the header of a csv file lacks
+    some field
+    """
+
+
+class InvalidRow(ValueError):
+    """
+    A row of the file being imported is not a valid product, the rest of the
+    file is imported anyway
+    """
+
+
+async def iter_lines(
+    chunks: typing.AsyncIterable[bytes],
+) -> typing.AsyncIterator[str]:
+    """
+    Split an utf-8 stream in lines, keeping their line breaks
+
+    :param chunks: the stream, in chunks of any size
+    :raises InvalidFile: if a line is longer than `MAX_LINE_LENGTH`
+    """
+    # a byte order mark at the start is skipped
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    pending = ""
+    async for chunk in chunks:
+        pending += decoder.decode(chunk)
+        lines = pending.split("\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line + "\n"
+        if len(pending) > MAX_LINE_LENGTH:
+            raise InvalidFile(f"lines can't be longer than {MAX_LINE_LENGTH}")
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+
+
+async def read_ndjson(lines: typing.AsyncIterable[str]) -> typing.AsyncIterator[Row]:
+    """
+    Read the rows of a newline delimited json file, an object per line
+
+    Empty lines are skipped.
+
+    :returns: the line number and the row of every line, or the `InvalidRow`
+    error of the lines that can't be read
+    """
+    number = 0
+    async for line in lines:
+        number += 1
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield number, InvalidRow(f"invalid json: {e}")
+            continue
+        if isinstance(row, dict):
+            yield number, row
+        else:
+            yield number, InvalidRow("the line is not an object")
+
+
+async def read_csv(lines: typing.AsyncIterable[str]) -> typing.AsyncIterator[Row]:
+    """
+    Read the rows of a csv file, whose first line names the fields
+
+    Empty lines are skipped. Quoted values may span several lines, and rows are
+    numbered by the line they start at.
+
+    :returns: the line number and the row of every line, or the `InvalidRow`
+    error of the lines that can't be read
+    :raises InvalidFile: if the header lacks any of `FIELDS`
+    """
+    header = None  # type: typing.Optional[typing.List[str]]
+    number = start = 0
+    record = ""
+    async for line in lines:
+        number += 1
+        if not record:
+            start = number
+        record += line
+        # quotes inside quoted values are doubled, so a record is complete when
+        # it has an even number of them
+        if record.count('"') % 2:
+            if len(record) > MAX_LINE_LENGTH:
+                raise InvalidFile(f"rows can't be longer than {MAX_LINE_LENGTH}")
+            continue
+        text, record = record, ""
+        if not text.strip():
+            continue
+
+        values = next(csv.reader([text]))
+        if header is None:
+            header = [value.strip() for value in values]
+            missing = [field for field in FIELDS if field not in header]
+            if missing:
+                raise InvalidFile(f"the header lacks {', '.join(missing)}")
+        elif len(values) != len(header):
+            yield start, InvalidRow(
+                f"expected {len(header)} values but there are {len(values)}"
+            )
+        else:
+            yield start, dict(zip(header, values))
+    if record:
+        yield start, InvalidRow("a quoted value is not closed")
+
+
+# row readers by format
+READERS = {"csv": read_csv, "ndjson": read_ndjson}
+
+
+def _number(row: dict, field: str) -> float:
+    value = row.get(field)
+    if isinstance(value, str):
+        try:
+            value = float(value)
+        except ValueError:
+            pass
+    if not isinstance(value, (int, float)) or isinstance(value, bool):
+        raise InvalidRow(f"{field} must be a number")
+    if not math.isfinite(value) or value < 0:
+        raise InvalidRow(f"{field} must be a non-negative number")
+    return value
+
+
+def _integer(row: dict, field: str) -> int:
+    value = row.get(field)
+    if isinstance(value, str):
+        try:
+            value = int(value)
+        except ValueError:
+            pass
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise InvalidRow(f"{field} must be an integer")
+    if value < 0:
+        raise InvalidRow(f"{field} can't be negative")
+    return value
+
+
+def validate_product(row: dict) -> typing.Tuple[typing.Optional[str], dict]:
+    """
+    Check that a row is a valid product, as the fields of `Product`
+
+    Values may be strings, as they are in csv files, if they can be converted.
+
+    :returns: the id of the product, `None` if it's a new one, and its fields
+    :raises InvalidRow: if the row is not valid
+    """
+    unknown = set(row).difference(("id",) + FIELDS)
+    if unknown:
+        raise InvalidRow(f"unknown fields {', '.join(sorted(unknown))}")
+    doc_id = row.get("id") or None
+    if doc_id is not None and not isinstance(doc_id, str):
+        raise InvalidRow("id must be a string")
+    title = row.get("title")
+    if not isinstance(title, str) or not title.strip():
+        raise InvalidRow("title is required")
+    return (
+        doc_id,
+        {
+            "title": title,
+            "price": _number(row, "price"),
+            "inventory_count": _integer(row, "inventory_count"),
+        },
+    )
+
+
+class ImportReport:
+    """
+    Progress of an import, see `import_products`
+    """
+
+    def __init__(self):
+        # rows read, valid or not
+        self.rows = 0
+        self.inserted = 0
+        self.updated = 0
+        self.invalid = 0
+        # line number and message of the first `MAX_REPORTED_ERRORS` errors
+        self.errors = []  # type: typing.List[typing.Tuple[int, str]]
+        self.done = False
+        self._updated_ids = set()  # type: typing.Set[str]
+
+    def add_updated(self, doc_ids: typing.Iterable[str]) -> None:
+        # products repeated in the file are only counted once
+        self._updated_ids.update(doc_ids)
+        self.updated = len(self._updated_ids)
+
+    def add_error(self, line: int, message: str) -> None:
+        self.invalid += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((line, message))
+
+    def to_json(self) -> dict:
+        data = {
+            "rows": self.rows,
+            "inserted": self.inserted,
+            "updated": self.updated,
+            "invalid": self.invalid,
+            "done": self.done,
+        }
+        # errors are only listed once, when the import is done
+        if self.done:
+            data["errors"] = [
+                {"line": line, "message": message} for line, message in self.errors
+            ]
+        return data
+
+
+async def _write_batch(
+    database: typing.Any,
+    batch: typing.List[typing.Tuple[int, typing.Optional[str], dict]],
+    report: ImportReport,
+) -> None:
+    async with database.session(write=True) as session:
+        doc_ids = [doc_id for _, doc_id, _ in batch if doc_id is not None]
+        existing = {
+            document.doc_id: document
+            for document in await session.products.get_many(doc_ids)
+            if document is not None
+        }
+        inserts, updates = [], {}
+        for line, doc_id, fields in batch:
+            if doc_id is None:
+                inserts.append(fields)
+            elif doc_id in existing:
+                document = existing[doc_id]
+                document.update(fields)
+                # a product repeated in the batch is written once, as it's last
+                updates[doc_id] = document
+            else:
+                report.add_error(line, f"there's no product with id {doc_id}")
+        if updates:
+            await session.products.update_many(list(updates.values()))
+        if inserts:
+            await session.products.insert_many(inserts)
+    report.inserted += len(inserts)
+    report.add_updated(updates)
+
+
+async def import_products(
+    database: typing.Any, rows: typing.AsyncIterable[Row], batch_size: int = 1000
+) -> typing.AsyncIterator[ImportReport]:
+    """
+    Import products from rows, like the ones of `read_csv` or `read_ndjson`
+
+    Rows with an id update that product, the rest are inserted as new products.
+    Invalid rows are skipped and reported. The products are written in a
+    session per `batch_size` rows, so only a batch is kept in memory, and each
+    batch is committed on its own: if the import fails, the batches before are
+    kept.
+
+    :param database Repository: repository to write the products to
+    :returns: the report of the import after every batch, the last one `done`
+    """
+    report = ImportReport()
+    batch = []
+    async for line, row in rows:
+        report.rows += 1
+        try:
+            if isinstance(row, InvalidRow):
+                raise row
+            batch.append((line, *validate_product(row)))
+        except InvalidRow as e:
+            report.add_error(line, str(e))
+        if len(batch) >= batch_size:
+            await _write_batch(database, batch, report)
+            batch = []
+            yield report
+    if batch:
+        await _write_batch(database, batch, report)
+    report.done = True
+    yield report
+
+
+def dump_ndjson(products: typing.List[dict], header: bool = False) -> str:
+    """
+    Write products, as exported by `iter_products`, as newline delimited json,
+    which has no header
+    """
+    return "".join(json.dumps(product) + "\n" for product in products)
+
+
+def dump_csv(products: typing.List[dict], header: bool = False) -> str:
+    """
+    Write products, as exported by `iter_products`, as csv
+
+    :param header bool: flag indicating if the header goes first
+    """
+    output = io.StringIO()
+    writer = csv.DictWriter(output, ("id",) + FIELDS, lineterminator="\n")
+    if header:
+        writer.writeheader()
+    writer.writerows(products)
+    return output.getvalue()
+
+
+# writers of exported products by format, and their media types
+WRITERS = {
+    "csv": (dump_csv, "text/csv"),
+    "ndjson": (dump_ndjson, "application/x-ndjson"),
+}
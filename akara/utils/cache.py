@@ -0,0 +1,208 @@
+import collections
+import hashlib
+import time
+import typing
+
+
+class LRUCache:
+    """
+    Bounded in-memory cache that evicts the least recently used entries
+
+    Entries can also expire, after `ttl` seconds or at the time given when
+    setting them, whatever comes first. Expired entries are dropped when they're
+    accessed or when they are the least recently used ones.
+
+    :param maxsize int: maximum number of entries
+    :param ttl float: seconds an entry lives, `None` to keep it until evicted
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # key -> (expiration timestamp or None, value), most recently used last
+        self._entries = collections.OrderedDict()
+
+    def get(self, key: typing.Hashable, default: typing.Any = None) -> typing.Any:
+        """
+        Obtain the value of an entry, counting the access as a hit or a miss
+        """
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] is not None and entry[0] <= time.time():
+            del self._entries[key]
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def set(
+        self, key: typing.Hashable, value: typing.Any, expires: float = None
+    ) -> None:
+        """
+        Add or replace an entry
+
+        :param expires float: unix timestamp at which the entry expires, if it
+        must expire before `ttl`
+        """
+        if self.maxsize <= 0:
+            return
+        if self.ttl is not None:
+            deadline = time.time() + self.ttl
+            expires = deadline if expires is None else min(expires, deadline)
+
+        self._entries[key] = (expires, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def pop(self, key: typing.Hashable, default: typing.Any = None) -> typing.Any:
+        """
+        Remove an entry, returning its value
+        """
+        entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def __contains__(self, key: typing.Hashable) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and (entry[0] is None or entry[0] > time.time())
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        """
+        Obtain the counters of the cache
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+        }
+
+
+def depends_on(context: dict, table: str, doc_id: str = None) -> None:
+    """
+    Record that the response of a request depends on a document, or on the
+    whole table if `doc_id` is `None`, so it can be cached (see `ResponseCache`)
+
+    :param context dict: graphql context of the request
+    """
+    context.setdefault("dependencies", set()).add((table, doc_id))
+
+
+class ResponseCache:
+    """
+    LRU cache of response bodies, bounded by their total size
+
+    Entries are tagged with the documents they were built from, as `(table,
+    doc_id)` pairs, or `(table, None)` for the whole table, and are dropped as
+    soon as any of them changes (see `invalidate`).
+
+    :param maxbytes int: maximum size of all the cached bodies together
+    """
+
+    def __init__(self, maxbytes: int = 16 * 1024 * 1024):
+        self.maxbytes = maxbytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # incremented on every invalidation, so responses built while the data
+        # was changing aren't cached
+        self.generation = 0
+        # key -> (body, etag, tags), most recently used last
+        self._entries = collections.OrderedDict()
+        self._tags = {}
+
+    def get(self, key: typing.Hashable) -> typing.Optional[typing.Tuple[bytes, str]]:
+        """
+        Obtain the body and ETag of a cached response
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[0], entry[1]
+
+    def set(
+        self,
+        key: typing.Hashable,
+        body: bytes,
+        tags: typing.Iterable[tuple],
+        generation: int = None,
+    ) -> str:
+        """
+        Cache a response body
+
+        :param tags: documents the response was built from
+        :param generation int: value of `generation` when the response started
+        being built, if something changed since then the response isn't cached
+        :returns: the ETag of the body
+        """
+        etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        if generation is not None and generation != self.generation:
+            return etag
+        if len(body) > self.maxbytes:
+            return etag
+
+        self._remove(key)
+        tags = frozenset(tags)
+        self._entries[key] = (body, etag, tags)
+        self.size += len(body)
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(key)
+
+        while self.size > self.maxbytes:
+            self._remove(next(iter(self._entries)))
+        return etag
+
+    def _remove(self, key: typing.Hashable) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self.size -= len(entry[0])
+        for tag in entry[2]:
+            keys = self._tags.get(tag)
+            keys.discard(key)
+            if not keys:
+                del self._tags[tag]
+
+    def invalidate(self, table: str = None, doc_ids: typing.Iterable[str] = None):
+        """
+        Drop the responses built from the given documents, those built from the
+        whole table when `doc_ids` is `None`, or every response when `table` is
+        also `None`
+        """
+        self.generation += 1
+        if table is None:
+            self.clear()
+            return
+
+        if doc_ids is None:
+            tags = [tag for tag in self._tags if tag[0] == table]
+        else:
+            tags = [(table, None), *((table, doc_id) for doc_id in doc_ids)]
+
+        for tag in tags:
+            for key in list(self._tags.get(tag, ())):
+                self._remove(key)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._tags.clear()
+        self.size = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,217 @@
+import array
+import bisect
+import itertools
+import math
+import sys
+import typing
+
+from tinydb.database import Document
+
+from .views import ProductView
+
+# inventory count stored for the products that don't have one
+MISSING_COUNT = -(2**63)
+
+
+class ProductColumns:
+    """
+    Products stored by column instead of as a document each
+
+    Ids and titles are kept in lists, titles interned so the products that share
+    one store it once, and prices and inventory counts in typed arrays, so a
+    product takes a fraction of the memory of a document, a dict with its keys
+    and a float and an int object. Filters and aggregates read only the columns
+    they need, unboxing plain numbers instead of looking up keys per product.
+
+    Products are kept in the order they're added. Missing prices are stored as
+    NaN and missing inventory counts as `MISSING_COUNT`, and neither are taken
+    into account by filters and aggregates. Removed products leave their row
+    empty, with a `None` id and neither price nor inventory count, until more
+    than half the rows are empty and the columns are compacted, so removing
+    doesn't copy the columns every time.
+
+    Price filters search the rows sorted by price, which are sorted when first
+    needed and again after prices change.
+
+    :param documents: products to start with
+    """
+
+    def __init__(self, documents: typing.Iterable[Document] = ()):
+        self.ids = []  # type: typing.List[str]
+        self.titles = []  # type: typing.List[typing.Optional[str]]
+        self.prices = array.array("d")
+        self.inventory_counts = array.array("q")
+        # id -> row of the product
+        self._rows = {}  # type: typing.Dict[str, int]
+        # rows left empty by removed products
+        self._removed = 0
+        # prices in order and their rows, `None` until a price filter needs them
+        self._by_price = None  # type: typing.Optional[tuple]
+        for document in documents:
+            self.set(document.doc_id, document)
+
+    def __len__(self) -> int:
+        return len(self.ids) - self._removed
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self._rows
+
+    def set(self, doc_id: str, document: typing.Mapping) -> None:
+        """
+        Add a product, or replace it if it's already stored
+        """
+        title = document.get("title")
+        if isinstance(title, str):
+            title = sys.intern(title)
+        price = document.get("price")
+        price = math.nan if price is None else float(price)
+        count = document.get("inventory_count")
+        count = MISSING_COUNT if count is None else int(count)
+
+        row = self._rows.get(doc_id)
+        if row is None:
+            self._rows[doc_id] = len(self.ids)
+            self.ids.append(doc_id)
+            self.titles.append(title)
+            self.prices.append(price)
+            self.inventory_counts.append(count)
+            if not math.isnan(price):
+                self._by_price = None
+        else:
+            self.titles[row] = title
+            previous = self.prices[row]
+            # NaN isn't equal to itself, but a missing price stays missing
+            if previous != price and (previous == previous or price == price):
+                self._by_price = None
+            self.prices[row] = price
+            self.inventory_counts[row] = count
+
+    def remove_many(self, doc_ids: typing.Iterable[str]) -> None:
+        """
+        Remove several products at once, the ones that aren't stored are ignored
+        """
+        for doc_id in doc_ids:
+            row = self._rows.pop(doc_id, None)
+            if row is None:
+                continue
+            self.ids[row] = None
+            self.titles[row] = None
+            # empty rows never pass the filters nor count in the aggregates
+            self.prices[row] = math.nan
+            self.inventory_counts[row] = MISSING_COUNT
+            self._removed += 1
+            self._by_price = None
+        if self._removed * 2 > len(self.ids):
+            self._compact()
+
+    def _compact(self) -> None:
+        kept = [doc_id is not None for doc_id in self.ids]
+        self.ids = list(itertools.compress(self.ids, kept))
+        self.titles = list(itertools.compress(self.titles, kept))
+        self.prices = array.array("d", itertools.compress(self.prices, kept))
+        self.inventory_counts = array.array(
+            "q", itertools.compress(self.inventory_counts, kept)
+        )
+        self._rows = {doc_id: row for row, doc_id in enumerate(self.ids)}
+        self._removed = 0
+        self._by_price = None
+
+    def _price_order(self) -> typing.Tuple[typing.List[float], typing.List[int]]:
+        if self._by_price is None:
+            prices = self.prices
+            # products without price are left out
+            rows = sorted(
+                (row for row, price in enumerate(prices) if price == price),
+                key=prices.__getitem__,
+            )
+            self._by_price = ([prices[row] for row in rows], rows)
+        return self._by_price
+
+    def document(self, row: int) -> Document:
+        """
+        Obtain the document of the product in a row
+        """
+        price = self.prices[row]
+        count = self.inventory_counts[row]
+        return Document(
+            {
+                "title": self.titles[row],
+                "price": None if math.isnan(price) else price,
+                "inventory_count": None if count == MISSING_COUNT else count,
+            },
+            doc_id=self.ids[row],
+        )
+
+    def rows(
+        self,
+        available: bool = False,
+        min_price: float = None,
+        max_price: float = None,
+    ) -> typing.List[int]:
+        """
+        Find the rows of the products that pass some filters
+
+        :param available bool: only the products in stock
+        :param min_price float: only the products that cost at least this
+        :param max_price float: only the products that cost at most this
+        """
+        if min_price is not None or max_price is not None:
+            lowest = -math.inf if min_price is None else float(min_price)
+            highest = math.inf if max_price is None else float(max_price)
+            prices, by_price = self._price_order()
+            start = bisect.bisect_left(prices, lowest)
+            end = bisect.bisect_right(prices, highest)
+            rows = sorted(by_price[start:end])
+            if not available:
+                return rows
+            counts = self.inventory_counts
+            return [row for row in rows if counts[row] > 0]
+
+        if available:
+            return [
+                row
+                for row, count in zip(range(len(self.ids)), self.inventory_counts)
+                if count > 0
+            ]
+        if self._removed:
+            return [row for row, doc_id in enumerate(self.ids) if doc_id is not None]
+        return list(range(len(self.ids)))
+
+    def total_inventory_value(self) -> float:
+        """
+        Obtain what all the products in stock are worth together
+        """
+        # NaN isn't equal to itself
+        return math.fsum(
+            price * count
+            for price, count in zip(self.prices, self.inventory_counts)
+            if count > 0 and price == price
+        )
+
+    def low_stock(self, threshold: int) -> int:
+        """
+        Count the products in stock with at most `threshold` units left
+        """
+        return sum(1 for count in self.inventory_counts if 0 < count <= threshold)
+
+
+class ProductColumnsView(ProductView):
+    """
+    `ProductColumns` of every repository, kept up to date with its changes (see
+    `ProductView`)
+    """
+
+    def build(self, documents: typing.List[Document]) -> ProductColumns:
+        return ProductColumns(documents)
+
+    def update(
+        self,
+        columns: ProductColumns,
+        changes: typing.Dict[str, typing.Optional[Document]],
+    ) -> None:
+        for doc_id, document in changes.items():
+            if document is not None:
+                columns.set(doc_id, document)
+        columns.remove_many(
+            doc_id for doc_id, document in changes.items() if document is None
+        )
@@ -0,0 +1,188 @@
+import collections
+import time
+import typing
+
+from graphql import GraphQLError
+from graphql.execution.values import get_argument_values
+from graphql.language import ast
+from graphql.type import GraphQLList, GraphQLNonNull
+from graphql.type.definition import get_named_type
+
+# items a list field is assumed to return when it can't be estimated
+DEFAULT_LIST_SIZE = 10
+
+
+def _is_list(field_type: typing.Any) -> bool:
+    if isinstance(field_type, GraphQLNonNull):
+        field_type = field_type.of_type
+    return isinstance(field_type, GraphQLList)
+
+
+def operation_cost(
+    schema: typing.Any,
+    document_ast: ast.Document,
+    operation_name: str = None,
+    variables: dict = None,
+    estimate: typing.Callable[[str, dict], typing.Optional[int]] = None,
+) -> typing.Tuple[int, int]:
+    """
+    Estimate how expensive an operation is without executing it
+
+    Every field selected costs 1 for each item of its parent, so a field inside
+    a list costs as many times as items the list is estimated to have. Fields
+    selected several times under different aliases count every time, and
+    introspection fields don't count at all.
+
+    :param document_ast Document: parsed and validated document
+    :param estimate: function that estimates the amount of items a field
+    returns, given its name (as `Type.field`) and its arguments, or returns
+    `None` to use the default, which is `DEFAULT_LIST_SIZE` for lists and 1 for
+    the rest
+    :returns: the cost and the depth of the operation
+    """
+    fragments = {}
+    operation = None
+    for definition in document_ast.definitions:
+        if isinstance(definition, ast.FragmentDefinition):
+            fragments[definition.name.value] = definition
+        elif isinstance(definition, ast.OperationDefinition):
+            name = definition.name.value if definition.name else None
+            if operation is None and (not operation_name or name == operation_name):
+                operation = definition
+    if operation is None:
+        return 0, 0
+
+    if operation.operation == "mutation":
+        root = schema.get_mutation_type()
+    elif operation.operation == "subscription":
+        root = schema.get_subscription_type()
+    else:
+        root = schema.get_query_type()
+
+    # cost of every fragment for a single item and its depth, as the cost grows
+    # linearly with the items, so fragments spread many times are visited once
+    fragment_costs = {}
+
+    def visit(
+        selection_set: ast.SelectionSet, parent_type: typing.Any, items: int
+    ) -> typing.Tuple[int, int]:
+        cost = depth = 0
+        for selection in selection_set.selections:
+            if isinstance(selection, ast.FragmentSpread):
+                name = selection.name.value
+                if name not in fragment_costs:
+                    fragment = fragments[name]
+                    selection_type = schema.get_type(fragment.type_condition.name.value)
+                    fragment_costs[name] = visit(
+                        fragment.selection_set, selection_type, 1
+                    )
+                unit_cost, fragment_depth = fragment_costs[name]
+                result = (unit_cost * items, fragment_depth)
+            elif isinstance(selection, ast.InlineFragment):
+                selection_type = parent_type
+                if selection.type_condition is not None:
+                    selection_type = schema.get_type(
+                        selection.type_condition.name.value
+                    )
+                result = visit(selection.selection_set, selection_type, items)
+            else:
+                name = selection.name.value
+                fields = getattr(parent_type, "fields", {})
+                if name.startswith("__") or name not in fields:
+                    continue
+                field = fields[name]
+                if selection.selection_set is None:
+                    result = (items, 1)
+                else:
+                    size = None
+                    if estimate is not None:
+                        try:
+                            arguments = get_argument_values(
+                                field.args, selection.arguments, variables or {}
+                            )
+                        except GraphQLError:
+                            arguments = {}
+                        size = estimate(f"{parent_type.name}.{name}", arguments)
+                    if size is None:
+                        size = DEFAULT_LIST_SIZE if _is_list(field.type) else 1
+                    children, children_depth = visit(
+                        selection.selection_set,
+                        get_named_type(field.type),
+                        items * max(size, 0),
+                    )
+                    result = (items + children, children_depth + 1)
+
+            cost += result[0]
+            depth = max(depth, result[1])
+        return cost, depth
+
+    return visit(operation.selection_set, root, 1)
+
+
+class CostBudget:
+    """
+    Cost that every client can spend over a sliding window of time
+
+    The cost of every operation admitted is kept for `window` seconds, and new
+    operations are only admitted while the total cost kept for the client,
+    identified by any hashable key, stays within the budget.
+
+    :param budget int: cost a client can spend in a window
+    :param window float: seconds
+    """
+
+    def __init__(self, budget: int, window: float = 60):
+        self.budget = budget
+        self.window = window
+        # key -> [total cost, deque of (timestamp, cost) oldest first]
+        self._spent = {}
+        self._pruned = time.monotonic()
+
+    def _expire(self, key: typing.Hashable, now: float) -> None:
+        spent = self._spent.get(key)
+        if spent is None:
+            return
+        operations = spent[1]
+        while operations and operations[0][0] <= now - self.window:
+            spent[0] -= operations.popleft()[1]
+        if not operations:
+            del self._spent[key]
+
+    def spent(self, key: typing.Hashable) -> int:
+        """
+        Obtain the cost spent by a client in the current window
+        """
+        self._expire(key, time.monotonic())
+        spent = self._spent.get(key)
+        return spent[0] if spent else 0
+
+    def spend(self, key: typing.Hashable, cost: int) -> float:
+        """
+        Admit an operation if the client has budget enough for it
+
+        :returns: 0 if the operation is admitted, otherwise the seconds until
+        the client may have budget enough again
+        """
+        now = time.monotonic()
+        if now - self._pruned > self.window:
+            # forget the clients that didn't send anything during a window
+            for client in list(self._spent):
+                self._expire(client, now)
+            self._pruned = now
+        self._expire(key, now)
+
+        spent = self._spent.setdefault(key, [0, collections.deque()])
+        if spent[0] + cost <= self.budget:
+            spent[0] += cost
+            spent[1].append((now, cost))
+            return 0
+
+        # wait until enough of the oldest operations leave the window
+        excess = spent[0] + cost - self.budget
+        for timestamp, operation_cost in spent[1]:
+            excess -= operation_cost
+            if excess <= 0:
+                return timestamp + self.window - now
+        if not spent[1]:
+            del self._spent[key]
+        return self.window
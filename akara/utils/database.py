@@ -1,59 +1,261 @@
+import typing
 import uuid
 
 from aiotinydb import AIOTinyDB
-from starlette.datastructures import DatabaseURL
-from starlette.types import ASGIApp, ASGIInstance, Scope
 from tinydb import Query, TinyDB
 from tinydb.database import Document, StorageProxy, Table
 
+from .indexes import HashIndex, KeyIndex, SortedIndex
+from .storage import TableStorage
+
 Q = Query()
 
 
 class UuidTable(Table):
     """
     TinyDB table class to generate random uuid's as id's for documents
+
+    Tables can also declare secondary indexes in `indexes`, by table name and
+    field. Searches, gets, updates and removals whose query compares an indexed
+    field (alone or as part of an `&`) only check the documents the index points
+    to. Indexes are only used when the storage supports them (see
+    `TableStorage.ensure_index`).
     """
 
+    indexes = {
+        "users": {"username": HashIndex},
+        "cart_items": {"user": HashIndex, "product": HashIndex},
+        "carts": {"user": HashIndex},
+        "products": {
+            "doc_id": KeyIndex,
+            "inventory_count": SortedIndex,
+            "price": SortedIndex,
+        },
+    }
+
+    def __init__(self, storage: StorageProxy, name: str, **kwargs: typing.Any):
+        super().__init__(storage, name, **kwargs)
+        self._indexes = {}
+        for field, index_class in self.indexes.get(name, {}).items():
+            index = storage.ensure_index(field, index_class)
+            if index is not None:
+                self._indexes[field] = index
+
     def _get_next_id(self) -> str:
         return uuid.uuid4().hex
 
+    def _lookup(self, hashval: tuple) -> typing.Optional[typing.List[str]]:
+        """
+        Obtain the ids of the documents that may match a query using the indexes
+
+        :param hashval tuple: `hashval` of the query
+        :returns: the candidate ids, or `None` if no index can answer the query
+        """
+        if hashval[0] == "and":
+            for part in hashval[1]:
+                doc_ids = self._lookup(part)
+                if doc_ids is not None:
+                    return doc_ids
+            return None
+
+        path = hashval[1] if len(hashval) > 2 else None
+        if isinstance(path, tuple) and len(path) == 1 and path[0] in self._indexes:
+            return self._indexes[path[0]].lookup(hashval)
+        return None
+
+    def _indexed_search(self, cond: Query) -> typing.Optional[list]:
+        hashval = getattr(cond, "hashval", None)
+        doc_ids = self._lookup(hashval) if self._indexes and hashval else None
+        if doc_ids is None:
+            return None
+
+        data = self._read()
+        return [data[doc_id] for doc_id in doc_ids if cond(data[doc_id])]
+
+    def search(self, cond: Query) -> list:
+        docs = self._indexed_search(cond)
+        if docs is None:
+            return super().search(cond)
+        return docs
+
+    def get(self, cond: Query = None, doc_id: str = None, eid: str = None) -> Document:
+        docs = self._indexed_search(cond) if cond is not None else None
+        if docs is None:
+            return super().get(cond, doc_id, eid)
+        return docs[0] if docs else None
+
+    def process_elements(
+        self,
+        func: typing.Callable,
+        cond: Query = None,
+        doc_ids: list = None,
+        eids: list = None,
+    ) -> list:
+        if cond is not None and doc_ids is None and eids is None:
+            docs = self._indexed_search(cond)
+            if docs is not None:
+                return super().process_elements(
+                    func, doc_ids=[doc.doc_id for doc in docs]
+                )
+        return super().process_elements(func, cond, doc_ids, eids)
+
+    def _init_last_id(self, data: dict) -> None:
+        # uuid's are not sequential, there's no last id to keep track of
+        self._last_id = None
+
+    def all(self) -> list:
+        return list(self._read().values())
+
+    def __iter__(self) -> typing.Iterator[Document]:
+        yield from self._read().values()
+
+    def get_multiple(self, doc_ids: typing.Iterable[str]) -> list:
+        """
+        Get several documents by id reading the table only once
+
+        :param doc_ids: ids of the documents to get
+        :returns: the documents in the same order of `doc_ids`, with `None` in
+        place of the ones that don't exist
+        """
+        data = self._read()
+        return [data.get(doc_id) for doc_id in doc_ids]
+
+    def ordered(
+        self, cond: Query = None, after: str = None
+    ) -> typing.Iterator[Document]:
+        """
+        Iterate the documents sorted by id
+
+        Documents are read lazily, so only the ones that are consumed are copied.
+        The iteration must be consumed before the database session ends.
+
+        :param cond: optional condition the documents must match
+        :param after: id of the document to start after, the first one if `None`
+        """
+        data = self._read()
+        index = self._indexes.get("doc_id")
+        if index is not None:
+            doc_ids = index.after(after)
+        else:
+            doc_ids = sorted(
+                doc_id for doc_id in data if after is None or doc_id > after
+            )
+
+        for doc_id in doc_ids:
+            document = data.get(doc_id)
+            if document is not None and (cond is None or cond(document)):
+                yield document
+
+    def write_back(self, documents: list, doc_ids: list = None) -> list:
+        """
+        Write back documents by doc_id
+
+        Same as `Table.write_back` but without checking the ids against the last
+        generated one, which makes no sense with random ids
+
+        :param documents list: documents to write back
+        :param doc_ids list: ids of the documents, taken from the documents when
+        not present
+        :returns: the ids of the written documents
+        """
+        if doc_ids is None:
+            doc_ids = [doc.doc_id for doc in documents]
+        elif len(documents) != len(doc_ids):
+            raise ValueError("The length of documents and doc_ids is not match.")
+
+        data = self._read()
+        for doc_id, document in zip(doc_ids, documents):
+            data[doc_id] = document
+        self._write(data)
+
+        return doc_ids
+
 
 class UuidStorageProxy(StorageProxy):
     """
     TinyDB storage proxy that allows string keys (uuid's) to be used
     as document id's
+
+    When the storage is a `TableStorage` only the proxied table is read and
+    written, instead of the whole database
     """
 
     def _new_document(self, key: str, value: dict) -> Document:
         return Document(value, key)
 
+    def read(self) -> dict:
+        if isinstance(self._storage, TableStorage):
+            return self._storage.read_table(self._table_name)
+        return super().read()
+
+    def write(self, data: dict) -> None:
+        if isinstance(self._storage, TableStorage):
+            self._storage.write_table(self._table_name, data)
+        else:
+            super().write(data)
+
+    def ensure_index(self, field: str, index_class: type) -> typing.Any:
+        if isinstance(self._storage, TableStorage):
+            return self._storage.ensure_index(self._table_name, field, index_class)
+        return None
+
 
 # set table and proxy on AIOTinyDB since that's what's being used
 AIOTinyDB.table_class = UuidTable
 AIOTinyDB.storage_proxy_class = UuidStorageProxy
 
 
-class TinyDbMiddleware:
+class TransactionalTinyDB(AIOTinyDB):
     """
-    Starlette middleware to provide TinyDb database
+    AIOTinyDB that can be used again after a session fails to commit
+
+    `AIOTinyDB` only forgets the storage of a session when it's closed without
+    errors, so a `ConflictError` raised when committing would leave the database
+    stuck in that session. It also gives access to the change notifications of
+    the storage.
 
-    Uses [aiotinydb](https://github.com/ASMfreaK/aiotinydb) to provide the
-    database connection. The `database_url` that must be supplied must match
-    the pattern `tinydb://path/to/database` in order to be loaded corretcly
+    `AIOTinyDB` also expects a session to end before the next one starts, while
+    sessions of a `TableStorage` can overlap, e.g. when they wait for the
+    storage to load or to commit. Overlapping sessions use a database each,
+    obtained with `session`, with a session of the storage of its own (see
+    `Transaction`).
 
     Example
     -------
     ```
-    async with request.database as db:
-        # db is a TinyDb instance
-        db.insert({ ... })
+    async with database.session() as db:
+        db.table("products").insert({ ... })
     ```
     """
 
-    def __init__(self, app: ASGIApp, database_url: DatabaseURL) -> None:
-        self.app = app
-        self.database = AIOTinyDB(database_url.hostname + database_url.path)
+    def session(self) -> "TransactionalTinyDB":
+        """
+        Obtain a database for a single session, that shares the storage and the
+        change notifications of this one
+        """
+        # `copy.copy` would look attributes up before they are set, which
+        # `AIOTinyDB.__getattr__` forwards to the tables
+        database = object.__new__(type(self))
+        database.__dict__.update(self.__dict__)
+        database._storage = None
+        database._table = None
+        database._table_cache = {}
+        return database
+
+    async def __aexit__(self, exc_type, exc, traceback) -> None:
+        try:
+            await super().__aexit__(exc_type, exc, traceback)
+        finally:
+            self._storage = None
+            self._table_cache = {}
+
+    def subscribe(self, callback: typing.Callable) -> bool:
+        """
+        Register a function to be called when documents change, see
+        `TableStorage.subscribe`
 
-    def __call__(self, scope: Scope) -> ASGIInstance:
-        scope["database"] = self.database
-        return self.app(scope)
+        :returns: if the storage supports change notifications
+        """
+        if isinstance(self._storage_cls, TableStorage):
+            return self._storage_cls.subscribe(callback)
+        return False
@@ -0,0 +1,220 @@
+import bisect
+import itertools
+import numbers
+import typing
+
+
+class Index:
+    """
+    Base class for secondary indexes over a field of the documents of a table
+
+    Indexes are owned and kept up to date by the storage (see
+    `TableStorage.ensure_index`) and used by the tables to answer queries.
+
+    :param field str: name of the indexed field
+    """
+
+    def __init__(self, field: str):
+        self.field = field
+        self.clear()
+
+    def build(self, documents: typing.Mapping[str, dict]) -> None:
+        """
+        Index all the documents of a table, discarding the previous entries
+        """
+        self.clear()
+        for doc_id, document in documents.items():
+            self.add(doc_id, document)
+
+    def update(self, doc_id: str, old: dict, new: dict) -> None:
+        """
+        Move a document to the entry of its new value, if it changed
+
+        :param old dict: previous version of the document, `None` if it's new
+        :param new dict: current version of the document, `None` if it's removed
+        """
+        if old is not None and new is not None:
+            if old.get(self.field, self) == new.get(self.field, self):
+                return
+        if old is not None and self.field in old:
+            self.discard(doc_id, old[self.field])
+        if new is not None and self.field in new:
+            self.add(doc_id, new)
+
+    def clear(self) -> None:
+        raise NotImplementedError()
+
+    def add(self, doc_id: str, document: dict) -> None:
+        raise NotImplementedError()
+
+    def discard(self, doc_id: str, value: typing.Any) -> None:
+        raise NotImplementedError()
+
+    def lookup(self, hashval: tuple) -> typing.Optional[typing.List[str]]:
+        """
+        Obtain the ids of the documents that may match a query
+
+        :param hashval tuple: `hashval` of the TinyDB query on the indexed field
+        :returns: the ids of the candidates, or `None` if the index can't answer
+        the query
+        """
+        raise NotImplementedError()
+
+
+class HashIndex(Index):
+    """
+    Secondary index that maps every value of a field to the ids of the documents
+    that have it, to answer equality queries without scanning the table
+
+    Documents whose value can't be hashed are kept apart and returned as
+    candidates for every lookup, so the query still decides if they match.
+    """
+
+    def clear(self) -> None:
+        self._values = {}
+        self._unhashable = {}
+
+    def add(self, doc_id: str, document: dict) -> None:
+        if self.field not in document:
+            return
+        try:
+            self._values.setdefault(document[self.field], {})[doc_id] = None
+        except TypeError:
+            self._unhashable[doc_id] = None
+
+    def discard(self, doc_id: str, value: typing.Any) -> None:
+        self._unhashable.pop(doc_id, None)
+        try:
+            doc_ids = self._values.get(value, {})
+        except TypeError:
+            return
+        doc_ids.pop(doc_id, None)
+        if not doc_ids:
+            self._values.pop(value, None)
+
+    def lookup(self, hashval: tuple) -> typing.Optional[typing.List[str]]:
+        if hashval[0] != "==":
+            return None
+        try:
+            doc_ids = self._values.get(hashval[2], {})
+        except TypeError:
+            return None
+        return [*doc_ids, *self._unhashable]
+
+
+def _is_number(value: typing.Any) -> bool:
+    return (
+        isinstance(value, numbers.Real)
+        and not isinstance(value, bool)
+        and value == value
+    )
+
+
+class SortedIndex(Index):
+    """
+    Secondary index that keeps the documents sorted by a numeric field, to answer
+    equality and range queries (`<`, `<=`, `>`, `>=`) with a binary search
+
+    Candidates are returned ordered by the value of the field. Documents whose
+    value is not a number are kept apart and returned as candidates for every
+    lookup, so the query still decides if they match.
+    """
+
+    def clear(self) -> None:
+        # `_keys` holds sorted (value, doc_id) pairs and `_values` only the values,
+        # to be able to search by value alone
+        self._keys = []
+        self._values = []
+        self._unsorted = {}
+
+    def build(self, documents: typing.Mapping[str, dict]) -> None:
+        self.clear()
+        keys = []
+        for doc_id, document in documents.items():
+            if self.field not in document:
+                continue
+            value = document[self.field]
+            if _is_number(value):
+                keys.append((value, doc_id))
+            else:
+                self._unsorted[doc_id] = None
+        keys.sort()
+        self._keys = keys
+        self._values = [value for value, _ in keys]
+
+    def add(self, doc_id: str, document: dict) -> None:
+        if self.field not in document:
+            return
+        value = document[self.field]
+        if not _is_number(value):
+            self._unsorted[doc_id] = None
+            return
+        position = bisect.bisect_left(self._keys, (value, doc_id))
+        self._keys.insert(position, (value, doc_id))
+        self._values.insert(position, value)
+
+    def discard(self, doc_id: str, value: typing.Any) -> None:
+        if not _is_number(value):
+            self._unsorted.pop(doc_id, None)
+            return
+        position = bisect.bisect_left(self._keys, (value, doc_id))
+        if position < len(self._keys) and self._keys[position] == (value, doc_id):
+            del self._keys[position]
+            del self._values[position]
+
+    def lookup(self, hashval: tuple) -> typing.Optional[typing.List[str]]:
+        operation, value = hashval[0], hashval[-1]
+        if operation not in ("==", "<", "<=", ">", ">=") or not _is_number(value):
+            return None
+
+        start, end = 0, len(self._values)
+        if operation in ("==", ">="):
+            start = bisect.bisect_left(self._values, value)
+        elif operation == ">":
+            start = bisect.bisect_right(self._values, value)
+        if operation in ("==", "<="):
+            end = bisect.bisect_right(self._values, value)
+        elif operation == "<":
+            end = bisect.bisect_left(self._values, value)
+
+        return [doc_id for _, doc_id in self._keys[start:end]] + list(self._unsorted)
+
+
+class KeyIndex(Index):
+    """
+    Index that keeps the ids of all the documents of a table sorted, to iterate
+    the table in a stable order starting from any id (keyset pagination)
+
+    It doesn't index any field of the documents, so it's declared with `doc_id`
+    as field name and doesn't answer queries.
+    """
+
+    def clear(self) -> None:
+        self._ids = []
+
+    def build(self, documents: typing.Mapping[str, dict]) -> None:
+        self._ids = sorted(documents)
+
+    def update(self, doc_id: str, old: dict, new: dict) -> None:
+        if old is None and new is not None:
+            self.add(doc_id, new)
+        elif old is not None and new is None:
+            self.discard(doc_id, None)
+
+    def add(self, doc_id: str, document: dict) -> None:
+        bisect.insort(self._ids, doc_id)
+
+    def discard(self, doc_id: str, value: typing.Any) -> None:
+        position = bisect.bisect_left(self._ids, doc_id)
+        if position < len(self._ids) and self._ids[position] == doc_id:
+            del self._ids[position]
+
+    def lookup(self, hashval: tuple) -> typing.Optional[typing.List[str]]:
+        return None
+
+    def after(self, doc_id: str = None) -> typing.Iterator[str]:
+        """
+        Iterate the sorted ids that come after `doc_id`, or all of them if `None`
+        """
+        start = 0 if doc_id is None else bisect.bisect_right(self._ids, doc_id)
+        return itertools.islice(self._ids, start, None)
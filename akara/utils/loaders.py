@@ -0,0 +1,97 @@
+import asyncio
+import typing
+
+from tinydb.database import Document
+
+from ..repositories import Repository
+
+
+class DocumentLoader:
+    """
+    Batches and caches the loading of documents from a table by id
+
+    Every id requested in the same iteration of the event loop is loaded in a
+    single storage access, and each id is loaded only once for the life of the
+    loader, which is meant to be created once per request (see `get_loader`).
+
+    Example
+    -------
+    ```
+    loader = get_loader(info.context, "products")
+    first, second = await asyncio.gather(loader.load(a), loader.load(b))
+    ```
+    """
+
+    def __init__(self, database: Repository, table: str):
+        self.database = database
+        self.table = table
+        self._cache = {}
+        self._queue = []
+
+    def load(self, doc_id: str) -> "asyncio.Future[typing.Optional[Document]]":
+        """
+        Obtain a document by id
+
+        :param doc_id str: id of the document to load
+        :returns: a future with the document, or `None` if it doesn't exist
+        """
+        if doc_id not in self._cache:
+            loop = asyncio.get_event_loop()
+            if not self._queue:
+                loop.call_soon(asyncio.ensure_future, self._dispatch())
+            self._queue.append(doc_id)
+            self._cache[doc_id] = loop.create_future()
+        return self._cache[doc_id]
+
+    async def load_many(
+        self, doc_ids: typing.Iterable[str]
+    ) -> typing.List[typing.Optional[Document]]:
+        """
+        Obtain several documents by id, in the same order of `doc_ids`
+        """
+        return await asyncio.gather(*(self.load(doc_id) for doc_id in doc_ids))
+
+    def prime(self, doc_id: str, document: typing.Optional[Document]) -> None:
+        """
+        Set the cached value of a document, e.g. after it has been written
+        """
+        future = asyncio.get_event_loop().create_future()
+        future.set_result(document)
+        self._cache[doc_id] = future
+
+    def clear(self, doc_id: str) -> None:
+        """
+        Remove a document from the cache so it's loaded again on the next access
+        """
+        self._cache.pop(doc_id, None)
+
+    async def _dispatch(self) -> None:
+        doc_ids, self._queue = self._queue, []
+        futures = [self._cache[doc_id] for doc_id in doc_ids]
+        try:
+            async with self.database.session() as session:
+                documents = await session.table(self.table).get_many(doc_ids)
+        except Exception as e:
+            for doc_id, future in zip(doc_ids, futures):
+                if self._cache.get(doc_id) is future:
+                    del self._cache[doc_id]
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for future, document in zip(futures, documents):
+            if not future.done():
+                future.set_result(document)
+
+
+def get_loader(context: dict, table: str) -> DocumentLoader:
+    """
+    Obtain the loader of a table for the current request
+
+    :param context dict: graphql context of the request
+    :param table str: name of the table to load documents from
+    """
+    loaders = context.setdefault("loaders", {})
+    if table not in loaders:
+        loaders[table] = DocumentLoader(context["request"].database, table)
+    return loaders[table]
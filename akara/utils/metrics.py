@@ -0,0 +1,333 @@
+import bisect
+import logging
+import random
+import time
+import typing
+
+from promise import Promise
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse
+from starlette.routing import BaseRoute, Match
+from starlette.types import ASGIApp, ASGIInstance, Receive, Scope, Send
+
+logger = logging.getLogger("akara.slow_queries")
+
+# upper bounds of the buckets of latency histograms, in seconds
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+)
+# upper bounds of the buckets of per-request count histograms
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 5000, 10000)
+
+
+def _format_labels(names: typing.Sequence[str], values: typing.Sequence) -> str:
+    if not names:
+        return ""
+    labels = ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in zip(names, values)
+    )
+    return "{" + labels + "}"
+
+
+class Counter:
+    """
+    Prometheus counter, with one value per combination of labels
+
+    :param name str: name of the metric
+    :param documentation str: help text of the metric
+    :param labels: names of the labels of the metric
+    """
+
+    type = "counter"
+
+    def __init__(
+        self, name: str, documentation: str, labels: typing.Sequence[str] = ()
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+
+    def inc(self, amount: float = 1, *labels: typing.Any) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self) -> typing.Iterator[str]:
+        for labels, value in sorted(self._values.items()):
+            yield f"{self.name}{_format_labels(self.labels, labels)} {value}"
+
+
+class Histogram(Counter):
+    """
+    Prometheus histogram, with one set of buckets per combination of labels
+
+    :param buckets: upper bounds of the buckets, sorted
+    """
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: typing.Sequence[str] = (),
+        buckets: typing.Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels: typing.Any) -> None:
+        series = self._values.get(labels)
+        if series is None:
+            # counts of every bucket, the last one being +Inf, and the sum
+            series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def samples(self) -> typing.Iterator[str]:
+        names = self.labels + ("le",)
+        for labels, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield "{}_bucket{} {}".format(
+                    self.name, _format_labels(names, labels + (bound,)), cumulative
+                )
+            suffix = _format_labels(self.labels, labels)
+            yield f"{self.name}_sum{suffix} {total}"
+            yield f"{self.name}_count{suffix} {cumulative}"
+
+
+class Registry:
+    """
+    Collection of the metrics of a worker
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric: Counter) -> Counter:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """
+        Obtain all the metrics in the Prometheus text format
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+REQUEST_SECONDS = registry.register(
+    Histogram(
+        "http_request_duration_seconds", "Latency of requests, by route", ["path"]
+    )
+)
+PHASE_SECONDS = registry.register(
+    Histogram(
+        "request_phase_duration_seconds",
+        "Time spent by requests in each phase: authentication, parsing, execution, "
+        "storage sessions and serialization",
+        ["phase"],
+    )
+)
+OPERATION_SECONDS = registry.register(
+    Histogram(
+        "graphql_operation_duration_seconds",
+        "Execution time of graphql operations",
+        ["operation"],
+    )
+)
+RESOLVER_SECONDS = registry.register(
+    Histogram(
+        "graphql_resolver_duration_seconds",
+        "Execution time of graphql resolvers",
+        ["field"],
+    )
+)
+STORAGE_OPENS = registry.register(
+    Histogram(
+        "storage_opens_per_request",
+        "Database sessions opened by each request",
+        buckets=COUNT_BUCKETS,
+    )
+)
+DOCUMENTS_SCANNED = registry.register(
+    Histogram(
+        "documents_scanned_per_request",
+        "Documents read from the storage by each request",
+        buckets=COUNT_BUCKETS,
+    )
+)
+SLOW_REQUESTS = registry.register(
+    Counter("slow_requests_total", "Requests slower than the slow query threshold")
+)
+
+
+class RequestMetrics:
+    """
+    Measures taken along a single request, available as `scope["metrics"]`
+    """
+
+    def __init__(self):
+        self.operation = None
+        self.storage_opens = 0
+        self.documents_scanned = 0
+        self.phases = {}
+        self.resolvers = {}
+
+    def add_phase(self, phase: str, seconds: float) -> None:
+        PHASE_SECONDS.observe(seconds, phase)
+        self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+    def add_resolver(self, field: str, seconds: float) -> None:
+        RESOLVER_SECONDS.observe(seconds, field)
+        self.resolvers[field] = self.resolvers.get(field, 0) + seconds
+
+
+def get_metrics(scope: typing.Mapping) -> typing.Optional[RequestMetrics]:
+    """
+    Obtain the metrics of the current request, `None` if they're not measured
+
+    :param scope: scope of the request, or the request itself
+    """
+    return scope.get("metrics")
+
+
+class MetricsMiddleware:
+    """
+    Starlette middleware that measures every request
+
+    It must be the outermost middleware. Other components add their measures to
+    the `RequestMetrics` of the request, which are aggregated per worker and
+    exposed by `metrics_endpoint`. Requests slower than `slow_threshold`
+    seconds are logged to the `akara.slow_queries` logger, a `slow_sample_rate`
+    fraction of them, with the details of where the time was spent.
+
+    Latencies are labelled with the path of the route of the request, so paths
+    with parameters share a label, and the ones that match no route with
+    `other`, so clients can't add labels at will.
+
+    :param slow_threshold float: seconds, `None` to disable the slow query log
+    :param slow_sample_rate float: fraction of the slow requests that are logged
+    :param routes: routes of the app, which may still be added to afterwards
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        slow_threshold: float = None,
+        slow_sample_rate: float = 1.0,
+        routes: typing.Sequence[BaseRoute] = (),
+    ) -> None:
+        self.app = app
+        self.slow_threshold = slow_threshold
+        self.slow_sample_rate = slow_sample_rate
+        self.routes = routes
+
+    def route_label(self, scope: Scope) -> str:
+        """
+        Obtain the label of the route of a request, `other` if it has none
+        """
+        for route in self.routes:
+            match, _ = route.matches(scope)
+            if match != Match.NONE:
+                return getattr(route, "path", "other")
+        return "other"
+
+    def __call__(self, scope: Scope) -> ASGIInstance:
+        if scope["type"] != "http":
+            return self.app(scope)
+
+        metrics = scope["metrics"] = RequestMetrics()
+        instance = self.app(scope)
+
+        async def measure(receive: Receive, send: Send) -> None:
+            start = time.perf_counter()
+            try:
+                await instance(receive, send)
+            finally:
+                self.finish(scope, metrics, time.perf_counter() - start)
+
+        return measure
+
+    def finish(self, scope: Scope, metrics: RequestMetrics, seconds: float) -> None:
+        REQUEST_SECONDS.observe(seconds, self.route_label(scope))
+        STORAGE_OPENS.observe(metrics.storage_opens)
+        DOCUMENTS_SCANNED.observe(metrics.documents_scanned)
+
+        if self.slow_threshold is None or seconds < self.slow_threshold:
+            return
+        SLOW_REQUESTS.inc()
+        if random.random() < self.slow_sample_rate:
+            slowest = sorted(metrics.resolvers.items(), key=lambda item: -item[1])
+            logger.warning(
+                "slow request %s operation=%s seconds=%.4f storage_opens=%d "
+                "documents_scanned=%d phases=%s resolvers=%s",
+                scope["path"],
+                metrics.operation,
+                seconds,
+                metrics.storage_opens,
+                metrics.documents_scanned,
+                {phase: round(value, 4) for phase, value in metrics.phases.items()},
+                {field: round(value, 4) for field, value in slowest[:5]},
+            )
+
+
+class ResolverMetricsMiddleware:
+    """
+    Graphene middleware that measures the resolvers of the operations
+
+    Only fields of the root types and fields resolved asynchronously are
+    measured, the rest are plain attribute reads.
+    """
+
+    def resolve(self, next: typing.Callable, root, info, **args) -> typing.Any:
+        request = info.context.get("request")
+        metrics = get_metrics(request) if request is not None else None
+        if metrics is None:
+            return next(root, info, **args)
+
+        field = f"{info.parent_type.name}.{info.field_name}"
+        start = time.perf_counter()
+        result = next(root, info, **args)
+        # results are wrapped in promises, which are pending if they're async
+        if isinstance(result, Promise) and result.is_pending:
+
+            def fulfilled(value: typing.Any) -> typing.Any:
+                metrics.add_resolver(field, time.perf_counter() - start)
+                return value
+
+            def rejected(error: Exception) -> typing.Any:
+                metrics.add_resolver(field, time.perf_counter() - start)
+                raise error
+
+            return result.then(fulfilled, rejected)
+
+        if root is None:
+            metrics.add_resolver(field, time.perf_counter() - start)
+        return result
+
+
+async def metrics_endpoint(request: Request) -> PlainTextResponse:
+    """
+    Expose the metrics of the worker in the Prometheus text format
+    """
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
@@ -1,18 +1,71 @@
+import asyncio
+import concurrent.futures
 import hashlib
-import uuid
+import hmac
+import os
+
+from config.settings import (
+    PASSWORD_HASHER,
+    PASSWORD_HASHING_THREADS,
+    PBKDF2_ITERATIONS,
+    SCRYPT_COST,
+    SCRYPT_BLOCK_SIZE,
+    SCRYPT_PARALLELISM,
+)
+
+# hashes are stored as `$<algorithm>$<parameters>$<salt>$<hash>`, hashes without
+# the leading `$` are the legacy salted sha512 ones
+SCRYPT = "scrypt"
+PBKDF2 = "pbkdf2-sha256"
+
+_executor = None
+
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(
+        password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r * p
+    )
+
+
+def _pbkdf2(password: str, salt: bytes, iterations: int) -> bytes:
+    return hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+
+
+def _parameters() -> str:
+    if PASSWORD_HASHER == SCRYPT:
+        return f"n={SCRYPT_COST},r={SCRYPT_BLOCK_SIZE},p={SCRYPT_PARALLELISM}"
+    if PASSWORD_HASHER == PBKDF2:
+        return f"i={PBKDF2_ITERATIONS}"
+    raise ValueError(f"unknown password hasher {PASSWORD_HASHER}")
+
+
+def _derive(password: str, algorithm: str, parameters: str, salt: bytes) -> bytes:
+    values = dict(parameter.split("=") for parameter in parameters.split(","))
+    if algorithm == SCRYPT:
+        return _scrypt(
+            password, salt, int(values["n"]), int(values["r"]), int(values["p"])
+        )
+    if algorithm == PBKDF2:
+        return _pbkdf2(password, salt, int(values["i"]))
+    raise ValueError(f"unknown password hasher {algorithm}")
 
 
 def hash_password(password: str) -> str:
     """
     Creates a hash from a password adding a random salt
 
+    The key derivation function and its cost are taken from the settings
+    (`PASSWORD_HASHER`, `SCRYPT_*` and `PBKDF2_ITERATIONS`) and stored along with
+    the hash, so they can be changed without invalidating existing hashes.
+
     :param password str: Password to hash
-    :returns: The bytes from the hashed password
-    :rtype: bytes
+    :returns: The hashed password
+    :rtype: str
     """
-    salt = uuid.uuid4().hex
-    _hash = hashlib.sha512(password.encode() + salt.encode()).hexdigest()
-    return salt + _hash
+    salt = os.urandom(16)
+    parameters = _parameters()
+    _hash = _derive(password, PASSWORD_HASHER, parameters, salt)
+    return f"${PASSWORD_HASHER}${parameters}${salt.hex()}${_hash.hex()}"
 
 
 def verify_password(password: str, password_hash: str) -> bool:
@@ -20,11 +73,62 @@ def verify_password(password: str, password_hash: str) -> bool:
     Verify a raw password against a hashed one
 
     :param password str: Raw password to check
-    :param password_hash bytes: Password hash to check against
+    :param password_hash str: Password hash to check against, either one made by
+    `hash_password` or a legacy salted sha512 one
     :returns: If the password matched with the hashed one or not
     :rtype: bool
     """
-    salt = password_hash[:32]
-    _hash = password_hash[32:]
-    _new_hash = hashlib.sha512(password.encode() + salt.encode()).hexdigest()
-    return _new_hash == _hash
+    if not password_hash.startswith("$"):
+        salt = password_hash[:32]
+        _hash = password_hash[32:]
+        _new_hash = hashlib.sha512(password.encode() + salt.encode()).hexdigest()
+        return hmac.compare_digest(_new_hash, _hash)
+
+    try:
+        _, algorithm, parameters, salt, _hash = password_hash.split("$")
+        _new_hash = _derive(password, algorithm, parameters, bytes.fromhex(salt))
+    except (ValueError, KeyError):
+        # a malformed hash, e.g. lacking some parameter, matches no password
+        return False
+    return hmac.compare_digest(_new_hash.hex(), _hash)
+
+
+def needs_rehash(password_hash: str) -> bool:
+    """
+    Check if a hash was made with other function or cost than the current ones
+    """
+    return not password_hash.startswith(f"${PASSWORD_HASHER}${_parameters()}$")
+
+
+def get_executor() -> concurrent.futures.ThreadPoolExecutor:
+    """
+    Obtain the thread pool where passwords are hashed
+
+    hashlib releases the GIL while hashing, so slow hashes run there don't
+    block the event loop, and the size of the pool bounds the amount of CPU
+    used for hashing at once.
+    """
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=PASSWORD_HASHING_THREADS, thread_name_prefix="password"
+        )
+    return _executor
+
+
+async def hash_password_async(password: str) -> str:
+    """
+    Same as `hash_password` but hashing on the password thread pool
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(get_executor(), hash_password, password)
+
+
+async def verify_password_async(password: str, password_hash: str) -> bool:
+    """
+    Same as `verify_password` but hashing on the password thread pool
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        get_executor(), verify_password, password, password_hash
+    )
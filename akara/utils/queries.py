@@ -0,0 +1,640 @@
+import asyncio
+import hashlib
+import json
+import math
+import time
+import typing
+from functools import partial
+
+from graphql import GraphQLError, parse, validate
+from graphql.backend.base import GraphQLBackend, GraphQLDocument
+from graphql.error import format_error
+from graphql.language import ast
+from graphql.execution import ExecutionResult, execute
+from starlette import status
+from starlette.background import BackgroundTasks
+from starlette.concurrency import run_in_threadpool
+from starlette.graphql import GraphQLApp
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+
+from ..repositories import shared_repository
+from .cache import LRUCache, ResponseCache
+from .complexity import CostBudget, operation_cost
+from .metrics import OPERATION_SECONDS, get_metrics
+
+
+def query_hash(query: str) -> str:
+    """
+    Obtain the hash that identifies a query, the hex sha256 of its text
+    """
+    return hashlib.sha256(query.encode()).hexdigest()
+
+
+def operation_label(document: GraphQLDocument, operation_name: str = None) -> str:
+    """
+    Obtain the name of the operation to run from a document, or its type if it's
+    anonymous
+    """
+    if operation_name:
+        return operation_name
+    for definition in document.document_ast.definitions:
+        if isinstance(definition, ast.OperationDefinition):
+            return definition.name.value if definition.name else definition.operation
+    return ""
+
+
+class PersistedQueryBackend(GraphQLBackend):
+    """
+    GraphQL backend that keeps parsed and validated documents in a LRU cache
+
+    Documents are identified by the hash of their text (see `query_hash`), so
+    they can be executed again by hash alone, and the ones that are found in
+    the cache are executed without being parsed or validated again.
+
+    :param maxsize int: maximum number of cached documents
+    """
+
+    def __init__(self, maxsize: int = 1000):
+        self.documents = LRUCache(maxsize=maxsize)
+
+    def get(self, sha256: str) -> typing.Optional[GraphQLDocument]:
+        """
+        Obtain a cached document by hash, `None` if it's not registered
+        """
+        return self.documents.get(sha256)
+
+    def register(self, schema: typing.Any, query: str) -> GraphQLDocument:
+        """
+        Parse and validate a query, caching it if it's valid
+
+        :raises GraphQLSyntaxError: if the query can't be parsed
+        """
+        document_ast = parse(query)
+        errors = validate(schema, document_ast)
+        if errors:
+            result = ExecutionResult(errors=errors, invalid=True)
+            return GraphQLDocument(
+                schema, query, document_ast, lambda *args, **kwargs: result
+            )
+
+        document = GraphQLDocument(
+            schema, query, document_ast, partial(execute, schema, document_ast)
+        )
+        self.documents.set(query_hash(query), document)
+        return document
+
+    def document_from_string(
+        self, schema: typing.Any, document_string: typing.Any
+    ) -> GraphQLDocument:
+        if isinstance(document_string, GraphQLDocument):
+            return document_string
+        document = self.get(query_hash(document_string))
+        if document is None:
+            document = self.register(schema, document_string)
+        return document
+
+
+class _UnknownSize(Exception):
+    """
+    Raised when the size of a table isn't known without reading the database
+    """
+
+
+class PersistedQueryApp(GraphQLApp):
+    """
+    Starlette GraphQL app with automatic persisted queries
+
+    Besides the usual `query`, requests can identify the query by its hash in
+    the `persistedQuery` extension, as done by Apollo clients:
+
+    ```
+    {"extensions": {"persistedQuery": {"version": 1, "sha256Hash": "..."}}}
+    ```
+
+    A hash that isn't registered yet fails with a `PersistedQueryNotFound`
+    error, and the client must send it again along with the full query, which
+    registers it. Every query, persisted or not, is parsed and validated only
+    the first time it's received (see `PersistedQueryBackend`).
+
+    Responses to anonymous queries that only select `cacheable_fields` are
+    cached, by query and variables, as long as the documents their resolvers
+    depend on (see `depends_on`) don't change. Changes are taken from the
+    repository, so it must support notifications (see `Repository.subscribe`).
+    Cached responses carry an `ETag`, and requests with a matching
+    `If-None-Match` get a `304 Not Modified`.
+
+    When the request is measured (see `MetricsMiddleware`) the time spent
+    parsing, executing and serializing is added to its metrics. Execution times
+    are labelled with the name of the operation when it's one of the
+    `measured_operations`, and with `other` otherwise, since names are chosen by
+    the clients.
+
+    Before executing an operation its cost is estimated (see `operation_cost`),
+    and operations deeper than `max_depth` or more expensive than `max_cost` are
+    rejected. Clients, by token or by address when anonymous, can also be
+    limited to a `cost_budget` over a window of time, the requests that exceed
+    it get a `429 Too Many Requests`.
+
+    A JSON array of operations can be sent instead of a single one, and they're
+    executed concurrently, sharing the authentication of the request and the
+    documents loaded by the others (see `get_loader`). The response is the
+    array of their responses, in the same order.
+
+    :param cache_size int: maximum number of registered queries
+    :param response_cache_size int: maximum bytes of cached responses
+    :param cacheable_fields: query fields whose responses can be cached
+    :param middleware: graphene middleware to execute the queries with
+    :param max_cost int: maximum estimated cost of an operation
+    :param max_depth int: maximum depth of an operation
+    :param cost_budget CostBudget: cost each client can spend over time
+    :param estimate: function that estimates the amount of items a field
+    returns, like the one of `operation_cost` but also given a function that
+    returns the amount of documents of a table
+    :param max_batch_size int: maximum number of operations of a batch
+    :param measured_operations: names of the operations measured on their own
+    """
+
+    def __init__(
+        self,
+        schema: typing.Any,
+        executor: typing.Any = None,
+        cache_size: int = 1000,
+        response_cache_size: int = 16 * 1024 * 1024,
+        cacheable_fields: typing.Iterable[str] = (
+            "products",
+            "productsConnection",
+            "product",
+            "searchProducts",
+            "catalogStats",
+        ),
+        middleware: typing.Sequence = None,
+        max_cost: int = None,
+        max_depth: int = None,
+        cost_budget: CostBudget = None,
+        estimate: typing.Callable = None,
+        max_batch_size: int = None,
+        measured_operations: typing.Iterable[str] = (),
+    ) -> None:
+        super().__init__(schema, executor)
+        self.middleware = middleware
+        self.backend = PersistedQueryBackend(maxsize=cache_size)
+        self.responses = ResponseCache(maxbytes=response_cache_size)
+        self.cacheable_fields = frozenset(cacheable_fields)
+        self.max_cost = max_cost
+        self.max_depth = max_depth
+        self.cost_budget = cost_budget
+        self.estimate = estimate
+        self.max_batch_size = max_batch_size
+        self.measured_operations = frozenset(measured_operations)
+        # databases that notify their changes to `changed`, and if they can
+        self._subscriptions = {}
+        # amount of documents of the tables used to estimate costs, only kept
+        # while the database notifies their changes
+        self._table_sizes = {}
+
+    async def get_data(self, request: Request) -> typing.Union[dict, list, Response]:
+        """
+        Obtain the parameters of the request, or the response to send if they
+        can't be read
+        """
+        if request.method in ("GET", "HEAD"):
+            return dict(request.query_params)
+
+        if request.method == "POST":
+            content_type = request.headers.get("Content-Type", "")
+
+            if "application/json" in content_type:
+                return await request.json()
+            if "application/graphql" in content_type:
+                body = await request.body()
+                return {"query": body.decode()}
+            if "query" in request.query_params:
+                return dict(request.query_params)
+            return PlainTextResponse(
+                "Unsupported Media Type",
+                status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            )
+
+        return PlainTextResponse(
+            "Method Not Allowed", status_code=status.HTTP_405_METHOD_NOT_ALLOWED
+        )
+
+    def get_document(
+        self, data: dict
+    ) -> typing.Union[str, GraphQLDocument, ExecutionResult, None]:
+        """
+        Obtain the query to execute for the given request parameters
+
+        :returns: the query, the persisted document, an error result if the
+        persisted query can't be used, or `None` if there's no query at all
+        """
+        query = data.get("query")
+        extensions = data.get("extensions") or {}
+        if isinstance(extensions, str):
+            try:
+                extensions = json.loads(extensions)
+            except ValueError:
+                extensions = {}
+        if not isinstance(extensions, dict):
+            return ExecutionResult(
+                errors=[GraphQLError("extensions must be an object")]
+            )
+
+        persisted = extensions.get("persistedQuery")
+        if not isinstance(persisted, dict) or "sha256Hash" not in persisted:
+            return query
+
+        sha256 = persisted["sha256Hash"]
+        if query is None:
+            document = self.backend.get(sha256)
+            if document is None:
+                return ExecutionResult(errors=[GraphQLError("PersistedQueryNotFound")])
+            return document
+
+        if query_hash(query) != sha256:
+            return ExecutionResult(
+                errors=[GraphQLError("provided sha does not match query")]
+            )
+        return query
+
+    async def handle_graphql(self, request: Request) -> Response:
+        if request.method in ("GET", "HEAD"):
+            if "text/html" in request.headers.get("Accept", ""):
+                return await self.handle_graphiql(request)
+
+        data = await self.get_data(request)
+        if isinstance(data, Response):
+            return data
+        if isinstance(data, list):
+            return await self.handle_batch(request, data)
+        return await self.handle_operation(request, data, BackgroundTasks(), {})
+
+    async def handle_batch(self, request: Request, batch: list) -> Response:
+        """
+        Execute the operations of a batch concurrently, see `handle_operation`
+
+        The response is the array of the responses to every operation, in the
+        same order, and is never a `304 Not Modified`.
+        """
+        if not batch:
+            return PlainTextResponse(
+                "The batch has no operations", status_code=status.HTTP_400_BAD_REQUEST
+            )
+        if self.max_batch_size is not None and len(batch) > self.max_batch_size:
+            return PlainTextResponse(
+                f"batches can't have more than {self.max_batch_size} operations",
+                status_code=status.HTTP_400_BAD_REQUEST,
+            )
+
+        background = BackgroundTasks()
+        shared = {}
+        responses = await asyncio.gather(
+            *(
+                self.handle_operation(request, data, background, shared, batched=True)
+                for data in batch
+            )
+        )
+
+        bodies = []
+        for response in responses:
+            if response.media_type == "application/json":
+                bodies.append(response.body)
+            else:
+                message = response.body.decode()
+                error = {"data": None, "errors": [{"message": message}]}
+                bodies.append(json.dumps(error).encode())
+        return Response(
+            b"[" + b",".join(bodies) + b"]",
+            media_type="application/json",
+            background=background,
+        )
+
+    async def handle_operation(
+        self,
+        request: Request,
+        data: typing.Any,
+        background: BackgroundTasks,
+        shared: dict,
+        batched: bool = False,
+    ) -> Response:
+        """
+        Execute a single operation of a request
+
+        :param data: parameters of the operation
+        :param background BackgroundTasks: tasks to run after the response
+        :param shared dict: what the operations of the same request share, like
+        the loaders of the documents
+        :param batched bool: if the operation is part of a batch, whose response
+        can't depend on the `If-None-Match` of the request
+        """
+        if not isinstance(data, dict):
+            return PlainTextResponse(
+                "The operation must be an object",
+                status_code=status.HTTP_400_BAD_REQUEST,
+            )
+        document = self.get_document(data)
+        if document is None:
+            return PlainTextResponse(
+                "No GraphQL query found in the request",
+                status_code=status.HTTP_400_BAD_REQUEST,
+            )
+
+        variables = data.get("variables")
+        if isinstance(variables, str):
+            variables = json.loads(variables)
+
+        metrics = get_metrics(request)
+        operation_name = data.get("operationName")
+        cache_key = None
+        if not isinstance(document, ExecutionResult):
+            start = time.perf_counter()
+            try:
+                document = self.backend.document_from_string(self.schema, document)
+            except Exception as e:
+                document = ExecutionResult(errors=[e], invalid=True)
+            else:
+                cache_key = self.get_cache_key(
+                    request, document, operation_name, variables
+                )
+            if metrics is not None:
+                metrics.add_phase("parsing", time.perf_counter() - start)
+                if not isinstance(document, ExecutionResult):
+                    label = operation_label(document, operation_name)
+                    if metrics.operation is not None:
+                        label = metrics.operation + "," + label
+                    metrics.operation = label
+        if cache_key is not None:
+            # catch up with the changes made by other workers before using the
+            # cache, once for all the operations of the request
+            if "caught_up" not in shared:
+                shared["caught_up"] = asyncio.ensure_future(self.catch_up(request))
+            await shared["caught_up"]
+            cached = self.responses.get(cache_key)
+            if cached is not None:
+                return self.cached_response(
+                    request, *cached, background, conditional=not batched
+                )
+            generation = self.responses.generation
+
+        if not isinstance(document, ExecutionResult):
+            rejection = await self.admit(request, document, operation_name, variables)
+            if rejection is not None:
+                return rejection
+
+        # documents loaded by any operation are reused by the others
+        context = {
+            "request": request,
+            "background": background,
+            "loaders": shared.setdefault("loaders", {}),
+        }
+
+        if isinstance(document, ExecutionResult):
+            result = document
+        else:
+            start = time.perf_counter()
+            result = await self.execute(
+                document,
+                variables=variables,
+                context=context,
+                operation_name=operation_name,
+            )
+            seconds = time.perf_counter() - start
+            label = operation_label(document, operation_name)
+            if label not in self.measured_operations:
+                label = "other"
+            OPERATION_SECONDS.observe(seconds, label)
+            if metrics is not None:
+                metrics.add_phase("execution", seconds)
+
+        start = time.perf_counter()
+        error_data = (
+            [format_error(err) for err in result.errors] if result.errors else None
+        )
+        response_data = {"data": result.data, "errors": error_data}
+        status_code = (
+            status.HTTP_400_BAD_REQUEST if result.errors else status.HTTP_200_OK
+        )
+
+        response = JSONResponse(
+            response_data, status_code=status_code, background=background
+        )
+        if metrics is not None:
+            metrics.add_phase("serialization", time.perf_counter() - start)
+        if cache_key is not None and not result.errors and "dependencies" in context:
+            etag = self.responses.set(
+                cache_key, response.body, context["dependencies"], generation
+            )
+            return self.cached_response(
+                request, response.body, etag, background, conditional=not batched
+            )
+        return response
+
+    async def catch_up(self, request: Request) -> None:
+        """
+        Get notified of the changes made to the database by other workers, see
+        `Repository.catch_up`
+        """
+        await request.database.catch_up()
+
+    def get_cache_key(
+        self,
+        request: Request,
+        document: GraphQLDocument,
+        operation_name: typing.Optional[str],
+        variables: typing.Optional[dict],
+    ) -> typing.Optional[tuple]:
+        """
+        Obtain the key of the response to a request in the response cache
+
+        :returns: the key, or `None` if the response can't be cached
+        """
+        if "Authorization" in request.headers:
+            return None
+        if document.get_operation_type(operation_name) != "query":
+            return None
+
+        if not self.subscribe(request.database):
+            return None
+
+        for definition in document.document_ast.definitions:
+            if not isinstance(definition, ast.OperationDefinition):
+                continue
+            if operation_name and getattr(definition.name, "value", None) != (
+                operation_name
+            ):
+                continue
+            for selection in definition.selection_set.selections:
+                if not isinstance(selection, ast.Field):
+                    return None
+                if selection.name.value not in self.cacheable_fields:
+                    return None
+
+        return (
+            query_hash(document.document_string),
+            operation_name,
+            json.dumps(variables, sort_keys=True),
+        )
+
+    def subscribe(self, database: typing.Any) -> bool:
+        """
+        Get notified of the changes made to a database, see `changed`
+
+        :returns: if the database supports change notifications
+        """
+        # requests get a wrapper of the shared database, see `RequestRepository`
+        database = shared_repository(database)
+        if database not in self._subscriptions:
+            subscribe = getattr(database, "subscribe", None)
+            self._subscriptions[database] = bool(subscribe and subscribe(self.changed))
+        return self._subscriptions[database]
+
+    def changed(self, table: typing.Optional[str], doc_ids: typing.Optional[list]):
+        """
+        Forget what depends on the documents that changed, see
+        `ResponseCache.invalidate`
+        """
+        self.responses.invalidate(table, doc_ids)
+        if table is None:
+            self._table_sizes.clear()
+        else:
+            self._table_sizes.pop(table, None)
+
+    def get_client_key(self, request: Request) -> str:
+        """
+        Obtain the key that identifies the client of a request for its cost
+        budget, its token or its address if it's anonymous
+        """
+        authorization = request.headers.get("Authorization")
+        if authorization:
+            return "token:" + hashlib.sha256(authorization.encode()).hexdigest()
+        client = request.client
+        return "address:" + (client.host if client else "")
+
+    async def admit(
+        self,
+        request: Request,
+        document: GraphQLDocument,
+        operation_name: typing.Optional[str],
+        variables: typing.Optional[dict],
+    ) -> typing.Optional[Response]:
+        """
+        Check if an operation can be executed given its estimated cost
+
+        :returns: the response rejecting the operation, or `None` if it's admitted
+        """
+        limits = (self.max_cost, self.max_depth, self.cost_budget)
+        if all(limit is None for limit in limits):
+            return None
+
+        def estimate_cost(table_size: typing.Callable) -> typing.Tuple[int, int]:
+            estimate = None
+            if self.estimate is not None:
+                estimate = partial(self.estimate, table_size=table_size)
+            return operation_cost(
+                self.schema, document.document_ast, operation_name, variables, estimate
+            )
+
+        sizes = dict(self._table_sizes)
+
+        def known_size(table: str) -> int:
+            if table not in sizes:
+                raise _UnknownSize(table)
+            return sizes[table]
+
+        while True:
+            try:
+                cost, depth = estimate_cost(known_size)
+                break
+            except _UnknownSize as e:
+                # count the missing table and estimate again
+                table = e.args[0]
+                async with request.database.session() as session:
+                    sizes[table] = await session.table(table).count()
+                if self.subscribe(request.database):
+                    self._table_sizes[table] = sizes[table]
+
+        message = None
+        if self.max_depth is not None and depth > self.max_depth:
+            message = f"query depth {depth} exceeds the maximum of {self.max_depth}"
+        elif self.max_cost is not None and cost > self.max_cost:
+            message = f"query cost {cost} exceeds the maximum of {self.max_cost}"
+        if message is not None:
+            return JSONResponse(
+                {"data": None, "errors": [{"message": message}]},
+                status_code=status.HTTP_400_BAD_REQUEST,
+            )
+
+        if self.cost_budget is not None:
+            wait = self.cost_budget.spend(self.get_client_key(request), cost)
+            if wait:
+                retry_after = max(math.ceil(wait), 1)
+                message = (
+                    f"query cost budget exhausted, try again in {retry_after} seconds"
+                )
+                return JSONResponse(
+                    {"data": None, "errors": [{"message": message}]},
+                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                    headers={"Retry-After": str(retry_after)},
+                )
+        return None
+
+    def cached_response(
+        self,
+        request: Request,
+        body: bytes,
+        etag: str,
+        background: BackgroundTasks = None,
+        conditional: bool = True,
+    ) -> Response:
+        """
+        Build the response for a cached body, or a `304 Not Modified` if the
+        client already has it
+
+        :param conditional bool: if the `If-None-Match` of the request applies
+        """
+        if not conditional:
+            return Response(
+                body,
+                headers={"ETag": etag},
+                media_type="application/json",
+                background=background,
+            )
+        if_none_match = request.headers.get("If-None-Match", "")
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        if etag in tags or "W/" + etag in tags or "*" in tags:
+            return Response(
+                status_code=status.HTTP_304_NOT_MODIFIED,
+                headers={"ETag": etag},
+                background=background,
+            )
+        return Response(
+            body,
+            headers={"ETag": etag},
+            media_type="application/json",
+            background=background,
+        )
+
+    async def execute(  # type: ignore
+        self, query, variables=None, context=None, operation_name=None
+    ):
+        if self.is_async:
+            return await self.schema.execute(
+                query,
+                variables=variables,
+                operation_name=operation_name,
+                executor=self.executor,
+                return_promise=True,
+                context=context,
+                backend=self.backend,
+                middleware=self.middleware,
+            )
+        return await run_in_threadpool(
+            self.schema.execute,
+            query,
+            variables=variables,
+            operation_name=operation_name,
+            context=context,
+            backend=self.backend,
+            middleware=self.middleware,
+        )
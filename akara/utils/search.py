@@ -0,0 +1,228 @@
+import bisect
+import math
+import re
+import typing
+import unicodedata
+
+from tinydb.database import Document
+
+from .cache import LRUCache
+from .views import ProductView
+
+WORD_PATTERN = re.compile(r"\w+")
+# marks left apart by the decomposition of accented letters
+COMBINING_PATTERN = re.compile("[\u0300-\u036f]")
+
+
+def tokenize(text: str) -> typing.List[str]:
+    """
+    Split a text in the words it's searched by, in lowercase and without accents
+    so "Crème Brûlée" is found by "creme brulee"
+    """
+    text = unicodedata.normalize("NFKD", text.lower())
+    return WORD_PATTERN.findall(COMBINING_PATTERN.sub("", text))
+
+
+class SearchIndex:
+    """
+    Inverted index of short texts, like titles, to search them by their words
+
+    Every word of a query must start a word of the text, so texts are found
+    while the last word is still being typed. Results are ranked by how rare
+    the words of the query are, whole words weight more than prefixes, the more
+    the longer the part left to type, and shorter texts go first since the
+    query is more of them. Ties are sorted by id.
+
+    The results of the last `cache_size` queries are kept until the index
+    changes, so pages after the first one, or popular queries, don't rank all
+    the matches again.
+
+    Example
+    -------
+    ```
+    index = SearchIndex()
+    index.add("1", "Potion of healing")
+    index.search("heal pot")  # ["1"]
+    ```
+
+    :param prefix_weight float: weight of a prefix that is almost the whole word
+    :param cache_size int: maximum number of queries whose results are kept
+    """
+
+    def __init__(self, prefix_weight: float = 0.5, cache_size: int = 256):
+        self.prefix_weight = prefix_weight
+        # word -> ids of the texts that have it
+        self._postings = {}  # type: typing.Dict[str, typing.Set[str]]
+        # id -> words of its text
+        self._documents = {}  # type: typing.Dict[str, typing.Tuple[str, ...]]
+        # all the words, sorted to find the ones that start with a prefix
+        self._vocabulary = []  # type: typing.List[str]
+        self._results = LRUCache(maxsize=cache_size)
+
+    def __len__(self) -> int:
+        return len(self._documents)
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self._documents
+
+    def add(self, doc_id: str, text: str) -> None:
+        """
+        Index the text of a document, replacing the previous one if any
+        """
+        words = tuple(tokenize(text or ""))
+        if self._documents.get(doc_id) == words:
+            return
+        self.remove(doc_id)
+        self._documents[doc_id] = words
+        for word in set(words):
+            postings = self._postings.get(word)
+            if postings is None:
+                postings = self._postings[word] = set()
+                bisect.insort(self._vocabulary, word)
+            postings.add(doc_id)
+        self._results.clear()
+
+    def add_many(self, documents: typing.Iterable[typing.Tuple[str, str]]) -> None:
+        """
+        Index the texts of many documents at once, given as `(id, text)`
+
+        Faster than adding them one by one when there are many new words, like
+        when building the index.
+        """
+        new_words = False
+        for doc_id, text in documents:
+            self.remove(doc_id)
+            words = tuple(tokenize(text or ""))
+            self._documents[doc_id] = words
+            for word in set(words):
+                postings = self._postings.get(word)
+                if postings is None:
+                    postings = self._postings[word] = set()
+                    new_words = True
+                postings.add(doc_id)
+        if new_words:
+            self._vocabulary = sorted(self._postings)
+        self._results.clear()
+
+    def remove(self, doc_id: str) -> None:
+        """
+        Forget a document, if it's indexed
+        """
+        words = self._documents.pop(doc_id, None)
+        if words is None:
+            return
+        for word in set(words):
+            postings = self._postings[word]
+            postings.discard(doc_id)
+            if not postings:
+                del self._postings[word]
+                del self._vocabulary[bisect.bisect_left(self._vocabulary, word)]
+        self._results.clear()
+
+    def _expand(self, term: str) -> typing.Dict[str, float]:
+        """
+        Obtain the words that start with a term and how much each one weights,
+        relative to the term itself
+        """
+        weights = {}
+        vocabulary = self._vocabulary
+        position = bisect.bisect_left(vocabulary, term)
+        while position < len(vocabulary) and vocabulary[position].startswith(term):
+            word = vocabulary[position]
+            position += 1
+            if word == term:
+                weights[word] = 1.0
+            else:
+                weights[word] = self.prefix_weight * len(term) / len(word)
+        return weights
+
+    def search(self, query: str) -> typing.List[str]:
+        """
+        Find the documents that match a query
+
+        :returns: the ids of the documents, the most relevant first
+        """
+        terms = tuple(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return []
+        results = self._results.get(terms)
+        if results is not None:
+            return results
+
+        total = len(self._documents)
+        expansions, matches = [], []
+        for term in terms:
+            weights = self._expand(term)
+            postings = [self._postings[word] for word in weights]
+            if not postings:
+                self._results.set(terms, [])
+                return []
+            match = postings[0].union(*postings[1:])
+            # terms that match fewer texts tell more about them
+            rarity = math.log(1 + total / len(match))
+            expansions.append(
+                {word: weight * rarity for word, weight in weights.items()}
+            )
+            matches.append(match)
+        # intersect starting with the fewest matches
+        matches.sort(key=len)
+        candidates = matches[0].intersection(*matches[1:])
+
+        scores = dict.fromkeys(candidates, 0.0)
+        for weights in expansions:
+            # each term counts once per text, by the best word it matches
+            best = {}
+            for word in sorted(weights, key=weights.get, reverse=True):
+                weight = weights[word]
+                for doc_id in self._postings[word]:
+                    if doc_id in scores and doc_id not in best:
+                        best[doc_id] = weight
+            for doc_id, weight in best.items():
+                scores[doc_id] += weight
+        documents = self._documents
+        for doc_id in scores:
+            scores[doc_id] /= math.sqrt(len(documents[doc_id]))
+        results = sorted(scores, key=lambda doc_id: (-scores[doc_id], doc_id))
+        self._results.set(terms, results)
+        return results
+
+
+class ProductSearch(ProductView):
+    """
+    Search of products by title, with a `SearchIndex` per repository kept up to
+    date with its changes (see `ProductView`)
+
+    :param cache_size int: maximum number of queries whose results are kept
+    """
+
+    fields = ["title"]
+
+    def __init__(self, cache_size: int = 256):
+        super().__init__()
+        self.cache_size = cache_size
+
+    def build(self, documents: typing.List[Document]) -> SearchIndex:
+        index = SearchIndex(cache_size=self.cache_size)
+        index.add_many(
+            (document.doc_id, document.get("title")) for document in documents
+        )
+        return index
+
+    def update(
+        self, index: SearchIndex, changes: typing.Dict[str, typing.Optional[Document]]
+    ) -> None:
+        for doc_id, document in changes.items():
+            if document is None:
+                index.remove(doc_id)
+            else:
+                index.add(doc_id, document.get("title"))
+
+    async def search(self, database: typing.Any, query: str) -> typing.List[str]:
+        """
+        Find the products whose title matches a query, see `SearchIndex.search`
+
+        :param database Repository: repository of the products
+        :returns: the ids of the products, the most relevant first
+        """
+        index = await self.prepare(database)
+        return index.search(query)
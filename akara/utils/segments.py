@@ -0,0 +1,235 @@
+import mmap
+import os
+import struct
+import sys
+import typing
+from collections.abc import MutableMapping
+
+from tinydb.storages import json
+
+from .storage import WriteAheadLogStorage
+
+# file layout:
+#   header     MAGIC, offset of the directory
+#   segments   for every table, its documents as json one after the other,
+#              followed by its index, an entry per document with the length of
+#              its id, its offset and length in the file, and then the id
+#   directory  json object with the offset, length and size of every index
+MAGIC = b"AKARASG1"
+HEADER = struct.Struct("<8sQ")
+ENTRY = struct.Struct("<HQI")
+
+
+class SegmentTable(MutableMapping):
+    """
+    Documents of a table stored in a segment file
+
+    Documents are decoded from the memory-mapped file every time they're
+    accessed, so reading one only touches its own bytes, and changes are kept
+    apart in memory. The index of the segment is only decoded when the table is
+    first used.
+
+    :param buffer mmap: contents of the segment file
+    :param offset int: position of the index of the table in the file
+    :param length int: size in bytes of the index
+    """
+
+    def __init__(self, buffer: mmap.mmap, offset: int, length: int):
+        self.buffer = buffer
+        self.offset = offset
+        self.length = length
+        self._entries = None
+        # documents added or replaced, and ids of the removed ones
+        self._changed = {}
+        self._deleted = set()
+
+    @property
+    def entries(self) -> typing.Dict[str, typing.Tuple[int, int]]:
+        """
+        Position and size of every document stored in the file, by id
+        """
+        if self._entries is None:
+            entries = {}
+            position, end = self.offset, self.offset + self.length
+            while position < end:
+                id_length, offset, length = ENTRY.unpack_from(self.buffer, position)
+                position += ENTRY.size
+                doc_id = self.buffer[position : position + id_length].decode()
+                position += id_length
+                entries[doc_id] = (offset, length)
+            self._entries = entries
+        return self._entries
+
+    def copy(self) -> "SegmentTable":
+        """
+        Copy the table, sharing the file but not the changes
+        """
+        table = SegmentTable(self.buffer, self.offset, self.length)
+        table._entries = self._entries
+        table._changed = dict(self._changed)
+        table._deleted = set(self._deleted)
+        return table
+
+    def raw(self, doc_id: str) -> typing.Optional[bytes]:
+        """
+        Obtain the encoded document as stored in the file, `None` if it changed
+        """
+        if doc_id in self._changed or doc_id in self._deleted:
+            return None
+        offset, length = self.entries[doc_id]
+        return self.buffer[offset : offset + length]
+
+    def __getitem__(self, doc_id: str) -> dict:
+        if doc_id in self._changed:
+            return self._changed[doc_id]
+        if doc_id in self._deleted:
+            raise KeyError(doc_id)
+        offset, length = self.entries[doc_id]
+        return json.loads(self.buffer[offset : offset + length])
+
+    def __setitem__(self, doc_id: str, document: dict) -> None:
+        self._deleted.discard(doc_id)
+        self._changed[doc_id] = document
+
+    def __delitem__(self, doc_id: str) -> None:
+        if doc_id not in self:
+            raise KeyError(doc_id)
+        self._changed.pop(doc_id, None)
+        if doc_id in self.entries:
+            self._deleted.add(doc_id)
+
+    def __contains__(self, doc_id: str) -> bool:
+        if doc_id in self._changed:
+            return True
+        return doc_id in self.entries and doc_id not in self._deleted
+
+    def __iter__(self) -> typing.Iterator[str]:
+        for doc_id in self.entries:
+            if doc_id not in self._deleted:
+                yield doc_id
+        for doc_id in self._changed:
+            if doc_id not in self.entries:
+                yield doc_id
+
+    def __len__(self) -> int:
+        added = sum(1 for doc_id in self._changed if doc_id not in self.entries)
+        return len(self.entries) - len(self._deleted) + added
+
+
+def read_segments(path: str) -> typing.Dict[str, SegmentTable]:
+    """
+    Open a segment file, without decoding any document
+
+    :returns: the tables in the file, empty if the file doesn't exist or is empty
+    """
+    try:
+        with open(path, "rb") as segments:
+            if os.fstat(segments.fileno()).st_size == 0:
+                return {}
+            # the mapping stays valid after closing the file, and after the file
+            # is replaced by a new one
+            buffer = mmap.mmap(segments.fileno(), 0, access=mmap.ACCESS_READ)
+    except FileNotFoundError:
+        return {}
+
+    magic, directory = HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a segment file")
+    return {
+        name: SegmentTable(buffer, offset, length)
+        for name, (offset, length) in json.loads(buffer[directory:]).items()
+    }
+
+
+def write_segments(file: typing.BinaryIO, tables: typing.Mapping) -> None:
+    """
+    Write tables in the segment format
+
+    Documents of tables read from a segment file are copied without decoding
+    them, if they didn't change.
+
+    :param file: binary file to write to, at its beginning
+    :param tables: documents of every table, by table name and id
+    """
+    file.write(HEADER.pack(MAGIC, 0))
+    position = HEADER.size
+    directory = {}
+    for name, documents in tables.items():
+        index = []
+        for doc_id, document in documents.items():
+            raw = None
+            if isinstance(documents, SegmentTable):
+                raw = documents.raw(doc_id)
+            if raw is None:
+                raw = json.dumps(document).encode()
+            file.write(raw)
+            encoded_id = doc_id.encode()
+            index.append(ENTRY.pack(len(encoded_id), position, len(raw)) + encoded_id)
+            position += len(raw)
+
+        index = b"".join(index)
+        file.write(index)
+        directory[name] = (position, len(index))
+        position += len(index)
+
+    file.write(json.dumps(directory).encode())
+    file.seek(0)
+    file.write(HEADER.pack(MAGIC, position))
+
+
+class SegmentStorage(WriteAheadLogStorage):
+    """
+    `WriteAheadLogStorage` whose snapshot is a segment file instead of json
+
+    Every table is stored in its own segment along with an index of the
+    position of its documents. The file is memory-mapped and documents are
+    decoded when they're accessed, so opening the database doesn't depend on
+    the size of the data and getting a document by id only reads that
+    document. Changes are kept in the log and in memory, as usual, until they're
+    compacted into a new segment file.
+
+    Use `convert` to create a segment file from a TinyDB json database.
+    """
+
+    def _read_snapshot(self) -> dict:
+        return read_segments(self.path)
+
+    def _dump_snapshot(self, file: typing.BinaryIO, tables: dict) -> None:
+        write_segments(file, tables)
+
+    def _copy_tables(self) -> dict:
+        return {
+            name: (
+                documents.copy()
+                if isinstance(documents, SegmentTable)
+                else dict(documents)
+            )
+            for name, documents in self._tables.items()
+        }
+
+    def _snapshot_written(self, stamp: tuple) -> None:
+        super()._snapshot_written(stamp)
+        # the changes kept in memory are in the new file now
+        self._tables = self._read_snapshot()
+
+
+def convert(source: str, destination: str) -> None:
+    """
+    Create a segment file from a TinyDB json database, including the changes
+    in its log if it has one
+
+    :param source str: path of the json database
+    :param destination str: path of the segment file to create
+    """
+    storage = WriteAheadLogStorage(source)
+    storage.refresh()
+    temporary = destination + ".tmp"
+    with open(temporary, "wb") as file:
+        write_segments(file, storage.read())
+    os.replace(temporary, destination)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit("usage: python -m akara.utils.segments <database.json> <output>")
+    convert(sys.argv[1], sys.argv[2])
@@ -0,0 +1,44 @@
+import typing
+
+from graphql.language import ast
+
+
+def _fields(
+    selection_sets: typing.Iterable[typing.Optional[ast.SelectionSet]],
+    fragments: typing.Dict[str, ast.FragmentDefinition],
+) -> typing.Iterator[ast.Field]:
+    for selection_set in selection_sets:
+        if selection_set is None:
+            continue
+        for selection in selection_set.selections:
+            if isinstance(selection, ast.Field):
+                yield selection
+            elif isinstance(selection, ast.InlineFragment):
+                yield from _fields([selection.selection_set], fragments)
+            elif isinstance(selection, ast.FragmentSpread):
+                fragment = fragments.get(selection.name.value)
+                if fragment is not None:
+                    yield from _fields([fragment.selection_set], fragments)
+
+
+def selected_fields(info: typing.Any, *path: str) -> typing.Set[str]:
+    """
+    Obtain the names of the fields selected on the result of the field being
+    resolved, wherever they are selected: directly, under any alias or in
+    fragments
+
+    Directives are not evaluated, so fields that are skipped are included too.
+
+    :param info ResolveInfo: info of the resolver
+    :param path: names of the fields to go through to reach the selection, e.g.
+    `("edges", "node")` for the nodes of a connection
+    """
+    fragments = info.fragments or {}
+    selection_sets = [field.selection_set for field in info.field_asts]
+    for name in path:
+        selection_sets = [
+            field.selection_set
+            for field in _fields(selection_sets, fragments)
+            if field.name.value == name
+        ]
+    return {field.name.value for field in _fields(selection_sets, fragments)}
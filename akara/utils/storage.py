@@ -0,0 +1,996 @@
+import asyncio
+import os
+import typing
+from collections.abc import MutableMapping
+
+try:
+    import fcntl
+except ImportError:  # pragma: nocover
+    fcntl = None
+
+from aiotinydb.storage import AIOStorage
+from tinydb.database import Document
+from tinydb.storages import json
+
+# version expected of documents that must not exist when committing
+_ABSENT = object()
+
+
+def _stamp(path: str) -> typing.Optional[typing.Tuple[int, int, int]]:
+    """
+    Identify the current version of a file without reading it
+
+    :param path str: path of the file
+    :returns: a tuple with the inode, size and modification time of the file, or
+    `None` if it doesn't exist
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def _encode(records: typing.List[tuple]) -> bytes:
+    return b"".join(json.dumps(record).encode() + b"\n" for record in records)
+
+
+class ConflictError(Exception):
+    """
+    Raised when a session tries to commit changes to documents that were changed
+    by someone else after the session read them
+    """
+
+
+class TableView(MutableMapping):
+    """
+    Copy-on-read view over the documents of a single table
+
+    TinyDB tables read all the documents, modify them and write them back as a
+    whole. This view hands out copies of the documents only when they are
+    accessed and keeps track of the changes, so the storage only has to persist
+    the documents that were actually touched.
+
+    Every document handed out has a `version` attribute, with the version it had
+    when it was read, which the storage checks before writing it back.
+
+    :param documents dict: documents of the table, by id
+    :param version callable: function that returns the version of a document
+    given its id
+    """
+
+    def __init__(self, documents: dict, version: typing.Callable = None):
+        self.documents = documents
+        self.version = version
+        # documents copied from the table, to measure how much of it is scanned
+        self.reads = 0
+        self.loaded = {}
+        # versions of the removed documents, by id
+        self.removed = {}
+
+    def __getitem__(self, doc_id: str) -> Document:
+        if doc_id in self.loaded:
+            return self.loaded[doc_id]
+        if doc_id in self.removed:
+            raise KeyError(doc_id)
+
+        document = Document(self.documents[doc_id], doc_id)
+        self.reads += 1
+        if self.version is not None:
+            document.version = self.version(doc_id)
+        self.loaded[doc_id] = document
+        return document
+
+    def __setitem__(self, doc_id: str, document: dict) -> None:
+        self.removed.pop(doc_id, None)
+        self.loaded[doc_id] = document
+
+    def __delitem__(self, doc_id: str) -> None:
+        if doc_id not in self:
+            raise KeyError(doc_id)
+        document = self.loaded.pop(doc_id, None)
+        if doc_id in self.documents:
+            self.removed[doc_id] = getattr(document, "version", None)
+
+    def __contains__(self, doc_id: str) -> bool:
+        if doc_id in self.loaded:
+            return True
+        return doc_id in self.documents and doc_id not in self.removed
+
+    def __iter__(self) -> typing.Iterator[str]:
+        for doc_id in self.documents:
+            if doc_id not in self.removed:
+                yield doc_id
+        for doc_id in self.loaded:
+            if doc_id not in self.documents:
+                yield doc_id
+
+    def __len__(self) -> int:
+        added = sum(1 for doc_id in self.loaded if doc_id not in self.documents)
+        return len(self.documents) - len(self.removed) + added
+
+
+class TableStorage(AIOStorage):
+    """
+    Base class for storages that keep the database in memory and serve it one
+    table at a time
+
+    Instances are meant to be shared by every session of an `AIOTinyDB`, so the
+    instance itself is passed as the storage factory, and calling it starts a
+    session:
+
+    ```
+    database = AIOTinyDB(storage=WriteAheadLogStorage("data/data.json"))
+    ```
+    """
+
+    def __call__(self) -> "TableStorage":
+        return self
+
+    @property
+    def documents_read(self) -> int:
+        """
+        Number of documents read in the session
+        """
+        return 0
+
+    def read_table(self, name: str) -> TableView:
+        raise NotImplementedError()
+
+    def write_table(self, name: str, data: typing.Mapping) -> None:
+        raise NotImplementedError()
+
+    def ensure_index(self, name: str, field: str, index_class: type) -> typing.Any:
+        """
+        Obtain the index of a field, creating it if it doesn't exist yet
+
+        :param name str: name of the table
+        :param field str: name of the indexed field
+        :param index_class type: class of the index, e.g. `HashIndex`
+        :returns: the index, which is kept up to date by the storage, or `None` if
+        the storage doesn't support indexes
+        """
+        return None
+
+    def subscribe(self, callback: typing.Callable) -> bool:
+        """
+        Register a function to be called whenever documents change, including
+        changes made by other processes as soon as they're noticed
+
+        The function receives the name of the table and the ids of the changed
+        documents, in the order they changed, or `None` if the whole table may
+        have changed. Both are `None` when the whole database may have changed.
+
+        :returns: if the storage supports change notifications
+        """
+        return False
+
+
+class WriteAheadLogStorage(TableStorage):
+    """
+    Storage that keeps all the tables in memory for the life of the process and
+    persists changes incrementally
+
+    The database is made of a snapshot, a regular TinyDB json file, and an
+    append-only log next to it (`<path>.wal`) with one record per changed
+    document. The log is replayed over the snapshot when loading, and once it
+    grows past `compact_threshold` records it is folded into a new snapshot.
+
+    Every session checks whether the files were changed by someone else: new
+    records appended to the log are replayed, and if the snapshot was rewritten
+    (e.g. by a plain `TinyDB`) the whole database is reloaded and the records in
+    the log, which belong to the previous snapshot, are discarded. The size of
+    the log and the identity of the snapshot act as version stamps, so checking
+    for changes made by other workers costs two `stat` calls.
+
+    Each session is a transaction (see `Transaction`), which keeps what it read
+    and wrote, so sessions can overlap. Its changes are visible to every session
+    right away, from the moment it makes them until they're committed, or
+    undone if it ends with an error or fails to commit. Only one open session
+    at a time can make changes.
+
+    Several processes can share the same files, using optimistic concurrency:
+    every document has a version, which changes with every record that touches
+    it, and committing a session checks that the documents it writes still
+    have the version they had when they were read. Otherwise the whole session
+    is undone and `ConflictError` is raised, so it can be retried. Only the
+    commit itself takes an exclusive lock on `<path>.lock`, to catch up with
+    the records of other workers, check the versions and append the new
+    records, so sessions touching different documents never wait for each
+    other. Records of other workers are applied before the changes not
+    committed yet, which are applied again on top of them (see `_rebase`), so
+    every process applies the records in the order of the log.
+
+    Used asynchronously, reading and decoding the files, encoding the records
+    and writing them run in the default executor of the event loop, so the loop
+    is never blocked by file I/O. Sessions that end while a commit is being
+    written are committed together in the next one (a group commit), with a
+    single write and `fsync` of the log for all of them.
+
+    :param path str: path of the snapshot file
+    :param compact_threshold int: number of records in the log that triggers a
+    compaction
+    :param fsync bool: wait for the data to reach the disk on every commit
+    """
+
+    def __init__(self, path: str, compact_threshold: int = 1000, fsync: bool = True):
+        self.path = path
+        self.log_path = path + ".wal"
+        self.lock_path = path + ".lock"
+        self.compact_threshold = compact_threshold
+        self.fsync = fsync
+
+        self._tables = None
+        self._indexes = {}
+        self._records = 0
+        self._snapshot_stamp = None
+        self._log_inode = None
+        self._log_offset = 0
+        # the log can only be appended to when its header matches the snapshot
+        self._log_valid = False
+        self._lock_fd = None
+        self._lock_pid = None
+        self._listeners = []
+
+        # versions are the number of the last record that touched each document,
+        # counting from the load of the snapshot, which makes them equal in every
+        # process that applies the same records
+        self._sequence = 0
+        self._versions = {}
+
+        # sessions whose changes are in the tables but not committed yet, in the
+        # order they made them, only the last one can still be open
+        self._sessions = []  # type: typing.List[Transaction]
+
+        # refresh in progress, shared by the sessions that start meanwhile
+        self._refreshing = None
+        # sessions waiting to be committed, as (session, future), and the task
+        # that commits them
+        self._queue = []
+        self._flusher = None
+        # while a commit is written the tables are ahead of the files
+        self._flushing = False
+
+    def __call__(self) -> "Transaction":
+        return Transaction(self)
+
+    async def __aenter__(self) -> "WriteAheadLogStorage":
+        """
+        Bring the tables up to date with the files, as sessions do when they start
+        """
+        # while a commit is written the files are behind the tables, and the
+        # commit itself catches up with the records of other workers
+        if not self._flushing:
+            if self._refreshing is None or self._refreshing.done():
+                self._refreshing = asyncio.ensure_future(self._refresh_async())
+            await asyncio.shield(self._refreshing)
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback) -> None:
+        # sessions commit by themselves, see `Transaction`
+        pass
+
+    async def _enqueue(self, session: "Transaction") -> None:
+        """
+        Commit the changes of a session along with the ones of the sessions that
+        end meanwhile (see `_commit_group`)
+
+        :raises ConflictError: if the session can't be committed, in which case
+        its changes are undone
+        """
+        future = asyncio.get_event_loop().create_future()
+        self._queue.append((session, future))
+        if self._flusher is None:
+            self._flusher = asyncio.ensure_future(self._flush())
+        await future
+
+    def _lock(self) -> None:
+        if fcntl is None:
+            return
+        if self._lock_pid != os.getpid():
+            # locks belong to the open file, which is shared with forked processes,
+            # so each process needs to open the file by itself
+            dirname = os.path.dirname(self.lock_path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            self._lock_fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT)
+            self._lock_pid = os.getpid()
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+
+    def _unlock(self) -> None:
+        if fcntl is not None and self._lock_fd is not None:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def _changes(self) -> typing.Optional[str]:
+        """
+        Check if the files changed since they were last read
+
+        :returns: "load" if the whole database must be loaded again, "replay" if
+        there are new records in the log, or `None`
+        """
+        if self._tables is None or _stamp(self.path) != self._snapshot_stamp:
+            return "load"
+
+        try:
+            stat = os.stat(self.log_path)
+        except FileNotFoundError:
+            return "load" if self._log_inode is not None else None
+
+        if stat.st_ino != self._log_inode or stat.st_size < self._log_offset:
+            return "load"
+        if stat.st_size > self._log_offset:
+            return "replay"
+        return None
+
+    def refresh(self) -> None:
+        """
+        Bring the in-memory tables up to date with the files on disk
+        """
+        changes = self._changes()
+        if changes == "load":
+            data = self._read_all()
+        elif changes == "replay":
+            data = self._read_log(self._log_inode, self._log_offset)
+        else:
+            return
+        self._rebase(lambda: self._apply_changes(changes, data))
+
+    async def _read_changes(self) -> typing.Tuple[typing.Optional[str], typing.Any]:
+        """
+        Read what changed in the files in the executor, without changing the
+        storage
+
+        :returns: what `_changes` found and what was read, to `_apply_changes`
+        """
+        loop = asyncio.get_event_loop()
+        changes = self._changes()
+        if changes == "load":
+            return changes, await loop.run_in_executor(None, self._read_all)
+        if changes == "replay":
+            return changes, await loop.run_in_executor(
+                None, self._read_log, self._log_inode, self._log_offset
+            )
+        return None, None
+
+    def _apply_changes(self, changes: typing.Optional[str], data: typing.Any) -> None:
+        if changes == "load":
+            self._load(*data)
+        elif changes == "replay":
+            self._replay(data)
+
+    async def _refresh_async(self) -> None:
+        """
+        Same as `refresh` but reading the files in the executor
+        """
+        changes, data = await self._read_changes()
+        if changes is not None:
+            self._rebase(lambda: self._apply_changes(changes, data))
+
+    def _rebase(
+        self, change: typing.Callable, done: typing.Sequence["Transaction"] = ()
+    ) -> typing.Any:
+        """
+        Make a change under the changes of the sessions that aren't committed
+        yet, which are undone before it and applied again after it
+
+        :param change: function that changes the tables
+        :param done: sessions whose changes are not applied again, because the
+        change commits them or discards them
+        :returns: what the change returns
+        """
+        sessions = self._sessions
+        for session in reversed(sessions):
+            session.undo_changes()
+        try:
+            return change()
+        finally:
+            self._sessions = [session for session in sessions if session not in done]
+            for session in self._sessions:
+                session.redo_changes()
+
+    def _read_snapshot(self) -> dict:
+        """
+        Read the tables stored in the snapshot
+        """
+        try:
+            with open(self.path, "rb") as snapshot:
+                payload = snapshot.read()
+        except FileNotFoundError:
+            return {}
+        return json.loads(payload) if payload.strip() else {}
+
+    def _dump_snapshot(self, file: typing.BinaryIO, tables: dict) -> None:
+        """
+        Write the tables as a snapshot
+        """
+        file.write(json.dumps(tables).encode())
+
+    def _read_all(self) -> tuple:
+        """
+        Read and decode the snapshot and the log, without changing the storage
+        """
+        stamp = _stamp(self.path)
+        return stamp, self._read_snapshot(), self._read_log(None, 0)
+
+    def _read_log(self, inode: typing.Optional[int], offset: int) -> tuple:
+        """
+        Read and decode the records of the log after an offset, without changing
+        the storage
+
+        :param inode int: inode of the log the offset refers to, if the log is
+        another file now it's read from the start
+        :returns: the inode of the log, the offset where the records start, the
+        records and their size, or `None` if there is no log
+        """
+        try:
+            with open(self.log_path, "rb") as log:
+                current_inode = os.fstat(log.fileno()).st_ino
+                if current_inode != inode:
+                    offset = 0
+                log.seek(offset)
+                payload = log.read()
+        except FileNotFoundError:
+            return None
+
+        # a trailing line without a newline is a partially written record
+        complete = payload.rfind(b"\n") + 1
+        records = [json.loads(line) for line in payload[:complete].splitlines()]
+        return current_inode, offset, records, complete
+
+    def _load(self, stamp: tuple, tables: dict, log: typing.Optional[tuple]) -> None:
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self._snapshot_stamp = stamp
+        self._tables = tables
+        for name in self._indexes:
+            self._build_indexes(name)
+        self._sequence = 0
+        self._versions = {}
+        self._records = 0
+        self._log_inode = None
+        self._log_offset = 0
+        self._log_valid = False
+        self._replay(log)
+        for listener in self._listeners:
+            listener(None, None)
+
+    def _replay(self, log: typing.Optional[tuple]) -> None:
+        if log is None:
+            return
+
+        self._log_inode, offset, records, size = log
+        applied = []
+        for record in records:
+            if record[0] == "snapshot":
+                self._log_valid = list(record[1]) == list(self._snapshot_stamp or ())
+            elif self._log_valid:
+                self._apply(record)
+                self._records += 1
+                applied.append(record)
+        self._log_offset = offset + size
+        self._notify(applied)
+
+    def _apply(self, record: typing.Sequence) -> None:
+        operation, name = record[0], record[1]
+        self._sequence += 1
+        if operation == "put":
+            documents = self._tables.setdefault(name, {})
+            doc_id, document = record[2], record[3]
+            for index in self._indexes.get(name, {}).values():
+                index.update(doc_id, documents.get(doc_id), document)
+            documents[doc_id] = document
+            self._versions.setdefault(name, {})[doc_id] = self._sequence
+        elif operation == "delete":
+            doc_id = record[2]
+            document = self._tables.get(name, {}).pop(doc_id, None)
+            if document is not None:
+                for index in self._indexes.get(name, {}).values():
+                    index.update(doc_id, document, None)
+            self._versions.get(name, {}).pop(doc_id, None)
+        elif operation == "clear":
+            self._tables[name] = {}
+            self._versions[name] = {}
+            self._build_indexes(name)
+        elif operation == "drop":
+            self._tables.pop(name, None)
+            self._versions.pop(name, None)
+            self._build_indexes(name)
+
+    def _build_indexes(self, name: str) -> None:
+        documents = self._tables.get(name, {})
+        for index in self._indexes.get(name, {}).values():
+            index.build(documents)
+
+    def ensure_index(self, name: str, field: str, index_class: type) -> typing.Any:
+        indexes = self._indexes.setdefault(name, {})
+        if field not in indexes:
+            index = index_class(field)
+            index.build(self._tables.get(name, {}))
+            indexes[field] = index
+        return indexes[field]
+
+    def version(self, name: str, doc_id: str) -> typing.Optional[tuple]:
+        """
+        Obtain the current version of a document
+
+        :returns: the version, or `None` if the document doesn't exist
+        """
+        if doc_id not in self._tables.get(name, {}):
+            return None
+        return (self._snapshot_stamp, self._versions.get(name, {}).get(doc_id, 0))
+
+    def _check(self, expected: dict) -> None:
+        for (name, doc_id), version in expected.items():
+            if self.version(name, doc_id) != version:
+                raise ConflictError(
+                    f"document {doc_id} of table {name} was modified concurrently"
+                )
+
+    def _commit(self, records: typing.List[tuple], expected: dict) -> None:
+        """
+        Same as `_enqueue` but committing the records right away, without an
+        event loop
+        """
+        self._lock()
+        try:
+            self.refresh()
+            self._check(expected)
+            if self._snapshot_stamp is None:
+                # the log header needs a snapshot to refer to
+                self._rebase(self._write_snapshot)
+
+            def commit() -> None:
+                for record in records:
+                    self._apply(record)
+
+            self._rebase(commit)
+            self._append(records)
+        finally:
+            self._unlock()
+        self._notify(records)
+
+    async def _flush(self) -> None:
+        """
+        Commit the queued sessions, in groups, until there are none left
+        """
+        try:
+            while self._queue:
+                # the files can't be read while the tables are ahead of them
+                while self._refreshing is not None and not self._refreshing.done():
+                    await asyncio.shield(self._refreshing)
+                group, self._queue = self._queue, []
+                self._flushing = True
+                try:
+                    await self._commit_group(group)
+                finally:
+                    self._flushing = False
+        finally:
+            self._flusher = None
+
+    async def _commit_group(self, group: list) -> None:
+        """
+        Same as `commit` but for several sessions at once, with the file I/O in
+        the executor
+
+        Each session is checked after applying the ones before it, so sessions
+        writing the same documents conflict with each other as if they were
+        committed one by one.
+
+        :param group list: every session and the future to resolve when it's
+        done
+        """
+        loop = asyncio.get_event_loop()
+        sessions = [session for session, _ in group]
+        records, committed = [], []
+
+        def commit() -> None:
+            # the sessions are undone by `_rebase`, and applied as committed here
+            for session, future in group:
+                try:
+                    self._check(session.expected)
+                except ConflictError as error:
+                    if not future.done():
+                        future.set_exception(error)
+                    continue
+                for record in session.pending:
+                    self._apply(record)
+                records.extend(session.pending)
+                committed.append(future)
+
+        try:
+            await loop.run_in_executor(None, self._lock)
+            try:
+                changes, data = await self._read_changes()
+                self._rebase(lambda: self._apply_changes(changes, data))
+                if self._snapshot_stamp is None:
+                    await self._write_snapshot_async()
+                self._rebase(commit, done=sessions)
+                if records:
+                    await self._append_async(records)
+            finally:
+                self._unlock()
+        except Exception as error:
+            # the tables may have changes that didn't reach the files
+            self._rebase(lambda: self._load(*self._read_all()), done=sessions)
+            for _, future in group:
+                if not future.done():
+                    future.set_exception(error)
+            return
+
+        for future in committed:
+            if not future.done():
+                future.set_result(None)
+        self._notify(records)
+
+    def subscribe(self, callback: typing.Callable) -> bool:
+        self._listeners.append(callback)
+        return True
+
+    def _notify(self, records: typing.List[tuple]) -> None:
+        if not self._listeners or not records:
+            return
+
+        # ids of the changed documents by table, in the order they changed, or
+        # None when it's the whole table
+        changes = {}
+        for record in records:
+            operation, name = record[0], record[1]
+            if operation in ("put", "delete"):
+                if changes.get(name, {}) is not None:
+                    changes.setdefault(name, {})[record[2]] = None
+            else:
+                changes[name] = None
+
+        for listener in self._listeners:
+            for name, doc_ids in changes.items():
+                listener(name, None if doc_ids is None else list(doc_ids))
+
+    def _write_log(self, payload: bytes) -> None:
+        fd = os.open(self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(fd, payload)
+            if self.fsync:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _write_new_log(self, stamp: tuple, payload: bytes) -> typing.Tuple[int, int]:
+        """
+        Start a log for a snapshot with the given records
+
+        :returns: the inode and the size of the log
+        """
+        header = json.dumps(["snapshot", stamp]).encode() + b"\n"
+        temporary = self.log_path + ".tmp"
+        with open(temporary, "wb") as log:
+            log.write(header + payload)
+            if self.fsync:
+                log.flush()
+                os.fsync(log.fileno())
+        os.replace(temporary, self.log_path)
+        return os.stat(self.log_path).st_ino, len(header) + len(payload)
+
+    def _log_started(self, log: typing.Tuple[int, int]) -> None:
+        self._log_inode, self._log_offset = log
+        self._log_valid = True
+
+    def _append(self, records: typing.List[tuple]) -> None:
+        payload = _encode(records)
+        if not self._log_valid:
+            self._log_started(self._write_new_log(self._snapshot_stamp, payload))
+        else:
+            self._write_log(payload)
+            self._log_offset += len(payload)
+
+        self._records += len(records)
+        # the snapshot can't have changes not committed
+        if self._records >= self.compact_threshold and not self._sessions:
+            self.compact()
+
+    async def _append_async(self, records: typing.List[tuple]) -> None:
+        loop = asyncio.get_event_loop()
+        payload = await loop.run_in_executor(None, _encode, records)
+        if not self._log_valid:
+            self._log_started(
+                await loop.run_in_executor(
+                    None, self._write_new_log, self._snapshot_stamp, payload
+                )
+            )
+        else:
+            await loop.run_in_executor(None, self._write_log, payload)
+            self._log_offset += len(payload)
+
+        self._records += len(records)
+        if self._records >= self.compact_threshold and not self._sessions:
+            await self._compact_async()
+
+    def _copy_tables(self) -> dict:
+        """
+        Copy the tables, so they can be written while sessions change them
+        """
+        return {name: dict(documents) for name, documents in self._tables.items()}
+
+    def _write_snapshot_file(self, tables: dict) -> typing.Optional[tuple]:
+        """
+        Write the tables as the new snapshot
+
+        :returns: the stamp of the snapshot
+        """
+        temporary = self.path + ".tmp"
+        with open(temporary, "wb") as snapshot:
+            self._dump_snapshot(snapshot, tables)
+            if self.fsync:
+                snapshot.flush()
+                os.fsync(snapshot.fileno())
+        os.replace(temporary, self.path)
+        return _stamp(self.path)
+
+    def _snapshot_written(self, stamp: tuple) -> None:
+        self._snapshot_stamp = stamp
+
+    def _write_snapshot(self) -> None:
+        self._snapshot_written(self._write_snapshot_file(self._tables))
+
+    async def _write_snapshot_async(self) -> None:
+        """
+        Write the tables as the new snapshot, without the changes not committed
+        """
+        loop = asyncio.get_event_loop()
+        tables = self._rebase(self._copy_tables)
+        stamp = await loop.run_in_executor(None, self._write_snapshot_file, tables)
+        self._rebase(lambda: self._snapshot_written(stamp))
+
+    def compact(self) -> None:
+        """
+        Write the whole database as a new snapshot and start an empty log
+        """
+        self._write_snapshot()
+        self._log_started(self._write_new_log(self._snapshot_stamp, b""))
+        self._compacted()
+
+    async def _compact_async(self) -> None:
+        loop = asyncio.get_event_loop()
+        await self._write_snapshot_async()
+        self._log_started(
+            await loop.run_in_executor(
+                None, self._write_new_log, self._snapshot_stamp, b""
+            )
+        )
+        # sessions that started meanwhile get the versions of the new snapshot
+        self._rebase(self._compacted)
+
+    def _compacted(self) -> None:
+        self._records = 0
+        self._sequence = 0
+        self._versions = {}
+
+    def read(self) -> dict:
+        return {name: dict(documents) for name, documents in self._tables.items()}
+
+    def write(self, data: dict) -> None:
+        raise TypeError("the tables are written through sessions, see `Transaction`")
+
+
+class Transaction(TableStorage):
+    """
+    Session of a `WriteAheadLogStorage`, started by calling the storage
+
+    Keeps what the session read and the changes it made, which are applied to
+    the tables of the storage right away, so every session sees them, and stay
+    there until they're committed, or undone if the session fails. Sessions
+    that overlap don't mix them up: only one open session at a time can make
+    changes, any other that tries to write meanwhile fails with
+    `ConflictError`, like it would if it committed after the first. Once the
+    session ends, the next one can make changes on top of the ones it's
+    committing.
+
+    :param storage WriteAheadLogStorage: storage of the session
+    """
+
+    def __init__(self, storage: WriteAheadLogStorage):
+        self.storage = storage
+        # records of the session, what's needed to undo them, the versions the
+        # documents it writes must still have when it commits and the documents
+        # it wrote
+        self.pending = []  # type: typing.List[tuple]
+        self.undo = []  # type: typing.List[tuple]
+        self.expected = {}  # type: typing.Dict[tuple, typing.Any]
+        self.written = set()  # type: typing.Set[tuple]
+        # tables read by the session
+        self.views = []  # type: typing.List[TableView]
+        self.ended = False
+
+    async def __aenter__(self) -> "Transaction":
+        await self.storage.__aenter__()
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback) -> None:
+        if exc_type is not None or not self.pending:
+            self.rollback()
+            return
+
+        # the changes stay in the tables until they're committed, the sessions
+        # that start meanwhile see them
+        self.ended = True
+        await self.storage._enqueue(self)
+
+    @property
+    def documents_read(self) -> int:
+        return sum(view.reads for view in self.views)
+
+    def ensure_index(self, name: str, field: str, index_class: type) -> typing.Any:
+        return self.storage.ensure_index(name, field, index_class)
+
+    def subscribe(self, callback: typing.Callable) -> bool:
+        return self.storage.subscribe(callback)
+
+    def _log(self, *record: typing.Any, expected: typing.Any = None) -> None:
+        """
+        Apply a record as part of the session
+
+        :param expected: version the document must have when committing, `None`
+        to write it regardless of its version
+        :raises ConflictError: if another open session has changes not committed
+        """
+        sessions = self.storage._sessions
+        if not sessions or sessions[-1] is not self:
+            if sessions and not sessions[-1].ended:
+                raise ConflictError("another session is writing the database")
+            sessions.append(self)
+
+        operation, name = record[0], record[1]
+        if operation in ("put", "delete"):
+            self._expect(name, record[2], expected)
+            self.written.add((name, record[2]))
+        self._apply(record)
+        self.pending.append(record)
+
+    def _apply(self, record: tuple) -> None:
+        storage = self.storage
+        operation, name = record[0], record[1]
+        if operation in ("put", "delete"):
+            doc_id = record[2]
+            self.undo.append(
+                (
+                    name,
+                    doc_id,
+                    storage._tables.get(name, {}).get(doc_id),
+                    storage._versions.get(name, {}).get(doc_id),
+                )
+            )
+        else:
+            self.undo.append(
+                (name, None, storage._tables.get(name), storage._versions.get(name))
+            )
+        storage._apply(record)
+
+    def _expect(self, name: str, doc_id: str, version: typing.Any) -> None:
+        # versions set by the session itself are undone before committing, the
+        # one to check is the version the document had before the session
+        if version is not None and (name, doc_id) not in self.written:
+            if version is _ABSENT:
+                version = None
+            self.expected.setdefault((name, doc_id), version)
+
+    def undo_changes(self) -> None:
+        """
+        Take the changes of the session out of the tables, keeping its records,
+        which must be the last ones applied
+        """
+        storage = self.storage
+        tables, versions = storage._tables, storage._versions
+        for name, doc_id, document, version in reversed(self.undo):
+            if doc_id is None:
+                # undo a whole table
+                if document is None:
+                    tables.pop(name, None)
+                    versions.pop(name, None)
+                else:
+                    tables[name] = document
+                    versions[name] = version
+                storage._build_indexes(name)
+                continue
+
+            documents = tables.setdefault(name, {})
+            for index in storage._indexes.get(name, {}).values():
+                index.update(doc_id, documents.get(doc_id), document)
+            table_versions = versions.setdefault(name, {})
+            if document is None:
+                documents.pop(doc_id, None)
+            else:
+                documents[doc_id] = document
+            if version is None:
+                table_versions.pop(doc_id, None)
+            else:
+                table_versions[doc_id] = version
+
+        storage._sequence -= len(self.pending)
+        self.undo = []
+
+    def redo_changes(self) -> None:
+        """
+        Apply the records of the session again, after `undo_changes`
+        """
+        for record in self.pending:
+            self._apply(record)
+
+    def rollback(self) -> None:
+        """
+        Undo the changes of the session
+        """
+        sessions = self.storage._sessions
+        if self in sessions:
+            # no other session can write until it ends, its changes are the last
+            self.undo_changes()
+            sessions.remove(self)
+        self.pending = []
+        self.undo = []
+        self.expected = {}
+        self.written = set()
+
+    def commit(self) -> None:
+        """
+        Persist the changes of the session without an event loop
+
+        :raises ConflictError: if any document written by the session was changed
+        by someone else, in which case the changes are undone
+        """
+        records, expected = self.pending, self.expected
+        # the records of the session are applied again after the ones that other
+        # workers have committed in the meantime, so they end up in log order
+        self.rollback()
+        if records:
+            self.storage._commit(records, expected)
+
+    def read_table(self, name: str) -> TableView:
+        storage = self.storage
+        view = TableView(
+            storage._tables.setdefault(name, {}),
+            lambda doc_id: storage.version(name, doc_id),
+        )
+        self.views.append(view)
+        return view
+
+    def write_table(self, name: str, data: typing.Mapping) -> None:
+        storage = self.storage
+        documents = storage._tables.setdefault(name, {})
+        if not isinstance(data, TableView):
+            # the whole table was replaced, e.g. when purging it
+            self._log("clear", name)
+            for doc_id, document in data.items():
+                self._log("put", name, doc_id, dict(document))
+            return
+
+        # documents are expected to have the version they had when they were read,
+        # or the current one if they were changed without reading them first
+        for doc_id, version in data.removed.items():
+            if doc_id in documents:
+                version = version or storage.version(name, doc_id)
+                self._log("delete", name, doc_id, expected=version)
+        for doc_id, document in data.loaded.items():
+            version = getattr(document, "version", None)
+            if doc_id in documents and documents[doc_id] == document:
+                # writing back a stale document must fail even if nothing changed
+                self._expect(name, doc_id, version)
+            elif doc_id not in documents and version is None:
+                # new documents must still not exist, in case another process
+                # inserted one with the same id meanwhile
+                self._log("put", name, doc_id, dict(document), expected=_ABSENT)
+            else:
+                version = version or storage.version(name, doc_id)
+                self._log("put", name, doc_id, dict(document), expected=version)
+
+    def read(self) -> dict:
+        return self.storage.read()
+
+    def write(self, data: dict) -> None:
+        tables = self.storage._tables
+        for name in list(tables):
+            if name not in data:
+                self._log("drop", name)
+        for name, documents in data.items():
+            if tables.get(name) != documents:
+                self._log("clear", name)
+                for doc_id, document in documents.items():
+                    self._log("put", name, doc_id, dict(document))
@@ -0,0 +1,128 @@
+import asyncio
+import typing
+
+from tinydb.database import Document
+
+from ..repositories import shared_repository
+
+
+class _ViewState:
+    def __init__(self):
+        self.view = None  # type: typing.Any
+        # if the repository notifies its changes, otherwise it's read every time
+        self.subscribed = False
+        # ids of the products changed since the view was updated, in the order
+        # they changed
+        self.pending = {}  # type: typing.Dict[str, None]
+        # times the whole table changed, to discard views built meanwhile
+        self.resets = 0
+        # future of the update in progress, which the others wait for
+        self.updating = None  # type: typing.Optional[asyncio.Future]
+
+
+class ProductView:
+    """
+    In-memory view of the products of a repository, like an index, with one
+    view per repository
+
+    The view is built the first time it's used, or beforehand with `prepare`
+    (e.g. when the worker starts), and kept up to date with the changes that
+    the repository notifies (see `Repository.subscribe`): only the products
+    that changed are read again, before the view is used, unless there are more
+    than `max_changes` of them. Repositories that don't notify changes are read
+    whole every time.
+
+    Subclasses build the view from the products with `build`, and update it
+    with the ones that changed with `update`.
+    """
+
+    # fields of the products the view needs, `None` for all of them
+    fields = None  # type: typing.Optional[typing.List[str]]
+    # products changed at once, like by an import, above which the view is
+    # built again instead of updated with each of them
+    max_changes = 1000
+
+    def __init__(self):
+        self._states = {}  # type: typing.Dict[typing.Any, _ViewState]
+
+    def build(self, documents: typing.List[Document]) -> typing.Any:
+        """
+        Build the view of all the products
+        """
+        raise NotImplementedError()
+
+    def update(
+        self, view: typing.Any, changes: typing.Dict[str, typing.Optional[Document]]
+    ) -> None:
+        """
+        Update the view with the products that changed
+
+        :param changes dict: products by id, `None` for the ones removed
+        """
+        raise NotImplementedError()
+
+    def _state(self, database: typing.Any) -> _ViewState:
+        # requests get a wrapper of the shared database, see `RequestRepository`
+        repository = shared_repository(database)
+        state = self._states.get(repository)
+        if state is None:
+            state = self._states[repository] = _ViewState()
+            state.subscribed = repository.subscribe(
+                lambda table, doc_ids: self._changed(state, table, doc_ids)
+            )
+        return state
+
+    def _changed(
+        self,
+        state: _ViewState,
+        table: typing.Optional[str],
+        doc_ids: typing.Optional[typing.Iterable[str]],
+    ) -> None:
+        if table is not None and table != "products":
+            return
+        if doc_ids is not None:
+            state.pending.update(dict.fromkeys(doc_ids))
+        if doc_ids is None or len(state.pending) > self.max_changes:
+            state.view = None
+            state.pending.clear()
+            state.resets += 1
+
+    async def prepare(self, database: typing.Any) -> typing.Any:
+        """
+        Bring the view of a repository up to date, building it if needed
+
+        :param database Repository: repository of the products
+        :returns: the view
+        """
+        state = self._state(database)
+        # the session catches up with the changes made by other workers first
+        async with database.session() as session:
+            while state.updating is not None:
+                await asyncio.wait([state.updating])
+
+            view = state.view
+            if view is not None and state.subscribed and not state.pending:
+                return view
+
+            state.updating = asyncio.get_event_loop().create_future()
+            try:
+                if view is None or not state.subscribed:
+                    resets = state.resets
+                    state.pending.clear()
+                    documents = await session.products.search(fields=self.fields)
+                    view = self.build(documents)
+                    if resets == state.resets:
+                        state.view = view
+                else:
+                    doc_ids, state.pending = list(state.pending), {}
+                    try:
+                        documents = await session.products.get_many(doc_ids)
+                    except BaseException:
+                        # they're read again the next time
+                        state.pending = {**dict.fromkeys(doc_ids), **state.pending}
+                        raise
+                    self.update(view, dict(zip(doc_ids, documents)))
+            finally:
+                state.updating.set_result(None)
+                state.updating = None
+        return view
@@ -0,0 +1,177 @@
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from .harness import (
+    MIXES,
+    compare,
+    copy_to_sqlite,
+    run_in_process,
+    run_with_gunicorn,
+    seed_database,
+)
+
+# database urls by storage, given the path of the database file
+STORAGES = {
+    "wal": "tinydb://{}",
+    "json": "tinydb://{}?storage=json",
+    "segments": "tinydb://{}?storage=segments",
+    "sqlite": "sqlite://{}",
+}
+
+
+def _commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], universal_newlines=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def _print(target: str, summary: dict) -> None:
+    print(f"\n{target}: {summary['total']['throughput']} requests/s")
+    print(
+        f"{'operation':<12}{'requests':>10}{'errors':>8}{'p50':>10}{'p95':>10}{'p99':>10}"
+    )
+    for operation, statistics in [
+        *summary["operations"].items(),
+        ("total", summary["total"]),
+    ]:
+        print(
+            f"{operation:<12}{statistics['requests']:>10}{statistics['errors']:>8}"
+            f"{statistics['p50']:>10}{statistics['p95']:>10}{statistics['p99']:>10}"
+        )
+
+
+def prepare(path: str, args: argparse.Namespace) -> tuple:
+    """
+    Create the database to benchmark, discarding the changes of previous runs
+    """
+    if os.path.exists(path + ".wal"):
+        os.remove(path + ".wal")
+    product_ids, carts = seed_database(
+        path, args.products, args.users, args.cart_size, args.seed
+    )
+    if args.storage == "segments":
+        from akara.utils.segments import convert
+
+        convert(path, path)
+    elif args.storage == "sqlite":
+        copy_to_sqlite(path, path + ".sqlite")
+    return product_ids, carts
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks",
+        description="Benchmark the graphql api against a generated database",
+    )
+    parser.add_argument("--products", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--cart-size", type=int, default=3)
+    parser.add_argument("--mix", choices=sorted(MIXES), default="shopping")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--warmup", type=int, default=100)
+    parser.add_argument(
+        "--concurrency", type=int, default=8, help="virtual users at the same time"
+    )
+    parser.add_argument("--storage", choices=sorted(STORAGES), default="wal")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        nargs="*",
+        default=[],
+        help="also run through gunicorn with these amounts of workers",
+    )
+    parser.add_argument(
+        "--skip-in-process", action="store_true", help="only run through gunicorn"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output", help="json file for the results, by default named by commit"
+    )
+    parser.add_argument("--compare", help="results of a previous run to compare to")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="fraction the p95 of an operation can grow before failing --compare",
+    )
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="akara-benchmark-")
+    path = os.path.join(directory, "data.json")
+    if args.storage == "sqlite":
+        database_url = STORAGES["sqlite"].format(path + ".sqlite")
+    else:
+        database_url = STORAGES[args.storage].format(path)
+    # must be set before akara is imported, its settings are read on import
+    os.environ["DATABASE_URL"] = database_url
+    os.environ.pop("TESTING", None)
+
+    parameters = {
+        "products": args.products,
+        "users": args.users,
+        "cart_size": args.cart_size,
+        "requests": args.requests,
+        "warmup": args.warmup,
+        "concurrency": args.concurrency,
+        "storage": args.storage,
+        "seed": args.seed,
+    }
+    options = dict(
+        requests=args.requests,
+        concurrency=args.concurrency,
+        warmup=args.warmup,
+        seed=args.seed,
+    )
+    mix = MIXES[args.mix]
+    commit = _commit()
+    results = {
+        "commit": commit,
+        "date": datetime.datetime.utcnow().isoformat(),
+        "mix": args.mix,
+        "parameters": parameters,
+        "targets": {},
+    }
+
+    if not args.skip_in_process:
+        product_ids, carts = prepare(path, args)
+        results["targets"]["in-process"] = summary = run_in_process(
+            product_ids, carts, mix, **options
+        )
+        _print("in-process", summary)
+    for workers in args.workers:
+        # every run starts from the same data
+        product_ids, carts = prepare(path, args)
+        target = f"gunicorn-{workers}"
+        results["targets"][target] = summary = run_with_gunicorn(
+            database_url, workers, product_ids, carts, mix, **options
+        )
+        _print(target, summary)
+
+    output = args.output or os.path.join(
+        "benchmarks", "results", f"{commit}-{args.mix}.json"
+    )
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"\nresults saved to {output}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(json.load(file), results, args.tolerance)
+        for regression in regressions:
+            print(f"regression: {regression}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
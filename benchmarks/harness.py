@@ -0,0 +1,566 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import http.client
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import typing
+
+PASSWORD = "benchmark"
+
+PRODUCTS_QUERY = "{ products(available: true) { id title price inventoryCount } }"
+PAGE_QUERY = """
+query Page($after: String) {
+  productsConnection(first: 20, after: $after) {
+    edges { cursor node { id title price inventoryCount } }
+    pageInfo { hasNextPage endCursor }
+  }
+}
+"""
+PRODUCT_QUERY = """
+query Product($id: ID!) { product(id: $id) { id title price inventoryCount } }
+"""
+CART_QUERY = """
+{ cart { price products { amount product { id title price } } } }
+"""
+ADD_MUTATION = """
+mutation Add($id: ID!) {
+  addToCart(productId: $id, amount: 1) { price products { amount } }
+}
+"""
+REMOVE_MUTATION = """
+mutation Remove($id: ID!) {
+  removeFromCart(productId: $id) { price products { amount } }
+}
+"""
+CHECKOUT_MUTATION = "mutation { completeCart { charged success } }"
+LOGIN_MUTATION = """
+mutation Login($username: String!, $password: String!) {
+  login(username: $username, password: $password) { token }
+}
+"""
+
+# relative weights of the operations run by every mix
+MIXES = {
+    "browse": {"products": 30, "page": 30, "product": 40},
+    "shopping": {
+        "products": 15,
+        "page": 10,
+        "product": 20,
+        "cart": 15,
+        "add": 20,
+        "remove": 8,
+        "checkout": 7,
+        "login": 5,
+    },
+    "checkout": {"cart": 20, "add": 50, "checkout": 30},
+    "login": {"login": 100},
+}
+
+
+def _random_id(rng: random.Random) -> str:
+    return "%032x" % rng.getrandbits(128)
+
+
+def seed_database(
+    path: str, products: int, users: int, cart_size: int, seed: int = 0
+) -> typing.Tuple[typing.List[str], typing.Dict[str, typing.List[str]]]:
+    """
+    Create a TinyDB json database with a random catalog, users with `PASSWORD`
+    as their password and carts of `cart_size` products each
+
+    The same seed always creates the same data. Inventories are big enough for
+    the products to never run out during a benchmark.
+
+    :param path str: path of the database file to create
+    :returns: the ids of the products, and those of the products in the cart of
+    every user, by username
+    """
+    # settings are read on import, so the database to use must be set before
+    from akara.utils.password import hash_password
+
+    rng = random.Random(seed)
+    # all the users share the hash, so seeding doesn't depend on the hash cost
+    password_hash = hash_password(PASSWORD)
+
+    catalog = {
+        _random_id(rng): {
+            "title": f"Product {number}",
+            "price": round(rng.uniform(1, 500), 2),
+            "inventory_count": rng.randint(10**6, 10**7),
+        }
+        for number in range(products)
+    }
+    product_ids = list(catalog)
+
+    accounts, cart_items, summaries, carts = {}, {}, {}, {}
+    for number in range(users):
+        username = f"user{number}"
+        user_id = _random_id(rng)
+        accounts[user_id] = {"username": username, "password_hash": password_hash}
+        carts[username] = rng.sample(product_ids, min(cart_size, len(product_ids)))
+        for product_id in carts[username]:
+            cart_items[_random_id(rng)] = {
+                "product": product_id,
+                "amount": 1,
+                "user": user_id,
+            }
+        summaries[_random_id(rng)] = {
+            "user": user_id,
+            "lines": len(carts[username]),
+            "price": round(
+                sum(catalog[product_id]["price"] for product_id in carts[username]), 6
+            ),
+        }
+
+    with open(path, "w") as database:
+        json.dump(
+            {
+                "_default": {},
+                "products": catalog,
+                "users": accounts,
+                "cart_items": cart_items,
+                "carts": {
+                    doc_id: summary
+                    for doc_id, summary in summaries.items()
+                    if summary["lines"]
+                },
+            },
+            database,
+        )
+    return product_ids, carts
+
+
+def copy_to_sqlite(path: str, sqlite_path: str) -> None:
+    """
+    Copy a TinyDB json database, like the ones of `seed_database`, to a new
+    SQLite database keeping the ids of the documents
+    """
+    from akara.repositories.sqlite import (
+        ConnectionPool,
+        SqliteCartItemTable,
+        SqliteCartTable,
+        SqliteProductTable,
+        SqliteUserTable,
+    )
+
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(sqlite_path + suffix):
+            os.remove(sqlite_path + suffix)
+    with open(path) as file:
+        data = json.load(file)
+
+    connection = ConnectionPool(sqlite_path).connect()
+    try:
+        with connection:
+            connection.execute("BEGIN")
+            for table in (
+                SqliteProductTable,
+                SqliteUserTable,
+                SqliteCartItemTable,
+                SqliteCartTable,
+            ):
+                placeholders = ", ".join("?" * (len(table.fields) + 1))
+                connection.executemany(
+                    f"INSERT INTO {table.name} (id, {', '.join(table.fields)}) "
+                    f"VALUES ({placeholders})",
+                    [
+                        (doc_id, *(document.get(field) for field in table.fields))
+                        for doc_id, document in data[table.name].items()
+                    ],
+                )
+    finally:
+        connection.close()
+
+
+class InProcessClient:
+    """
+    Client that sends requests straight to an ASGI app, in the current event loop
+    """
+
+    def __init__(self, app: typing.Callable):
+        self.app = app
+
+    async def post(
+        self, path: str, body: bytes, headers: typing.Dict[str, str]
+    ) -> typing.Tuple[int, bytes]:
+        scope = {
+            "type": "http",
+            "http_version": "1.1",
+            "method": "POST",
+            "scheme": "http",
+            "root_path": "",
+            "path": path,
+            "query_string": b"",
+            "headers": [
+                (name.lower().encode(), value.encode())
+                for name, value in headers.items()
+            ],
+            "client": ("127.0.0.1", 0),
+            "server": ("benchmark", 80),
+        }
+        messages = [{"type": "http.request", "body": body, "more_body": False}]
+        status, chunks = None, []
+
+        async def receive() -> dict:
+            return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+        async def send(message: dict) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+
+        await self.app(scope)(receive, send)
+        return status, b"".join(chunks)
+
+    def close(self) -> None:
+        pass
+
+
+class HttpClient:
+    """
+    Client that sends requests to a server over HTTP, from a pool of threads
+    that keep their connections open
+
+    :param threads int: requests sent at the same time at most
+    """
+
+    def __init__(self, host: str, port: int, threads: int):
+        self.host = host
+        self.port = port
+        self._local = threading.local()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+
+    def _post(
+        self, path: str, body: bytes, headers: typing.Dict[str, str]
+    ) -> typing.Tuple[int, bytes]:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = http.client.HTTPConnection(
+                self.host, self.port
+            )
+        try:
+            connection.request("POST", path, body=body, headers=headers)
+            response = connection.getresponse()
+            return response.status, response.read()
+        except (http.client.HTTPException, OSError):
+            connection.close()
+            self._local.connection = None
+            raise
+
+    async def post(
+        self, path: str, body: bytes, headers: typing.Dict[str, str]
+    ) -> typing.Tuple[int, bytes]:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self._executor, self._post, path, body, headers
+        )
+
+    def close(self) -> None:
+        self._executor.shutdown()
+
+
+class Session:
+    """
+    Virtual user of a benchmark, sending the requests of a mix one after another
+
+    :param client: `InProcessClient` or `HttpClient` to send the requests with
+    :param cart: ids of the products in the cart of the user when it starts
+    """
+
+    def __init__(
+        self,
+        client: typing.Any,
+        username: str,
+        cart: typing.Iterable[str],
+        product_ids: typing.Sequence[str],
+        rng: random.Random,
+    ):
+        self.client = client
+        self.username = username
+        self.in_cart = set(cart)
+        self.product_ids = product_ids
+        self.rng = rng
+        self.token = None
+        self.cursor = None
+
+    async def execute(
+        self, query: str, variables: dict = None, authenticated: bool = False
+    ) -> dict:
+        """
+        Send a graphql request
+
+        :raises RuntimeError: if the request fails or the result has errors
+        """
+        headers = {"Content-Type": "application/json"}
+        if authenticated:
+            headers["Authorization"] = f"Bearer {self.token}"
+        body = json.dumps({"query": query, "variables": variables}).encode()
+        status, content = await self.client.post("/query", body, headers)
+        result = json.loads(content) if content else {}
+        if status != 200 or result.get("errors"):
+            raise RuntimeError(f"{status} {result.get('errors')}")
+        return result["data"]
+
+    async def login(self) -> None:
+        data = await self.execute(
+            LOGIN_MUTATION, {"username": self.username, "password": PASSWORD}
+        )
+        self.token = data["login"]["token"]
+
+    async def products(self) -> None:
+        await self.execute(PRODUCTS_QUERY)
+
+    async def page(self) -> None:
+        data = await self.execute(PAGE_QUERY, {"after": self.cursor})
+        page_info = data["productsConnection"]["pageInfo"]
+        self.cursor = page_info["endCursor"] if page_info["hasNextPage"] else None
+
+    async def product(self) -> None:
+        await self.execute(PRODUCT_QUERY, {"id": self.rng.choice(self.product_ids)})
+
+    async def cart(self) -> None:
+        await self.execute(CART_QUERY, authenticated=True)
+
+    async def add(self) -> None:
+        product_id = self.rng.choice(self.product_ids)
+        await self.execute(ADD_MUTATION, {"id": product_id}, authenticated=True)
+        self.in_cart.add(product_id)
+
+    async def remove(self) -> None:
+        product_id = self.rng.choice(sorted(self.in_cart))
+        await self.execute(REMOVE_MUTATION, {"id": product_id}, authenticated=True)
+        self.in_cart.discard(product_id)
+
+    async def checkout(self) -> None:
+        await self.execute(CHECKOUT_MUTATION, authenticated=True)
+        self.in_cart.clear()
+
+    def next_operation(self, mix: typing.Dict[str, int]) -> str:
+        operation = self.rng.choices(list(mix), weights=list(mix.values()))[0]
+        if operation in ("remove", "checkout") and not self.in_cart:
+            # there must be something in the cart to remove or buy
+            return "add"
+        return operation
+
+
+def percentile(values: typing.Sequence[float], percent: float) -> float:
+    """
+    Obtain a percentile of sorted values, by the nearest rank method
+    """
+    if not values:
+        return 0.0
+    rank = max(math.ceil(percent / 100 * len(values)), 1)
+    return values[rank - 1]
+
+
+def summarize(
+    latencies: typing.Dict[str, typing.List[float]],
+    errors: typing.Dict[str, int],
+    seconds: float,
+) -> dict:
+    """
+    Obtain the throughput and the latency percentiles, in milliseconds, of every
+    operation and of all of them together
+    """
+    operations = {}
+    everything = []
+    for operation in sorted(set(latencies) | set(errors)):
+        values = sorted(latencies.get(operation, ()))
+        everything.extend(values)
+        operations[operation] = _statistics(values, errors.get(operation, 0), seconds)
+
+    everything.sort()
+    return {
+        "seconds": round(seconds, 3),
+        "total": _statistics(everything, sum(errors.values()), seconds),
+        "operations": operations,
+    }
+
+
+def _statistics(values: typing.List[float], errors: int, seconds: float) -> dict:
+    return {
+        "requests": len(values),
+        "errors": errors,
+        "throughput": round(len(values) / seconds, 2) if seconds else 0.0,
+        "mean": round(sum(values) / len(values) * 1000, 3) if values else 0.0,
+        "p50": round(percentile(values, 50) * 1000, 3),
+        "p95": round(percentile(values, 95) * 1000, 3),
+        "p99": round(percentile(values, 99) * 1000, 3),
+    }
+
+
+async def run(
+    client: typing.Any,
+    product_ids: typing.Sequence[str],
+    carts: typing.Dict[str, typing.List[str]],
+    mix: typing.Dict[str, int],
+    requests: int,
+    concurrency: int,
+    warmup: int = 0,
+    seed: int = 0,
+) -> dict:
+    """
+    Run a mix of operations with `concurrency` virtual users at the same time,
+    every one of them logged in as a different user when there are enough
+
+    :param requests int: total amount of measured requests
+    :param warmup int: requests sent before starting to measure
+    :returns: the summary of the measures (see `summarize`)
+    """
+    usernames = sorted(carts)
+    sessions = [
+        Session(
+            client,
+            usernames[number % len(usernames)],
+            carts[usernames[number % len(usernames)]],
+            product_ids,
+            random.Random(seed * 1000 + number),
+        )
+        for number in range(concurrency)
+    ]
+    await asyncio.gather(*(session.login() for session in sessions))
+
+    latencies, errors = {}, {}
+    remaining = warmup + requests
+
+    async def worker(session: Session) -> None:
+        nonlocal remaining
+        while remaining > 0:
+            measured = remaining <= requests
+            remaining -= 1
+            operation = session.next_operation(mix)
+            start = time.perf_counter()
+            try:
+                await getattr(session, operation)()
+            except RuntimeError:
+                if measured:
+                    errors[operation] = errors.get(operation, 0) + 1
+                continue
+            if measured:
+                latencies.setdefault(operation, []).append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(session) for session in sessions))
+    return summarize(latencies, errors, time.perf_counter() - start)
+
+
+def run_in_process(*args: typing.Any, **kwargs: typing.Any) -> dict:
+    """
+    Same as `run` but sending the requests straight to `akara.app:app`
+    """
+    # settings are read on import, so the database to use must be set before
+    from akara.app import app
+
+    client = InProcessClient(app)
+    # the graphql executor of the app is bound to the default loop
+    loop = asyncio.get_event_loop()
+    return loop.run_until_complete(run(client, *args, **kwargs))
+
+
+def _free_port() -> int:
+    with contextlib.closing(socket.socket()) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextlib.contextmanager
+def serve(
+    database_url: str, workers: int, timeout: float = 30
+) -> typing.Iterator[typing.Tuple[str, int]]:
+    """
+    Start `akara.app:app` with gunicorn in the background
+
+    :param workers int: amount of gunicorn workers
+    :returns: the host and port the server listens on
+    """
+    host, port = "127.0.0.1", _free_port()
+    environment = dict(os.environ, DATABASE_URL=database_url, DEBUG="False")
+    environment.pop("TESTING", None)
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "gunicorn",
+            "--workers",
+            str(workers),
+            "--worker-class",
+            "uvicorn.workers.UvicornWorker",
+            "--bind",
+            f"{host}:{port}",
+            "akara:app",
+        ],
+        env=environment,
+    )
+    try:
+        deadline = time.time() + timeout
+        while True:
+            if server.poll() is not None:
+                raise RuntimeError("gunicorn exited before accepting connections")
+            try:
+                socket.create_connection((host, port), timeout=1).close()
+                break
+            except OSError:
+                if time.time() > deadline:
+                    raise RuntimeError("gunicorn didn't start in time")
+                time.sleep(0.1)
+        yield host, port
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def run_with_gunicorn(
+    database_url: str,
+    workers: int,
+    *args: typing.Any,
+    concurrency: int,
+    **kwargs: typing.Any,
+) -> dict:
+    """
+    Same as `run` but sending the requests over HTTP to gunicorn with `workers`
+    workers
+    """
+    with serve(database_url, workers) as (host, port):
+        client = HttpClient(host, port, threads=concurrency)
+        try:
+            loop = asyncio.get_event_loop()
+            return loop.run_until_complete(
+                run(client, *args, concurrency=concurrency, **kwargs)
+            )
+        finally:
+            client.close()
+
+
+def compare(baseline: dict, current: dict, tolerance: float = 0.2) -> list:
+    """
+    Find the operations whose p95 latency grew by more than `tolerance` (a
+    fraction) between two benchmark results with the same targets
+
+    :returns: a description of every regression
+    """
+    regressions = []
+    for target, summary in current["targets"].items():
+        previous = baseline.get("targets", {}).get(target)
+        if previous is None:
+            continue
+        for operation, statistics in summary["operations"].items():
+            before = previous["operations"].get(operation)
+            if not before or not before["p95"]:
+                continue
+            change = statistics["p95"] / before["p95"] - 1
+            if change > tolerance:
+                regressions.append(
+                    f"{target} {operation}: p95 {before['p95']}ms -> "
+                    f"{statistics['p95']}ms (+{change:.0%})"
+                )
+    return regressions
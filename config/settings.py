@@ -1,7 +1,7 @@
 from starlette.config import Config
-from starlette.datastructures import DatabaseURL
+from starlette.datastructures import CommaSeparatedStrings, DatabaseURL
 
-from akara.utils.database import TinyDbMiddleware as DatabaseMiddleware
+from akara.repositories import DatabaseMiddleware
 
 
 config = Config(".env")
@@ -11,12 +11,53 @@ TESTING = config("TESTING", cast=bool, default=False)
 SECRET_KEY = config("SECRET_KEY", default="unsecure secret")
 JWT_ALGORITHM = config("JWT_ALGORITHM", default="HS256")
 JWT_EXPIRATION_DAYS = config("JWT_EXPIRATION_DAYS", cast=int, default=60)
+# key derivation function used for passwords, "scrypt" or "pbkdf2-sha256", and
+# its cost, hashes made with other settings are updated when users log in
+PASSWORD_HASHER = config("PASSWORD_HASHER", default="scrypt")
+SCRYPT_COST = config("SCRYPT_COST", cast=int, default=2 ** 14)
+SCRYPT_BLOCK_SIZE = config("SCRYPT_BLOCK_SIZE", cast=int, default=8)
+SCRYPT_PARALLELISM = config("SCRYPT_PARALLELISM", cast=int, default=1)
+PBKDF2_ITERATIONS = config("PBKDF2_ITERATIONS", cast=int, default=200000)
+# threads used to hash passwords outside of the event loop
+PASSWORD_HASHING_THREADS = config("PASSWORD_HASHING_THREADS", cast=int, default=2)
+# parsed and validated queries kept in memory, by hash
+QUERY_CACHE_SIZE = config("QUERY_CACHE_SIZE", cast=int, default=1000)
+# bytes of responses to anonymous catalog queries kept in memory
+RESPONSE_CACHE_SIZE = config("RESPONSE_CACHE_SIZE", cast=int, default=16 * 1024 ** 2)
+# requests slower than this many seconds are logged, a fraction of them
+SLOW_QUERY_THRESHOLD = config("SLOW_QUERY_THRESHOLD", cast=float, default=None)
+SLOW_QUERY_SAMPLE_RATE = config("SLOW_QUERY_SAMPLE_RATE", cast=float, default=1.0)
+# names of the graphql operations whose execution time is measured on its own
+MEASURED_OPERATIONS = config(
+    "MEASURED_OPERATIONS", cast=CommaSeparatedStrings, default=""
+)
+# users allowed to administer the shop, e.g. to import products
+ADMIN_USERNAMES = config("ADMIN_USERNAMES", cast=CommaSeparatedStrings, default="")
+# verified tokens kept in memory, and for how many seconds at most
+JWT_CACHE_SIZE = config("JWT_CACHE_SIZE", cast=int, default=1024)
+JWT_CACHE_TTL = config("JWT_CACHE_TTL", cast=float, default=300)
+# operations estimated to be more expensive or deeper than this are rejected
+MAX_QUERY_COST = config("MAX_QUERY_COST", cast=int, default=50000)
+MAX_QUERY_DEPTH = config("MAX_QUERY_DEPTH", cast=int, default=10)
+# estimated cost each client can spend every window of seconds, by default any
+QUERY_COST_BUDGET = config("QUERY_COST_BUDGET", cast=int, default=None)
+QUERY_COST_WINDOW = config("QUERY_COST_WINDOW", cast=float, default=60)
+# operations a single request to /query can send in a batch
+MAX_BATCH_SIZE = config("MAX_BATCH_SIZE", cast=int, default=20)
+# maximum amount of items returned by a page of a connection
+MAX_PAGE_SIZE = config("MAX_PAGE_SIZE", cast=int, default=100)
+# product searches whose ranked results are kept in memory until products change
+SEARCH_CACHE_SIZE = config("SEARCH_CACHE_SIZE", cast=int, default=256)
+# units left under which products count as low on stock by default
+LOW_STOCK_THRESHOLD = config("LOW_STOCK_THRESHOLD", cast=int, default=5)
+# products written in each session of an import
+IMPORT_BATCH_SIZE = config("IMPORT_BATCH_SIZE", cast=int, default=1000)
+# times a mutation of the cart, like a checkout, is attempted when other
+# requests change the same documents before it commits
+WRITE_ATTEMPTS = config("WRITE_ATTEMPTS", cast=int, default=5)
 
 DATABASE_URL = config("DATABASE_URL", cast=DatabaseURL)
 if TESTING:
     DATABASE_URL = DATABASE_URL.replace(database="test_" + DATABASE_URL.database)
-
-if DATABASE_URL.dialect != "tinydb":
-    # use starlette default database middleware when not using tinydb
-    # intended to make project work in a environment with a real database
-    from starlette.middleware.database import DatabaseMiddleware
+# connections to the database each worker keeps open, only for sqlite
+DATABASE_POOL_SIZE = config("DATABASE_POOL_SIZE", cast=int, default=5)
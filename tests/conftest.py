@@ -1,32 +1,152 @@
+import asyncio
+import os
+import typing
+
 import pytest
 
 from tinydb import TinyDB
 from starlette.config import environ
+from starlette.datastructures import DatabaseURL
 from starlette.testclient import TestClient
 
 environ["TESTING"] = "True"
 
-from akara.app import app, DATABASE_URL
+from akara.app import app, database_middleware, graphql_app, DATABASE_URL
+from akara.repositories import Repository, create_repository
+from akara.utils.cache import ResponseCache
 from akara.utils.database import UuidStorageProxy, UuidTable
 
 TinyDB.table_class = UuidTable
 TinyDB.storage_proxy_class = UuidStorageProxy
 
+TABLES = ("products", "users", "cart_items", "carts")
+
+# databases the tests run against, by backend
+BACKENDS = {
+    "tinydb": DATABASE_URL,
+    "sqlite": DatabaseURL(
+        "sqlite://"
+        + os.path.splitext(DATABASE_URL.hostname + DATABASE_URL.path)[0]
+        + ".db"
+    ),
+}
+
+
+def run(coroutine):
+    """
+    Run a coroutine to completion in a new event loop
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers", "backends(*names): only run the test against these backends"
+    )
+
+
+# repositories used by the app, and by the tests to change the database as if
+# they were another worker, by backend
+_repositories = {"tinydb": database_middleware.repository}
+_workers = {}
+
+
+class WorkerTable:
+    """
+    Table of the database the app is using, accessed as another worker would
+    """
+
+    def __init__(self, repository: Repository, name: str):
+        self.repository = repository
+        self.name = name
+
+    async def _session(self, function: typing.Callable) -> typing.Any:
+        async with self.repository.session(write=True) as session:
+            return await function(session.table(self.name))
+
+    def insert(self, document: dict) -> str:
+        return run(self._session(lambda table: table.insert(document)))
+
+    def insert_multiple(self, documents: typing.List[dict]) -> typing.List[str]:
+        return run(self._session(lambda table: table.insert_many(documents)))
+
+    def all(self) -> typing.List[dict]:
+        return run(self._session(lambda table: table.all()))
+
+    def update(self, fields: dict, doc_ids: typing.List[str]) -> None:
+        async def update(table):
+            documents = await table.get_many(doc_ids)
+            for document in documents:
+                document.update(fields)
+            await table.update_many(documents)
+
+        run(self._session(update))
+
+    def purge(self) -> None:
+        async def purge(table):
+            await table.remove([document.doc_id for document in await table.all()])
+
+        run(self._session(purge))
+
+
+@pytest.fixture(params=sorted(BACKENDS))
+def backend(request, monkeypatch) -> str:
+    """
+    Run the test against every backend, starting with an empty database
+    """
+    name = request.param
+    marker = request.node.get_closest_marker("backends")
+    if marker is not None and name not in marker.args:
+        pytest.skip(f"not supported by {name}")
+
+    if name not in _repositories:
+        _repositories[name] = create_repository(BACKENDS[name])
+    if name not in _workers:
+        _workers[name] = create_repository(BACKENDS[name])
+    monkeypatch.setattr(database_middleware, "repository", _repositories[name])
+    # what the app knows of the database is only valid for its own backend
+    monkeypatch.setattr(graphql_app, "responses", ResponseCache())
+    monkeypatch.setattr(graphql_app, "_table_sizes", {})
+
+    for table in TABLES:
+        WorkerTable(_workers[name], table).purge()
+    return name
+
 
 @pytest.fixture
-def test_database(request):
+def test_database(backend):
     """
     Create a database for testing
     """
-    database_url = DATABASE_URL.hostname + DATABASE_URL.path
-    with TinyDB(database_url) as db:
 
-        def _make_table(name: str):
-            return db.table(name)
+    def _make_table(name: str):
+        return WorkerTable(_workers[backend], name)
+
+    yield _make_table
+
+    for table in TABLES:
+        _make_table(table).purge()
+
+
+class CountingRepository:
+    """
+    Repository wrapper that counts how many sessions are opened
+    """
+
+    def __init__(self, repository: Repository):
+        self.repository = repository
+        self.opened = 0
 
-        yield _make_table
+    def session(self, write: bool = False):
+        self.opened += 1
+        return self.repository.session(write)
 
-        db.purge_tables()
+    def __getattr__(self, name: str):
+        return getattr(self.repository, name)
 
 
 class StarletteGraphQlClient:
@@ -49,6 +169,6 @@ class StarletteGraphQlClient:
 
 
 @pytest.fixture
-def client():
+def client(backend):
     with TestClient(app) as client:
         yield StarletteGraphQlClient(client)
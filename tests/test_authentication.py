@@ -0,0 +1,79 @@
+import time
+from datetime import datetime, timedelta
+
+import jwt
+import pytest
+from starlette.authentication import AuthenticationError
+from starlette.requests import Request
+
+from akara.utils.authentication import JWTAuthenticationBackend
+from akara.utils.cache import LRUCache
+
+from .conftest import run
+
+
+def make_request(token: str) -> Request:
+    headers = [(b"authorization", f"Bearer {token}".encode())]
+    return Request({"type": "http", "headers": headers})
+
+
+def make_token(expires: datetime, **payload) -> str:
+    return jwt.encode(
+        {"id": "1", "username": "test", **payload, "exp": expires},
+        key="secret",
+        algorithm="HS256",
+    ).decode()
+
+
+def test_verified_tokens_are_cached():
+    backend = JWTAuthenticationBackend("secret", "HS256")
+    token = make_token(datetime.utcnow() + timedelta(days=1))
+
+    credentials, user = run(backend.authenticate(make_request(token)))
+    assert credentials.scopes == ["authenticated"]
+    assert user.username == "test"
+    assert run(backend.authenticate(make_request(token)))[1] is user
+    assert (backend.cache.hits, backend.cache.misses) == (1, 1)
+
+    # tampered tokens don't match the cached digest
+    with pytest.raises(AuthenticationError):
+        run(backend.authenticate(make_request(token[:-2] + "xx")))
+
+
+def test_cached_tokens_expire_with_the_token():
+    backend = JWTAuthenticationBackend("secret", "HS256")
+    token = make_token(datetime.utcnow() + timedelta(seconds=2))
+    run(backend.authenticate(make_request(token)))
+
+    expires, _ = next(iter(backend.cache._entries.values()))
+    assert expires <= time.time() + 2
+
+
+def test_tokens_must_expire():
+    backend = JWTAuthenticationBackend("secret", "HS256", cache_ttl=60)
+    token = jwt.encode({"id": "1", "username": "test"}, key="secret").decode()
+    with pytest.raises(AuthenticationError, match="exp"):
+        run(backend.authenticate(make_request(token)))
+    assert len(backend.cache) == 0
+
+    # tokens that expire after the ttl are kept for the ttl
+    token = make_token(datetime.utcnow() + timedelta(days=1))
+    run(backend.authenticate(make_request(token)))
+    expires, _ = next(iter(backend.cache._entries.values()))
+    assert expires <= time.time() + 60
+
+
+def test_cache_is_bounded():
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+
+    # "b" was the least recently used
+    assert "b" not in cache
+    assert [cache.get(key) for key in ("a", "c")] == [1, 3]
+    assert len(cache) == 2
+
+    cache.set("d", 4, expires=time.time() - 1)
+    assert cache.get("d") is None
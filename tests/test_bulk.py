@@ -0,0 +1,149 @@
+import json
+
+import pytest
+
+from akara import endpoints
+from akara.app import authentication_backend
+from akara.models import product_search
+from akara.utils.bulk import InvalidRow, iter_lines, read_csv, validate_product
+
+from .conftest import StarletteGraphQlClient, run
+from .test_cart import user_jwt
+from .test_users import initial_user
+
+
+async def _chunks(*chunks: bytes):
+    for chunk in chunks:
+        yield chunk
+
+
+async def _read_csv(*chunks: bytes) -> list:
+    return [row async for row in read_csv(iter_lines(_chunks(*chunks)))]
+
+
+def test_read_csv():
+    rows = run(
+        _read_csv(
+            b'\xef\xbb\xbftitle,price,inventory_count\n"Potion of\n',
+            b'healing",10,3\n\nEther,5\n"Elixir ""gold""",20,1\n',
+        )
+    )
+    assert rows[0] == (
+        2,
+        {"title": "Potion of\nhealing", "price": "10", "inventory_count": "3"},
+    )
+    assert rows[1][0] == 5
+    assert isinstance(rows[1][1], InvalidRow)
+    assert rows[2] == (
+        6,
+        {"title": 'Elixir "gold"', "price": "20", "inventory_count": "1"},
+    )
+
+
+def test_validate_product():
+    assert validate_product(
+        {"id": "", "title": "Potion", "price": "1.5", "inventory_count": "3"}
+    ) == (None, {"title": "Potion", "price": 1.5, "inventory_count": 3})
+    for row, message in [
+        ({"title": "", "price": 1, "inventory_count": 1}, "title is required"),
+        ({"title": "a", "price": "a", "inventory_count": 1}, "price must be a number"),
+        ({"title": "a", "price": -1, "inventory_count": 1}, "non-negative"),
+        ({"title": "a", "price": 1, "inventory_count": 1.5}, "inventory_count must"),
+        ({"title": "a", "price": 1, "inventory_count": True}, "inventory_count must"),
+        ({"title": "a", "price": 1, "inventory_count": 1, "size": 1}, "unknown"),
+    ]:
+        with pytest.raises(InvalidRow, match=message):
+            validate_product(row)
+
+
+@pytest.fixture
+def admin_jwt(user_jwt, initial_user, monkeypatch):
+    monkeypatch.setattr(authentication_backend, "admins", {initial_user.username})
+    yield user_jwt
+
+
+def test_import_requires_admin(client: StarletteGraphQlClient, user_jwt):
+    response = client.client.post("/products/import", data="")
+    assert response.status_code == 401
+    response = client.client.post(
+        "/products/import",
+        data="",
+        headers={"Authorization": f"Bearer {user_jwt}", "Content-Type": "text/csv"},
+    )
+    assert response.status_code == 403
+
+
+def test_import_products(
+    client: StarletteGraphQlClient, admin_jwt, test_database, monkeypatch
+):
+    monkeypatch.setattr(endpoints, "IMPORT_BATCH_SIZE", 2)
+    headers = {"Authorization": f"Bearer {admin_jwt}"}
+    data = "\n".join(
+        [
+            json.dumps({"title": "Potion", "price": 10, "inventory_count": 3}),
+            json.dumps({"title": "Ether", "price": 20, "inventory_count": 0}),
+            "not json",
+            json.dumps({"title": "Elixir", "price": 30, "inventory_count": 1}),
+        ]
+    )
+    response = client.client.post(
+        "/products/import",
+        data=data,
+        headers={**headers, "Content-Type": "application/x-ndjson"},
+    )
+    assert response.status_code == 200
+    reports = [json.loads(line) for line in response.text.splitlines()]
+    assert [report["rows"] for report in reports] == [2, 4]
+    assert reports[-1]["done"] is True
+    assert reports[-1]["inserted"] == 3
+    assert reports[-1]["errors"][0]["line"] == 3
+
+    # the csv export is imported back, updating the products
+    response = client.client.get("/products.csv")
+    assert response.headers["content-type"].startswith("text/csv")
+    lines = response.text.splitlines()
+    assert lines[0] == "id,title,price,inventory_count"
+    assert len(lines) == 4
+    data = response.text.replace("Potion", "Tonic")
+    response = client.client.post(
+        "/products/import", data=data, headers={**headers, "Content-Type": "text/csv"}
+    )
+    report = [json.loads(line) for line in response.text.splitlines()][-1]
+    assert (report["inserted"], report["updated"], report["invalid"]) == (0, 3, 0)
+    titles = sorted(product["title"] for product in test_database("products").all())
+    assert titles == ["Elixir", "Ether", "Tonic"]
+
+    # a product repeated in the file, even in different batches, is counted once
+    monkeypatch.setattr(endpoints, "IMPORT_BATCH_SIZE", 1)
+    data = "\n".join([lines[0], lines[1], lines[1]])
+    response = client.client.post(
+        "/products/import", data=data, headers={**headers, "Content-Type": "text/csv"}
+    )
+    report = [json.loads(line) for line in response.text.splitlines()][-1]
+    assert (report["rows"], report["updated"]) == (2, 1)
+
+    response = client.client.post(
+        "/products/import",
+        data="title,price\n",
+        headers={**headers, "Content-Type": "text/csv"},
+    )
+    assert response.status_code == 400
+    assert response.text == "the header lacks inventory_count"
+
+
+def test_import_rebuilds_views(
+    client: StarletteGraphQlClient, admin_jwt, test_database, monkeypatch
+):
+    # the index is built before the import
+    client.execute('{ searchProducts(query: "potion") { edges { cursor } } }')
+    monkeypatch.setattr(product_search, "max_changes", 2)
+    data = "title,price,inventory_count\n" + "Potion,1,1\n" * 5
+    client.client.post(
+        "/products/import",
+        data=data,
+        headers={"Authorization": f"Bearer {admin_jwt}", "Content-Type": "text/csv"},
+    )
+    response = client.execute(
+        '{ searchProducts(query: "potion") { edges { cursor } } }'
+    )
+    assert len(response["data"]["searchProducts"]["edges"]) == 5
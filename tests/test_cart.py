@@ -2,6 +2,9 @@ import pytest
 import typing
 from tinydb.database import Document
 
+from akara.repositories.base import CartTable
+from akara.utils.storage import ConflictError
+
 from .conftest import StarletteGraphQlClient
 from .test_users import initial_user
 
@@ -204,3 +207,351 @@ def test_complete_cart(
     )
     # cart must be clear afterwards
     assert response == {"data": {"cart": None}, "errors": None}
+
+    response = client.execute("{ products(available: true) { id } }")
+    # the product ran out of stock
+    assert response == {"data": {"products": []}, "errors": None}
+
+
+def test_cart_with_several_products(
+    user_jwt: str, client: StarletteGraphQlClient, insert_product: typing.Callable
+):
+    productIds = [
+        insert_product(title="Test Product 1", price=10, inventory_count=2),
+        insert_product(title="Test Product 2", price=5, inventory_count=3),
+    ]
+    for productId, amount in zip(productIds, (2, 3)):
+        response = client.execute(
+            """
+            mutation($id: ID!, $amount: Int!) {
+                addToCart(productId: $id, amount: $amount) {
+                    price
+                }
+            }
+            """,
+            variables={"id": productId, "amount": amount},
+            headers={"Authorization": f"Bearer {user_jwt}"},
+        )
+        assert response.get("errors") == None
+
+    response = client.execute(
+        "{ cart { products { product { id } amount } price } }",
+        headers={"Authorization": f"Bearer {user_jwt}"},
+    )
+    assert response.get("data").get("cart").get("price") == 35
+    assert sorted(
+        (item["product"]["id"], item["amount"])
+        for item in response.get("data").get("cart").get("products")
+    ) == sorted(zip(productIds, (2, 3)))
+
+
+def test_complete_cart_out_of_stock(
+    user_jwt: str,
+    client: StarletteGraphQlClient,
+    insert_product: typing.Callable,
+    test_database: typing.Callable,
+):
+    productIds = [
+        insert_product(title="Test Product 1", price=10, inventory_count=2),
+        insert_product(title="Test Product 2", price=5, inventory_count=2),
+    ]
+    for productId in productIds:
+        response = client.execute(
+            """
+            mutation($id: ID!) {
+                addToCart(productId: $id, amount: 2) {
+                    price
+                }
+            }
+            """,
+            variables={"id": productId},
+            headers={"Authorization": f"Bearer {user_jwt}"},
+        )
+        assert response.get("errors") == None
+
+    # another worker sells one of the products in the meantime
+    test_database("products").update({"inventory_count": 1}, productIds[1:])
+
+    response = client.execute(
+        "mutation { completeCart { success charged } }",
+        headers={"Authorization": f"Bearer {user_jwt}"},
+    )
+    assert (
+        response.get("errors")[0].get("message")
+        == "there's not enougth availability to fullfil your order"
+    )
+
+    # nothing is bought and the cart is kept
+    response = client.execute(
+        "{ cart { price } }", headers={"Authorization": f"Bearer {user_jwt}"}
+    )
+    assert response == {"data": {"cart": {"price": 30}}, "errors": None}
+    response = client.execute("{ products { inventoryCount } }")
+    assert sorted(
+        product["inventoryCount"] for product in response["data"]["products"]
+    ) == [1, 2]
+
+
+def test_update_cart(
+    user_jwt: str, client: StarletteGraphQlClient, insert_product: typing.Callable
+):
+    productIds = [
+        insert_product(title="Test Product 1", price=10, inventory_count=5),
+        insert_product(title="Test Product 2", price=5, inventory_count=5),
+        insert_product(title="Test Product 3", price=1, inventory_count=5),
+    ]
+    update_cart = """
+        mutation($items: [CartItemInput!]!) {
+            updateCart(items: $items) {
+                products {
+                    product {
+                        id
+                    }
+                    amount
+                }
+                price
+            }
+        }
+    """
+
+    response = client.execute(
+        update_cart,
+        variables={
+            "items": [
+                {"productId": productIds[0], "amount": 2},
+                {"productId": productIds[1], "amount": 3},
+            ]
+        },
+        headers={"Authorization": f"Bearer {user_jwt}"},
+    )
+    assert response.get("errors") == None
+    assert response.get("data").get("updateCart").get("price") == 35
+
+    # amounts are replaced, products with amount 0 removed and the rest kept
+    response = client.execute(
+        update_cart,
+        variables={
+            "items": [
+                {"productId": productIds[0], "amount": 0},
+                {"productId": productIds[2], "amount": 4},
+            ]
+        },
+        headers={"Authorization": f"Bearer {user_jwt}"},
+    )
+    assert response.get("errors") == None
+    assert response.get("data").get("updateCart").get("price") == 19
+    assert sorted(
+        (item["product"]["id"], item["amount"])
+        for item in response.get("data").get("updateCart").get("products")
+    ) == sorted(zip(productIds[1:], (3, 4)))
+
+    response = client.execute(
+        update_cart,
+        variables={
+            "items": [
+                {"productId": productIds[1], "amount": 0},
+                {"productId": productIds[2], "amount": 0},
+            ]
+        },
+        headers={"Authorization": f"Bearer {user_jwt}"},
+    )
+    assert response == {"data": {"updateCart": None}, "errors": None}
+
+
+def test_update_cart_all_or_nothing(
+    user_jwt: str, client: StarletteGraphQlClient, insert_product: typing.Callable
+):
+    productIds = [
+        insert_product(title="Test Product 1", price=10, inventory_count=5),
+        insert_product(title="Test Product 2", price=5, inventory_count=1),
+    ]
+    update_cart = """
+        mutation($items: [CartItemInput!]!) {
+            updateCart(items: $items) {
+                price
+            }
+        }
+    """
+    invalid_items = [
+        # not enough stock
+        [
+            {"productId": productIds[0], "amount": 2},
+            {"productId": productIds[1], "amount": 2},
+        ],
+        # unknown product
+        [
+            {"productId": productIds[0], "amount": 2},
+            {"productId": "missing", "amount": 1},
+        ],
+        # negative amount
+        [
+            {"productId": productIds[0], "amount": 2},
+            {"productId": productIds[1], "amount": -1},
+        ],
+        # repeated product
+        [
+            {"productId": productIds[0], "amount": 2},
+            {"productId": productIds[0], "amount": 1},
+        ],
+    ]
+    for items in invalid_items:
+        response = client.execute(
+            update_cart,
+            variables={"items": items},
+            headers={"Authorization": f"Bearer {user_jwt}"},
+        )
+        assert response.get("data") == {"updateCart": None}
+        assert len(response.get("errors")) == 1
+
+    # nothing was added to the cart
+    response = client.execute(
+        "{ cart { price } }", headers={"Authorization": f"Bearer {user_jwt}"}
+    )
+    assert response == {"data": {"cart": None}, "errors": None}
+
+
+def test_cart_price_is_kept_up_to_date(
+    user_jwt: str,
+    client: StarletteGraphQlClient,
+    insert_product: typing.Callable,
+    test_database: typing.Callable,
+):
+    potion = insert_product(title="Potion", price=10, inventory_count=5)
+    ether = insert_product(title="Ether", price=2.5, inventory_count=5)
+    mutation = """
+        mutation($id: ID!, $amount: Int) {
+            addToCart(productId: $id, amount: $amount) { price }
+        }
+    """
+    headers = {"Authorization": f"Bearer {user_jwt}"}
+    client.execute(mutation, {"id": potion, "amount": 2}, headers=headers)
+    client.execute(mutation, {"id": ether, "amount": 4}, headers=headers)
+
+    # another worker raises the price of a product in the cart
+    products = test_database("products")
+    products.update({"price": 12}, [potion])
+    response = client.execute("{ cart { price } }", headers=headers)
+    assert response == {"data": {"cart": {"price": 34}}, "errors": None}
+
+    # the price of the cart doesn't need its products
+    products.purge()
+    response = client.execute("{ cart { price } }", headers=headers)
+    assert response == {"data": {"cart": {"price": 34}}, "errors": None}
+
+    (cart,) = test_database("carts").all()
+    assert cart["lines"] == 2
+
+
+def test_concurrent_adds_to_cart(
+    user_jwt: str,
+    client: StarletteGraphQlClient,
+    insert_product: typing.Callable,
+    test_database: typing.Callable,
+):
+    products = [
+        insert_product(title=f"Potion {number}", price=1, inventory_count=10)
+        for number in range(5)
+    ]
+    mutation = "mutation($id: ID!) { addToCart(productId: $id) { price } }"
+    # the operations of a batch run concurrently, each in its own session
+    batch = [
+        {"query": mutation, "variables": {"id": products[number % 5]}}
+        for number in range(20)
+    ]
+    headers = {"Authorization": f"Bearer {user_jwt}"}
+    response = client.client.post("/query", json=batch, headers=headers)
+    assert all(result["errors"] is None for result in response.json())
+
+    items = test_database("cart_items").all()
+    assert sorted(item["product"] for item in items) == sorted(products)
+    assert [item["amount"] for item in items] == [4] * 5
+    (cart,) = test_database("carts").all()
+    assert (cart["lines"], cart["price"]) == (5, 20)
+
+
+def test_cart_changes_are_retried_on_conflict(
+    user_jwt: str,
+    client: StarletteGraphQlClient,
+    insert_product: typing.Callable,
+    test_database: typing.Callable,
+    monkeypatch,
+):
+    product = insert_product(title="Potion", price=1, inventory_count=10)
+    add = CartTable.add
+    conflicts = []
+
+    async def conflicting_add(self, *args):
+        # another request changes the cart before the first attempt commits
+        if not conflicts:
+            conflicts.append(args)
+            raise ConflictError()
+        return await add(self, *args)
+
+    monkeypatch.setattr(CartTable, "add", conflicting_add)
+    response = client.execute(
+        "mutation($id: ID!) { addToCart(productId: $id, amount: 2) { price } }",
+        variables={"id": product},
+        headers={"Authorization": f"Bearer {user_jwt}"},
+    )
+    assert response == {"data": {"addToCart": {"price": 2}}, "errors": None}
+    assert len(conflicts) == 1
+    # nothing of the attempt that conflicted was kept
+    (item,) = test_database("cart_items").all()
+    assert item["amount"] == 2
+
+
+def test_cart_without_summary(
+    user_jwt: str,
+    initial_user,
+    client: StarletteGraphQlClient,
+    insert_product: typing.Callable,
+    test_database: typing.Callable,
+):
+    potion = insert_product(title="Potion", price=10, inventory_count=5)
+    ether = insert_product(title="Ether", price=2.5, inventory_count=5)
+    # a cart filled before the summaries were kept
+    test_database("cart_items").insert_multiple(
+        [
+            {"user": initial_user.id, "product": potion, "amount": 1},
+            {"user": initial_user.id, "product": ether, "amount": 2},
+        ]
+    )
+    headers = {"Authorization": f"Bearer {user_jwt}"}
+    response = client.execute(
+        """
+        mutation($id: ID!) {
+            addToCart(productId: $id) { price }
+        }
+        """,
+        {"id": potion},
+        headers=headers,
+    )
+    assert response == {"data": {"addToCart": {"price": 25}}, "errors": None}
+
+    (cart,) = test_database("carts").all()
+    assert cart["lines"] == 2
+
+
+def test_cart_products_are_loaded_lazily(
+    user_jwt: str,
+    client: StarletteGraphQlClient,
+    insert_product: typing.Callable,
+    test_database: typing.Callable,
+):
+    potion = insert_product(title="Potion", price=10, inventory_count=5)
+    headers = {"Authorization": f"Bearer {user_jwt}"}
+    client.execute(
+        "mutation($id: ID!) { addToCart(productId: $id, amount: 2) { price } }",
+        {"id": potion},
+        headers=headers,
+    )
+    query = "{ cart { products { amount product { id } } } }"
+    expected = {"products": [{"amount": 2, "product": {"id": potion}}]}
+
+    response = client.execute(query, headers=headers)
+    assert response == {"data": {"cart": expected}, "errors": None}
+
+    # products whose fields are not requested are not read at all
+    test_database("products").purge()
+    response = client.execute(query, headers=headers)
+    assert response == {"data": {"cart": expected}, "errors": None}
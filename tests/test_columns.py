@@ -0,0 +1,93 @@
+from tinydb.database import Document
+
+from akara.utils.columns import ProductColumns
+
+from .conftest import StarletteGraphQlClient
+
+
+def product(doc_id: str, title: str, price: float = None, count: int = None):
+    return Document(
+        {"title": title, "price": price, "inventory_count": count}, doc_id=doc_id
+    )
+
+
+def test_product_columns():
+    columns = ProductColumns(
+        [
+            product("a", "Potion", 10, 3),
+            product("b", "Ether", 20.5, 0),
+            product("c", "Elixir", None, 8),
+            product("d", "Scroll", 5, None),
+        ]
+    )
+    assert columns.document(2) == {
+        "title": "Elixir",
+        "price": None,
+        "inventory_count": 8,
+    }
+    assert columns.document(2).doc_id == "c"
+
+    assert columns.rows() == [0, 1, 2, 3]
+    assert columns.rows(available=True) == [0, 2]
+    # products without price never pass the price filters
+    assert columns.rows(min_price=5, max_price=10) == [0, 3]
+    assert columns.rows(available=True, max_price=15) == [0]
+
+    # the elixir has no price and the scroll no inventory count
+    assert columns.total_inventory_value() == 30
+    assert columns.low_stock(3) == 1
+    assert columns.low_stock(10) == 2
+    assert columns.low_stock(0) == 0
+
+    columns.set("b", product("b", "Ether", 20.5, 2))
+    columns.set("e", product("e", "Tent", 100, 1))
+    columns.remove_many(["a", "c", "not existent"])
+    assert [columns.ids[row] for row in columns.rows()] == ["b", "d", "e"]
+    assert [columns.ids[row] for row in columns.rows(available=True)] == ["b", "e"]
+    assert columns.total_inventory_value() == 141
+    assert len(columns) == 3 and "a" not in columns
+
+    # prices changed after sorting them are taken into account
+    assert [columns.ids[row] for row in columns.rows(min_price=20)] == ["b", "e"]
+    columns.set("d", product("d", "Scroll", 50, None))
+    columns.set("e", product("e", "Tent", None, 1))
+    assert [columns.ids[row] for row in columns.rows(min_price=20)] == ["b", "d"]
+
+    # once more than half the rows are empty the columns are compacted
+    columns.remove_many(["b"])
+    assert columns.ids == ["d", "e"]
+    assert columns.rows() == [0, 1]
+    assert columns.rows(max_price=50) == [0]
+
+
+def test_catalog_stats(client: StarletteGraphQlClient, test_database):
+    products = test_database("products")
+    potion, _ = products.insert_multiple(
+        [
+            {"title": "Potion", "price": 10, "inventory_count": 3},
+            {"title": "Ether", "price": 20, "inventory_count": 10},
+        ]
+    )
+    query = """
+        {
+            catalogStats { totalInventoryValue lowStock }
+            products(minPrice: 15) { title }
+        }
+    """
+    assert client.execute(query) == {
+        "data": {
+            "catalogStats": {"totalInventoryValue": 230, "lowStock": 1},
+            "products": [{"title": "Ether"}],
+        },
+        "errors": None,
+    }
+
+    # changes made by other workers are taken into account
+    products.update({"inventory_count": 0}, [potion])
+    response = client.execute(
+        "{ catalogStats { totalInventoryValue lowStock(threshold: 10) } }"
+    )
+    assert response["data"]["catalogStats"] == {
+        "totalInventoryValue": 200,
+        "lowStock": 1,
+    }
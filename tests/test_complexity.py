@@ -0,0 +1,141 @@
+from datetime import datetime, timedelta
+
+import jwt
+from graphql import parse
+
+from akara.app import graphql_app
+from akara.models import estimate_list_size, schema
+from akara.utils import complexity
+from akara.utils.complexity import DEFAULT_LIST_SIZE, CostBudget, operation_cost
+from config.settings import JWT_ALGORITHM, SECRET_KEY
+
+from .conftest import StarletteGraphQlClient
+
+
+def cost(query: str, catalog_size: int = 100, **kwargs) -> tuple:
+    def estimate(field: str, arguments: dict):
+        return estimate_list_size(field, arguments, lambda table: catalog_size)
+
+    return operation_cost(schema, parse(query), estimate=estimate, **kwargs)
+
+
+def test_operation_cost():
+    assert cost("{ products { id title } }") == (201, 2)
+    # every alias counts
+    assert cost("{ a: products { id } b: products { id } }") == (202, 2)
+    assert cost("{ products { id } }", catalog_size=1000) == (1001, 2)
+
+    # pages are bounded by their size
+    assert cost("{ productsConnection(first: 5) { edges { node { id } } } }") == (
+        16,
+        4,
+    )
+    assert cost(
+        "query($first: Int) { productsConnection(first: $first) { edges { cursor } } }",
+        variables={"first": 20},
+    ) == (41, 3)
+
+    # lists without estimation take the default size
+    assert cost("{ cart { products { amount } } }") == (1 + 1 + DEFAULT_LIST_SIZE, 3)
+    assert cost("mutation { completeCart { charged success } }") == (3, 2)
+
+
+def test_operation_cost_fragments():
+    query = """
+        query Catalog { ...Products }
+        query Other { user { id } }
+        fragment Products on Query {
+            products { ... on Product { id title } }
+        }
+    """
+    assert cost(query, operation_name="Catalog") == (201, 2)
+    assert cost(query, operation_name="Other") == (2, 2)
+    # introspection is free
+    assert cost("{ __schema { types { name fields { name } } } }") == (0, 0)
+
+    # every fragment is visited once however many times it's spread
+    fragments = ["fragment F0 on Query { products { id } }"] + [
+        f"fragment F{level} on Query {{ ...F{level - 1} ...F{level - 1} }}"
+        for level in range(1, 40)
+    ]
+    query = "\n".join(["{ ...F39 }"] + fragments)
+    assert cost(query) == (2**39 * 101, 2)
+
+
+def test_cost_budget(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(complexity.time, "monotonic", lambda: now[0])
+    budget = CostBudget(100, window=60)
+
+    assert budget.spend("a", 60) == 0
+    now[0] += 30
+    assert budget.spend("a", 30) == 0
+    # other clients have their own budget
+    assert budget.spend("b", 100) == 0
+
+    now[0] += 10
+    # the first operation leaves the window in 20 seconds
+    assert budget.spend("a", 20) == 20
+    assert budget.spent("a") == 90
+
+    now[0] += 20
+    assert budget.spend("a", 20) == 0
+    assert budget.spent("a") == 50
+
+
+def test_expensive_queries_are_rejected(client: StarletteGraphQlClient, monkeypatch):
+    monkeypatch.setattr(graphql_app, "max_cost", 100)
+    monkeypatch.setattr(graphql_app, "max_depth", 3)
+    aliases = " ".join(
+        f"p{number}: product(id: {number}) {{ id }}" for number in range(60)
+    )
+
+    response = client.execute("{ " + aliases + " }")
+    assert response == {
+        "data": None,
+        "errors": [{"message": "query cost 120 exceeds the maximum of 100"}],
+    }
+
+    response = client.execute(
+        "{ productsConnection { edges { node { id } } pageInfo { endCursor } } }"
+    )
+    assert response == {
+        "data": None,
+        "errors": [{"message": "query depth 4 exceeds the maximum of 3"}],
+    }
+
+    response = client.execute("{ productsConnection { pageInfo { endCursor } } }")
+    assert response["errors"] is None
+
+
+def test_cost_budget_per_token(client: StarletteGraphQlClient, monkeypatch):
+    monkeypatch.setattr(graphql_app, "cost_budget", CostBudget(10, window=60))
+    query = """
+        query($id: ID!) {
+            a: product(id: $id) { id title price }
+            b: product(id: $id) { id }
+        }
+    """
+
+    assert client.execute(query, {"id": "1"})["errors"] is None
+    # cached responses don't cost anything, so the request must be different
+    response = client.client.request(
+        "POST", "/query", json={"query": query, "variables": {"id": "2"}}
+    )
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) > 0
+    assert response.json()["errors"][0]["message"].startswith(
+        "query cost budget exhausted"
+    )
+
+    # other tokens have their own budget
+    expires = datetime.utcnow() + timedelta(days=1)
+    token = jwt.encode(
+        {"id": "1", "username": "test", "exp": expires},
+        key=SECRET_KEY,
+        algorithm=JWT_ALGORITHM,
+    ).decode()
+    response = client.execute(
+        query, {"id": "2"}, headers={"Authorization": f"Bearer {token}"}
+    )
+    assert response["errors"] is None
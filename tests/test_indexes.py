@@ -0,0 +1,78 @@
+import pytest
+from aiotinydb import AIOTinyDB
+
+from akara.utils.database import Q
+from akara.utils.indexes import HashIndex, SortedIndex
+from akara.utils.storage import WriteAheadLogStorage
+
+from .conftest import run
+
+
+@pytest.fixture
+def database(tmp_path):
+    yield AIOTinyDB(storage=WriteAheadLogStorage(str(tmp_path / "data.json")))
+
+
+def test_hash_index_lookup():
+    index = HashIndex("user")
+    index.build({"a": {"user": 1}, "b": {"user": 2}, "c": {"user": [1]}, "d": {}})
+
+    # unhashable values are always candidates
+    assert index.lookup(("==", ("user",), 1)) == ["a", "c"]
+    assert index.lookup(("==", ("user",), 3)) == ["c"]
+    assert index.lookup((">", ("user",), 1)) is None
+
+    index.update("a", {"user": 1}, {"user": 2})
+    index.update("c", {"user": [1]}, None)
+    assert index.lookup(("==", ("user",), 2)) == ["b", "a"]
+
+
+def test_sorted_index_lookup():
+    index = SortedIndex("price")
+    index.build(
+        {
+            "a": {"price": 10},
+            "b": {"price": 5.5},
+            "c": {"price": 10},
+            "d": {"price": None},
+        }
+    )
+
+    assert index.lookup((">", ("price",), 5.5)) == ["a", "c", "d"]
+    assert index.lookup(("<=", ("price",), 10)) == ["b", "a", "c", "d"]
+    assert index.lookup(("==", ("price",), 10)) == ["a", "c", "d"]
+    assert index.lookup(("<", ("price",), 5.5)) == ["d"]
+    assert index.lookup(("!=", ("price",), 5.5)) is None
+
+    index.update("a", {"price": 10}, {"price": 1})
+    index.update("d", {"price": None}, {"price": 7})
+    assert index.lookup((">=", ("price",), 0)) == ["a", "b", "d", "c"]
+
+
+def test_indexed_queries(database: AIOTinyDB):
+    async def scenario():
+        async with database as db:
+            cart_items = db.table("cart_items")
+            cart_items.insert_multiple(
+                [
+                    {"user": "a", "product": "x", "amount": 1},
+                    {"user": "a", "product": "y", "amount": 2},
+                    {"user": "b", "product": "x", "amount": 3},
+                ]
+            )
+            # the index narrows the candidates to the documents of the user
+            assert len(cart_items._lookup((Q.user == "a").hashval)) == 2
+
+            item = cart_items.get((Q.user == "a") & (Q.product == "y"))
+            item["user"] = "b"
+            cart_items.write_back([item])
+            cart_items.remove(Q.user == "a")
+
+        async with database as db:
+            cart_items = db.table("cart_items")
+            return (
+                cart_items.search(Q.user == "a"),
+                sorted(item["amount"] for item in cart_items.search(Q.user == "b")),
+            )
+
+    assert run(scenario()) == ([], [2, 3])
@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+
+from akara.repositories import TinyDbRepository
+from akara.utils.database import TransactionalTinyDB
+from akara.utils.loaders import DocumentLoader
+from akara.utils.storage import WriteAheadLogStorage
+
+from .conftest import CountingRepository, run
+
+
+@pytest.fixture
+def database(tmp_path):
+    storage = WriteAheadLogStorage(str(tmp_path / "data.json"))
+    database = TinyDbRepository(TransactionalTinyDB(storage=storage))
+
+    async def insert():
+        async with database.session(write=True) as session:
+            return await session.products.insert_many(
+                [{"title": "Potion"}, {"title": "Scroll"}]
+            )
+
+    yield CountingRepository(database), run(insert())
+
+
+def test_loads_in_a_single_batch(database):
+    database, ids = database
+    loader = DocumentLoader(database, "products")
+
+    async def load():
+        return await asyncio.gather(
+            loader.load(ids[0]),
+            loader.load_many([ids[1], ids[0], "not existent"]),
+        )
+
+    first, many = run(load())
+    assert first == {"title": "Potion"}
+    assert many == [{"title": "Scroll"}, {"title": "Potion"}, None]
+    assert database.opened == 1
+
+
+def test_caches_loaded_documents(database):
+    database, ids = database
+    loader = DocumentLoader(database, "products")
+
+    async def load():
+        await loader.load(ids[0])
+        loader.prime(ids[1], {"title": "Primed"})
+        return await loader.load_many(ids)
+
+    assert run(load()) == [{"title": "Potion"}, {"title": "Primed"}]
+    assert database.opened == 1
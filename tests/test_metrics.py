@@ -0,0 +1,84 @@
+import logging
+
+from starlette.responses import PlainTextResponse
+from starlette.testclient import TestClient
+
+from akara.app import graphql_app
+from akara.utils.metrics import (
+    DOCUMENTS_SCANNED,
+    Histogram,
+    MetricsMiddleware,
+    get_metrics,
+)
+
+from .conftest import StarletteGraphQlClient
+
+
+def test_metrics_endpoint(client: StarletteGraphQlClient, test_database, monkeypatch):
+    products = test_database("products")
+    for title in ("Potion", "Ether"):
+        products.insert({"title": title, "price": 1, "inventory_count": 1})
+    monkeypatch.setattr(graphql_app, "measured_operations", {"Catalog"})
+
+    scanned = DOCUMENTS_SCANNED._values.get((), [[], 0])[1]
+    response = client.execute("query Catalog { products { title } }")
+    assert len(response["data"]["products"]) == 2
+    client.execute("query Whatever { products { title } }")
+
+    text = client.client.get("/metrics").text
+    assert 'graphql_resolver_duration_seconds_count{field="Query.products"}' in text
+    assert 'graphql_operation_duration_seconds_count{operation="Catalog"}' in text
+    # names not measured on their own don't add labels
+    assert 'graphql_operation_duration_seconds_count{operation="other"}' in text
+    assert "Whatever" not in text
+    assert 'request_phase_duration_seconds_count{phase="storage"}' in text
+    assert "storage_opens_per_request_bucket" in text
+    # both products were read
+    assert DOCUMENTS_SCANNED._values[()][1] == scanned + 2
+
+
+def test_request_latency_by_route(client: StarletteGraphQlClient):
+    client.client.get("/products.csv")
+    client.client.get("/products.json")
+    client.client.get("/not/a/route")
+
+    text = client.client.get("/metrics").text
+    assert 'http_request_duration_seconds_count{path="/products.{format}"}' in text
+    assert 'http_request_duration_seconds_count{path="other"}' in text
+    assert "/products.csv" not in text
+    assert "/not/a/route" not in text
+
+
+def test_histogram_format():
+    histogram = Histogram("latency", "Latency", ["path"], buckets=(0.1, 1))
+    histogram.observe(0.05, "/query")
+    histogram.observe(0.5, "/query")
+    histogram.observe(5, "/query")
+    assert list(histogram.samples()) == [
+        'latency_bucket{path="/query",le="0.1"} 1',
+        'latency_bucket{path="/query",le="1"} 2',
+        'latency_bucket{path="/query",le="+Inf"} 3',
+        'latency_sum{path="/query"} 5.55',
+        'latency_count{path="/query"} 3',
+    ]
+
+
+def test_slow_query_log(caplog):
+    def app(scope):
+        async def asgi(receive, send):
+            get_metrics(scope).storage_opens += 3
+            await PlainTextResponse("ok")(receive, send)
+
+        return asgi
+
+    client = TestClient(MetricsMiddleware(app, slow_threshold=0))
+    with caplog.at_level(logging.WARNING, logger="akara.slow_queries"):
+        client.get("/slow")
+    assert "slow request /slow" in caplog.text
+    assert "storage_opens=3" in caplog.text
+
+    caplog.clear()
+    client = TestClient(MetricsMiddleware(app, slow_threshold=0, slow_sample_rate=0))
+    with caplog.at_level(logging.WARNING, logger="akara.slow_queries"):
+        client.get("/slow")
+    assert not caplog.text
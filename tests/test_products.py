@@ -1,3 +1,5 @@
+import json
+
 import pytest
 from .conftest import StarletteGraphQlClient
 
@@ -63,3 +65,43 @@ def test_obtain_by_id_not_existent(client: StarletteGraphQlClient):
         variables={"id": "not existent"},
     )
     assert response == {"data": {"product": None}, "errors": None}
+
+
+def test_products_connection(client: StarletteGraphQlClient, initial_products):
+    query = """
+        query($after: String) {
+            productsConnection(first: 2, after: $after) {
+                edges {
+                    cursor
+                    node { id title }
+                }
+                pageInfo { hasNextPage endCursor }
+            }
+        }
+    """
+    response = client.execute(query)
+    page = response.get("data").get("productsConnection")
+    assert len(page["edges"]) == 2
+    assert page["pageInfo"]["hasNextPage"] == True
+    assert page["pageInfo"]["endCursor"] == page["edges"][-1]["cursor"]
+
+    response = client.execute(query, variables={"after": page["pageInfo"]["endCursor"]})
+    next_page = response.get("data").get("productsConnection")
+    assert len(next_page["edges"]) == 1
+    assert next_page["pageInfo"]["hasNextPage"] == False
+
+    ids = [edge["node"]["id"] for edge in page["edges"] + next_page["edges"]]
+    assert ids == sorted(ids)
+    titles = {edge["node"]["title"] for edge in page["edges"] + next_page["edges"]}
+    assert titles == {"Test Product 1", "Test Product 2", "Test Product 3"}
+
+
+def test_export_products(client: StarletteGraphQlClient, initial_products):
+    response = client.client.get("/products.ndjson", params={"available": "true"})
+    assert response.headers["content-type"] == "application/x-ndjson"
+
+    products = [json.loads(line) for line in response.text.splitlines()]
+    assert sorted(product["inventory_count"] for product in products) == [5, 10]
+    assert [product["id"] for product in products] == sorted(
+        product["id"] for product in products
+    )
@@ -0,0 +1,172 @@
+import hashlib
+
+import pytest
+
+from akara.app import database_middleware, graphql_app
+
+from .conftest import CountingRepository, StarletteGraphQlClient
+
+QUERY = "{ products { id } }"
+HASH = hashlib.sha256(QUERY.encode()).hexdigest()
+
+
+def persisted_query(client: StarletteGraphQlClient, sha256: str, query: str = None):
+    body = {"extensions": {"persistedQuery": {"version": 1, "sha256Hash": sha256}}}
+    if query is not None:
+        body["query"] = query
+    return client.client.request("POST", "/query", json=body).json()
+
+
+def test_persisted_query_registration(
+    client: StarletteGraphQlClient, test_database, backend: str
+):
+    # registered queries are kept across tests, so every backend needs its own
+    query = f"{{ {backend}: products {{ title }} }}"
+    fresh = hashlib.sha256(query.encode()).hexdigest()
+    response = persisted_query(client, fresh)
+    assert response["errors"][0]["message"] == "PersistedQueryNotFound"
+
+    response = persisted_query(client, fresh, query)
+    assert response == {"data": {backend: []}, "errors": None}
+    # now the hash is enough
+    response = persisted_query(client, fresh)
+    assert response == {"data": {backend: []}, "errors": None}
+
+
+def test_persisted_query_hash_mismatch(client: StarletteGraphQlClient):
+    response = persisted_query(client, HASH, "{ products { title } }")
+    assert response["errors"][0]["message"] == "provided sha does not match query"
+
+
+def test_invalid_extensions(client: StarletteGraphQlClient):
+    # also when sent as json in a string, like in the query string of a GET
+    for extensions in (["persistedQuery"], "[1]"):
+        response = client.client.post(
+            "/query", json={"query": QUERY, "extensions": extensions}
+        )
+        assert response.status_code == 400
+        assert response.json()["errors"][0]["message"] == "extensions must be an object"
+
+
+def test_queries_are_parsed_once(client: StarletteGraphQlClient, test_database):
+    backend = graphql_app.backend
+    client.execute(QUERY)
+    document = backend.get(HASH)
+    assert document is not None
+
+    misses = backend.documents.misses
+    assert client.execute(QUERY) == {"data": {"products": []}, "errors": None}
+    assert backend.get(HASH) is document
+    assert backend.documents.misses == misses
+
+
+def test_invalid_queries_are_not_registered(client: StarletteGraphQlClient):
+    response = client.execute("{ products { unknown } }")
+    assert response["errors"]
+    assert (
+        client.client.app.routes[0].app.backend.get(
+            hashlib.sha256(b"{ products { unknown } }").hexdigest()
+        )
+        is None
+    )
+
+
+def test_syntax_errors(client: StarletteGraphQlClient):
+    response = client.execute("{ products { id }")
+    assert response["data"] is None
+    assert response["errors"]
+
+
+def test_anonymous_responses_are_cached(client: StarletteGraphQlClient, test_database):
+    products = test_database("products")
+    first = products.insert({"title": "Potion", "price": 10, "inventory_count": 1})
+    second = products.insert({"title": "Ether", "price": 20, "inventory_count": 1})
+    query = "query($id: ID!) { product(id: $id) { title inventoryCount } }"
+
+    def product(doc_id, **kwargs):
+        body = {"query": query, "variables": {"id": doc_id}}
+        return client.client.request("POST", "/query", json=body, **kwargs)
+
+    etags = {doc_id: product(doc_id).headers["ETag"] for doc_id in (first, second)}
+    hits = graphql_app.responses.hits
+    response = product(first)
+    assert response.json()["data"]["product"]["title"] == "Potion"
+    assert graphql_app.responses.hits == hits + 1
+
+    response = product(first, headers={"If-None-Match": etags[first]})
+    assert response.status_code == 304
+
+    # another worker sells the second product, only its responses are dropped
+    products.update({"inventory_count": 0}, [second])
+    response = product(second, headers={"If-None-Match": etags[second]})
+    assert response.status_code == 200
+    assert response.json()["data"]["product"]["inventoryCount"] == 0
+    response = product(first, headers={"If-None-Match": etags[first]})
+    assert response.status_code == 304
+
+
+def test_cache_hits_open_no_session(
+    client: StarletteGraphQlClient, test_database, monkeypatch
+):
+    doc_id = test_database("products").insert(
+        {"title": "Potion", "price": 10, "inventory_count": 1}
+    )
+    body = {"query": "query($id: ID!) { product(id: $id) { title } }"}
+    body["variables"] = {"id": doc_id}
+    client.client.request("POST", "/query", json=body)
+
+    repository = CountingRepository(database_middleware.repository)
+    monkeypatch.setattr(database_middleware, "repository", repository)
+    hits = graphql_app.responses.hits
+    response = client.client.request("POST", "/query", json=body)
+    assert response.json()["data"]["product"]["title"] == "Potion"
+    assert graphql_app.responses.hits == hits + 1
+    # what other workers changed is known without a session
+    assert repository.opened == 0
+
+
+def test_authenticated_responses_are_not_cached(client: StarletteGraphQlClient):
+    response = client.client.request(
+        "POST",
+        "/query",
+        json={"query": "{ products { id } }"},
+        headers={"Authorization": "Bearer token"},
+    )
+    assert "ETag" not in response.headers
+
+
+def test_batched_operations(client: StarletteGraphQlClient, test_database, monkeypatch):
+    doc_id = test_database("products").insert(
+        {"title": "Potion", "price": 10, "inventory_count": 1}
+    )
+    repository = CountingRepository(database_middleware.repository)
+    monkeypatch.setattr(database_middleware, "repository", repository)
+
+    query = "query($id: ID!) { product(id: $id) { title } }"
+    batch = [
+        {"query": query, "variables": {"id": doc_id}},
+        {"query": "{ products { unknown } }"},
+        {"query": query, "variables": {"id": doc_id}},
+        {"variables": {}},
+    ]
+    response = client.client.request("POST", "/query", json=batch)
+    assert response.status_code == 200
+    first, invalid, second, empty = response.json()
+    assert first == second == {"data": {"product": {"title": "Potion"}}, "errors": None}
+    assert invalid["errors"]
+    assert empty == {
+        "data": None,
+        "errors": [{"message": "No GraphQL query found in the request"}],
+    }
+    # catching up with other workers needs no session, only loading the product
+    assert repository.opened == 1
+
+
+def test_batch_limits(client: StarletteGraphQlClient, monkeypatch):
+    response = client.client.request("POST", "/query", json=[])
+    assert response.status_code == 400
+
+    monkeypatch.setattr(graphql_app, "max_batch_size", 1)
+    batch = [{"query": "{ products { id } }"}] * 2
+    response = client.client.request("POST", "/query", json=batch)
+    assert response.status_code == 400
@@ -0,0 +1,268 @@
+import asyncio
+
+import pytest
+
+from akara.app import database_middleware
+from akara.repositories import RequestRepository, SqliteRepository, TinyDbRepository
+from akara.repositories.base import MeasuredRepository
+from akara.utils.database import TransactionalTinyDB
+from akara.utils.metrics import RequestMetrics
+from akara.utils.storage import ConflictError, WriteAheadLogStorage
+
+from .conftest import run
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "data.db")
+
+
+def test_sqlite_sessions_are_transactions(path):
+    repository = SqliteRepository(path)
+
+    async def fail():
+        async with repository.session(write=True) as session:
+            await session.products.insert({"title": "Potion", "inventory_count": 1})
+            raise ValueError()
+
+    async def count():
+        async with repository.session() as session:
+            return await session.products.count()
+
+    with pytest.raises(ValueError):
+        run(fail())
+    assert run(count()) == 0
+
+
+def test_sqlite_queries(path):
+    repository = SqliteRepository(path)
+
+    async def queries():
+        async with repository.session(write=True) as session:
+            ids = await session.products.insert_many(
+                [
+                    {"title": "Potion", "price": 10, "inventory_count": 1},
+                    {"title": "Ether", "price": 20, "inventory_count": 0},
+                    {"title": "Elixir", "price": 30, "inventory_count": 5},
+                ]
+            )
+            await session.cart_items.insert(
+                {"user": "someone", "product": ids[0], "amount": 1}
+            )
+
+        async with repository.session() as session:
+            available = await session.products.search(available=True)
+            page = await session.products.page(after=min(ids), limit=1)
+            many = await session.products.get_many([ids[2], "not existent"])
+            item = await session.cart_items.get_item("someone", ids[0])
+            titles = await session.products.search(fields=["title"])
+            return ids, available, page, many, item, titles
+
+    ids, available, page, many, item, titles = run(queries())
+    assert [product["title"] for product in available] == ["Potion", "Elixir"]
+    assert [product.doc_id for product in page] == [sorted(ids)[1]]
+    assert many[0] == {"title": "Elixir", "price": 30, "inventory_count": 5}
+    assert many[0].doc_id == ids[2] and many[1] is None
+    assert item == {"user": "someone", "product": ids[0], "amount": 1}
+    # only the requested fields are read
+    assert titles == [{"title": "Potion"}, {"title": "Ether"}, {"title": "Elixir"}]
+
+
+def test_sqlite_pool_limits_connections(path):
+    repository = SqliteRepository(path, pool_size=1)
+    order = []
+
+    async def insert(title: str):
+        async with repository.session(write=True) as session:
+            order.append(title)
+            await session.products.insert({"title": title})
+            order.append(title)
+
+    async def insert_all():
+        await asyncio.gather(insert("Potion"), insert("Ether"))
+
+    run(insert_all())
+    # the second session waited for the connection of the first one
+    assert order == ["Potion", "Potion", "Ether", "Ether"]
+    assert repository.pool._opened == 1
+
+
+def test_sqlite_locked_database_conflicts(path):
+    worker = SqliteRepository(path)
+    other_worker = SqliteRepository(path, timeout=0.1)
+
+    async def write():
+        async with worker.session(write=True) as session:
+            await session.products.insert({"title": "Potion"})
+            # another worker tries to write while this one holds the lock
+            with pytest.raises(ConflictError):
+                async with other_worker.session(write=True) as other:
+                    await other.products.insert({"title": "Ether"})
+
+            # but it can still read what was committed
+            async with other_worker.session() as other:
+                return await other.products.count()
+
+    assert run(write()) == 0
+
+
+def test_sqlite_notifies_changes(path):
+    repository = SqliteRepository(path)
+    other_worker = SqliteRepository(path)
+    changes = []
+    assert repository.subscribe(lambda table, doc_ids: changes.append((table, doc_ids)))
+
+    async def insert() -> str:
+        async with other_worker.session(write=True) as session:
+            return await session.products.insert({"title": "Potion"})
+
+    async def read() -> None:
+        async with repository.session():
+            pass
+
+    run(read())
+    # nothing is known of the changes made before the first session
+    assert changes == [(None, None)]
+
+    doc_id = run(insert())
+    run(read())
+    assert changes[1:] == [("products", [doc_id])]
+    run(read())
+    assert len(changes) == 2
+
+
+def test_request_sessions_share_a_snapshot(path):
+    repository = SqliteRepository(path)
+    other_worker = SqliteRepository(path)
+
+    async def insert(database, title: str) -> None:
+        async with database.session(write=True) as session:
+            await session.products.insert({"title": title})
+
+    async def count(database) -> int:
+        async with database.session() as session:
+            return await session.products.count()
+
+    async def request():
+        database = RequestRepository(repository)
+        counts = [await count(database)]
+        async with database.session() as first, database.session() as second:
+            assert first is second
+        # what other workers commit meanwhile isn't seen by the request
+        await insert(other_worker, "Potion")
+        counts.append(await count(database))
+        # but what it writes is
+        await insert(database, "Ether")
+        counts.append(await count(database))
+        await database.close()
+        return counts
+
+    assert run(request()) == [0, 0, 2]
+    # the write reused the connection of the snapshot
+    assert repository.pool._opened == 1
+
+
+def test_sessions_count_their_own_reads(test_database):
+    test_database("products").insert_multiple(
+        [{"title": title, "inventory_count": 1} for title in ("Potion", "Ether")]
+    )
+
+    async def read(
+        metrics: RequestMetrics, everything: bool, first_read: asyncio.Event
+    ) -> None:
+        database = MeasuredRepository(database_middleware.repository, metrics)
+        async with database.session() as session:
+            if everything:
+                await session.products.all()
+                first_read.set()
+            else:
+                # reads while the other session is open
+                await first_read.wait()
+                await session.products.page(limit=1)
+
+    async def requests():
+        # created in the loop that runs the test, as older versions of python
+        # bind events to the loop that is current when they're created
+        first_read = asyncio.Event()
+        await asyncio.gather(
+            read(everything, True, first_read), read(one, False, first_read)
+        )
+
+    everything, one = RequestMetrics(), RequestMetrics()
+    run(requests())
+    assert (everything.documents_scanned, one.documents_scanned) == (2, 1)
+
+
+def test_workers_summarize_a_cart_once(tmp_path):
+    path = str(tmp_path / "data.json")
+    # two processes with the same database
+    first, second = (
+        TinyDbRepository(TransactionalTinyDB(storage=WriteAheadLogStorage(path)))
+        for _ in range(2)
+    )
+
+    async def add(session, product: str) -> None:
+        # the summary is built from the items when the cart has none
+        (document,) = await session.products.get_many([product])
+        await session.cart_items.insert(
+            {"user": "someone", "product": product, "amount": 1}
+        )
+        await session.carts.add("someone", 1, document["price"])
+
+    async def concurrent_first_adds(potion: str, ether: str) -> None:
+        async with second.session(write=True) as session:
+            # the cart is empty for both when they read it
+            await session.carts.get_for_user("someone")
+            async with first.session(write=True) as other:
+                await add(other, potion)
+            await add(session, ether)
+
+    async def products():
+        async with first.session(write=True) as session:
+            return await session.products.insert_many(
+                [{"title": "Potion", "price": 10}, {"title": "Ether", "price": 5}]
+            )
+
+    async def retry(ether: str) -> list:
+        async with second.session(write=True) as session:
+            await add(session, ether)
+            return await session.carts.all()
+
+    potion, ether = run(products())
+    with pytest.raises(ConflictError):
+        run(concurrent_first_adds(potion, ether))
+    # once retried it finds the summary of the other
+    (summary,) = run(retry(ether))
+    assert (summary["lines"], summary["price"]) == (2, 15)
+
+
+def test_request_writes_with_a_single_connection(path):
+    repository = SqliteRepository(path, pool_size=1, timeout=1)
+
+    async def request():
+        database = RequestRepository(repository)
+        async with database.session() as session:
+            await session.products.count()
+        # the snapshot holds the only connection until the write starts
+        async with database.session(write=True) as session:
+            await session.products.insert({"title": "Potion"})
+        async with database.session() as session:
+            count = await session.products.count()
+        await database.close()
+        return count
+
+    assert run(request()) == 1
+
+
+def test_sqlite_pool_waits_for_a_connection_until_timeout(path):
+    repository = SqliteRepository(path, pool_size=1, timeout=0.1)
+
+    async def nested():
+        async with repository.session():
+            async with repository.session():
+                pass
+
+    with pytest.raises(ConflictError):
+        run(nested())
+    # the connection was given back, not to the session that gave up
+    assert len(repository.pool._idle) == 1
@@ -0,0 +1,78 @@
+from akara.utils.search import SearchIndex, tokenize
+
+from .conftest import StarletteGraphQlClient
+
+QUERY = """
+    query($query: String!, $first: Int, $after: String) {
+        searchProducts(query: $query, first: $first, after: $after) {
+            edges { node { id title } }
+            pageInfo { hasNextPage endCursor }
+        }
+    }
+"""
+
+
+def test_tokenize():
+    assert tokenize("Crème Brûlée, 2-pack") == ["creme", "brulee", "2", "pack"]
+
+
+def test_search_index():
+    index = SearchIndex()
+    index.add("1", "Potion of healing")
+    index.add("2", "Greater healing potion")
+    index.add("3", "Ether")
+
+    # every word must start a word of the title
+    assert index.search("heal") == ["1", "2"]
+    assert index.search("pot heal") == ["1", "2"]
+    assert index.search("potion ether") == []
+    assert index.search("") == []
+    # whole words rank higher than prefixes, and shorter titles higher too
+    index.add("4", "Potions")
+    assert index.search("potion") == ["1", "2", "4"]
+    assert index.search("ether") == ["3"]
+
+    index.add("3", "Elixir")
+    index.remove("1")
+    assert index.search("ether") == []
+    assert index.search("el") == ["3"]
+    assert index.search("potion") == ["2", "4"]
+
+
+def search(client: StarletteGraphQlClient, query: str, **variables) -> dict:
+    response = client.execute(QUERY, {"query": query, **variables})
+    assert response["errors"] is None
+    return response["data"]["searchProducts"]
+
+
+def test_search_products(client: StarletteGraphQlClient, test_database):
+    products = test_database("products")
+    potion, _, elixir = products.insert_multiple(
+        [
+            {"title": "Potion", "price": 10, "inventory_count": 1},
+            {"title": "Ether", "price": 20, "inventory_count": 0},
+            {"title": "Potion of elixirs", "price": 30, "inventory_count": 5},
+        ]
+    )
+
+    page = search(client, "po", first=1)
+    assert page["edges"] == [{"node": {"id": potion, "title": "Potion"}}]
+    assert page["pageInfo"] == {"hasNextPage": True, "endCursor": potion}
+
+    page = search(client, "po", first=1, after=potion)
+    assert [edge["node"]["id"] for edge in page["edges"]] == [elixir]
+    assert page["pageInfo"]["hasNextPage"] is False
+
+    # changes made by other workers are indexed before searching again
+    products.update({"title": "Elixir"}, [elixir])
+    assert [edge["node"]["id"] for edge in search(client, "po")["edges"]] == [potion]
+    assert search(client, "elixir")["edges"] == [
+        {"node": {"id": elixir, "title": "Elixir"}}
+    ]
+
+
+def test_search_products_unknown_cursor(client: StarletteGraphQlClient, test_database):
+    response = client.execute(QUERY, {"query": "potion", "after": "unknown"})
+    assert (
+        response["errors"][0]["message"] == "the cursor is not a result of the search"
+    )
@@ -0,0 +1,49 @@
+import graphene
+
+from akara.utils.selection import selected_fields
+
+
+class Node(graphene.ObjectType):
+    id = graphene.ID()
+    name = graphene.String()
+    children = graphene.List(lambda: Node)
+
+
+class Query(graphene.ObjectType):
+    node = graphene.Field(Node)
+
+    def resolve_node(self, info):
+        Query.selections.append(
+            (selected_fields(info), selected_fields(info, "children"))
+        )
+        return Node(id="1", name="root", children=[])
+
+
+schema = graphene.Schema(query=Query)
+
+
+def selections(query: str) -> list:
+    Query.selections = []
+    result = schema.execute(query)
+    assert not result.errors
+    return Query.selections
+
+
+def test_selected_fields():
+    assert selections("{ node { id children { name } } }") == [
+        ({"id", "children"}, {"name"})
+    ]
+    # aliases are resolved by name, and every field selected with the same name
+    # is merged
+    assert selections(
+        "{ node { first: children { id } second: children { name } } }"
+    ) == [({"children"}, {"id", "name"})]
+
+
+def test_selected_fields_in_fragments():
+    query = """
+        { node { ...Fields ... on Node { children { ...Children } } } }
+        fragment Fields on Node { name }
+        fragment Children on Node { id }
+    """
+    assert selections(query) == [({"name", "children"}, {"id"})]
@@ -0,0 +1,325 @@
+import asyncio
+import multiprocessing
+
+import pytest
+from aiotinydb import AIOTinyDB
+from tinydb import TinyDB
+
+from akara.utils.database import Q, TransactionalTinyDB
+from akara.utils.segments import SegmentStorage, SegmentTable, convert, read_segments
+from akara.utils.storage import ConflictError, WriteAheadLogStorage
+
+from .conftest import run
+
+
+@pytest.fixture
+def database_path(tmp_path):
+    yield str(tmp_path / "data.json")
+
+
+def test_changes_survive_restart(database_path: str):
+    async def write():
+        async with AIOTinyDB(storage=WriteAheadLogStorage(database_path)) as db:
+            products = db.table("products")
+            doc_id = products.insert({"title": "Potion", "inventory_count": 2})
+            product = products.get(doc_id=doc_id)
+            product["inventory_count"] -= 1
+            products.write_back([product])
+            return doc_id
+
+    async def read(doc_id):
+        async with AIOTinyDB(storage=WriteAheadLogStorage(database_path)) as db:
+            return db.table("products").get(doc_id=doc_id)
+
+    doc_id = run(write())
+    assert run(read(doc_id)) == {"title": "Potion", "inventory_count": 1}
+
+
+def test_read_documents_are_copies(database_path: str):
+    async def scenario():
+        async with AIOTinyDB(storage=WriteAheadLogStorage(database_path)) as db:
+            products = db.table("products")
+            doc_id = products.insert({"title": "Potion", "inventory_count": 2})
+            # modifying a document without writing it back must not change it
+            products.get(doc_id=doc_id)["inventory_count"] = 0
+            return products.get(doc_id=doc_id)
+
+    assert run(scenario()) == {"title": "Potion", "inventory_count": 2}
+
+
+def test_compaction_writes_plain_tinydb_file(database_path: str):
+    storage = WriteAheadLogStorage(database_path, compact_threshold=4)
+
+    async def write():
+        async with AIOTinyDB(storage=storage) as db:
+            users = db.table("users")
+            for username in ("a", "b", "c"):
+                users.insert({"username": username})
+        async with AIOTinyDB(storage=storage) as db:
+            db.table("users").remove(Q.username == "b")
+
+    run(write())
+    with TinyDB(database_path) as db:
+        assert sorted(doc["username"] for doc in db.table("users").all()) == [
+            "a",
+            "c",
+        ]
+
+
+def test_external_changes_are_loaded(database_path: str):
+    first = WriteAheadLogStorage(database_path)
+    second = WriteAheadLogStorage(database_path)
+
+    async def count(storage):
+        async with AIOTinyDB(storage=storage) as db:
+            return len(db.table("products"))
+
+    async def insert(storage):
+        async with AIOTinyDB(storage=storage) as db:
+            db.table("products").insert({"title": "Potion"})
+
+    assert run(count(first)) == 0
+    # records appended to the log by another worker
+    run(insert(second))
+    assert run(count(first)) == 1
+
+    # snapshot rewritten by someone unaware of the log
+    with TinyDB(database_path) as db:
+        db.purge_tables()
+    assert run(count(first)) == 0
+    assert run(count(second)) == 0
+
+
+def test_stale_documents_are_rejected(database_path: str):
+    first = WriteAheadLogStorage(database_path)
+    second = WriteAheadLogStorage(database_path)
+
+    async def create():
+        async with AIOTinyDB(storage=first) as db:
+            return db.table("products").insert(
+                {"title": "Potion", "inventory_count": 2}
+            )
+
+    async def read(storage, doc_id):
+        async with AIOTinyDB(storage=storage) as db:
+            return db.table("products").get(doc_id=doc_id)
+
+    async def buy(storage, product):
+        async with AIOTinyDB(storage=storage) as db:
+            products = db.table("products")
+            product["inventory_count"] -= 1
+            products.write_back([product])
+            db.table("orders").insert({"product": product.doc_id})
+
+    doc_id = run(create())
+    stale = run(read(second, doc_id))
+    run(buy(first, run(read(first, doc_id))))
+
+    # the product changed since it was read, none of the session is written
+    with pytest.raises(ConflictError):
+        run(buy(second, stale))
+    assert run(read(second, doc_id))["inventory_count"] == 1
+    assert run(read(first, doc_id))["inventory_count"] == 1
+
+    async def orders(storage):
+        async with AIOTinyDB(storage=storage) as db:
+            return len(db.table("orders"))
+
+    assert run(orders(first)) == 1
+    assert run(orders(second)) == 1
+
+    run(buy(second, run(read(second, doc_id))))
+    assert run(read(first, doc_id))["inventory_count"] == 0
+
+
+def test_concurrent_sessions_are_committed_together(database_path: str):
+    storage = WriteAheadLogStorage(database_path)
+    database = TransactionalTinyDB(storage=storage)
+    writes = []
+    write_log, write_new_log = storage._write_log, storage._write_new_log
+    storage._write_log = lambda *args: writes.append(args) or write_log(*args)
+    storage._write_new_log = lambda *args: writes.append(args) or write_new_log(*args)
+
+    async def add(number):
+        async with database.session() as db:
+            db.table("cart_items").insert({"product": number, "amount": 1})
+
+    async def scenario():
+        await asyncio.gather(*(add(number) for number in range(10)))
+
+    run(scenario())
+    # a single write for all the sessions
+    assert len(writes) == 1
+
+    run(scenario())
+    assert len(writes) == 2
+
+    async def count():
+        async with AIOTinyDB(storage=WriteAheadLogStorage(database_path)) as db:
+            return len(db.table("cart_items"))
+
+    assert run(count()) == 20
+
+
+def test_sessions_committed_together_can_conflict(database_path: str):
+    database = TransactionalTinyDB(storage=WriteAheadLogStorage(database_path))
+
+    async def create():
+        async with database as db:
+            return db.table("products").insert({"inventory_count": 2})
+
+    doc_id = run(create())
+
+    async def scenario():
+        both_read = asyncio.Event()
+        first_written = asyncio.Event()
+
+        async def buy(amount: int, first: bool) -> None:
+            async with database.session() as db:
+                products = db.table("products")
+                product = products.get(doc_id=doc_id)
+                if first:
+                    await both_read.wait()
+                else:
+                    both_read.set()
+                    await first_written.wait()
+                product["inventory_count"] -= amount
+                products.write_back([product])
+                if first:
+                    first_written.set()
+
+        return await asyncio.gather(buy(1, True), buy(2, False), return_exceptions=True)
+
+    # both read the same version, the second one writes on top of the first
+    # while it waits to be committed, but only the first one is committed
+    first, second = run(scenario())
+    assert first is None
+    assert isinstance(second, ConflictError)
+
+    async def read():
+        async with database as db:
+            return db.table("products").get(doc_id=doc_id)["inventory_count"]
+
+    assert run(read()) == 1
+
+
+def test_overlapping_sessions_keep_their_changes(database_path: str):
+    database = TransactionalTinyDB(storage=WriteAheadLogStorage(database_path))
+
+    async def scenario():
+        writing = asyncio.Event()
+        failed = asyncio.Event()
+
+        async def write():
+            async with database.session() as db:
+                db.table("products").insert({"title": "Potion"})
+                writing.set()
+                await failed.wait()
+
+        async def fail():
+            await writing.wait()
+            try:
+                async with database.session() as db:
+                    db.table("products").insert({"title": "Ether"})
+            finally:
+                failed.set()
+
+        return await asyncio.gather(write(), fail(), return_exceptions=True)
+
+    # the second one can't write while the first has changes not committed, and
+    # failing doesn't undo the changes of the first
+    first, second = run(scenario())
+    assert first is None
+    assert isinstance(second, ConflictError)
+
+    async def read():
+        async with database.session() as db:
+            return [product["title"] for product in db.table("products").all()]
+
+    assert run(read()) == ["Potion"]
+
+
+def increment_counter(database_path: str, times: int) -> None:
+    storage = WriteAheadLogStorage(database_path, compact_threshold=50)
+
+    async def increment():
+        async with AIOTinyDB(storage=storage) as db:
+            counters = db.table("counters")
+            counter = counters.get(Q.name == "visits")
+            counter["value"] += 1
+            counters.write_back([counter])
+
+    for _ in range(times):
+        while True:
+            try:
+                run(increment())
+                break
+            except ConflictError:
+                continue
+
+
+def test_concurrent_workers_dont_lose_writes(database_path: str):
+    async def create():
+        async with AIOTinyDB(storage=WriteAheadLogStorage(database_path)) as db:
+            db.table("counters").insert({"name": "visits", "value": 0})
+
+    run(create())
+
+    workers = [
+        multiprocessing.Process(target=increment_counter, args=(database_path, 100))
+        for _ in range(4)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert all(worker.exitcode == 0 for worker in workers)
+
+    async def read():
+        async with AIOTinyDB(storage=WriteAheadLogStorage(database_path)) as db:
+            return db.table("counters").get(Q.name == "visits")["value"]
+
+    assert run(read()) == 400
+
+
+def test_segment_storage(database_path: str, tmp_path):
+    async def write():
+        async with AIOTinyDB(storage=WriteAheadLogStorage(database_path)) as db:
+            products = db.table("products")
+            return [
+                products.insert({"title": title, "inventory_count": 1})
+                for title in ("Potion", "Ether", "Elixir")
+            ]
+
+    doc_ids = run(write())
+    segments_path = str(tmp_path / "data.seg")
+    convert(database_path, segments_path)
+
+    storage = SegmentStorage(segments_path, compact_threshold=4)
+
+    async def scenario():
+        async with AIOTinyDB(storage=storage) as db:
+            products = db.table("products")
+            assert products.get(doc_id=doc_ids[0])["title"] == "Potion"
+            # reading leaves the table in the mapped file
+            table = storage._tables["products"]
+            assert isinstance(table, SegmentTable) and not table._changed
+
+            products.update({"inventory_count": 0}, doc_ids=[doc_ids[1]])
+            products.remove(doc_ids=[doc_ids[2]])
+            products.insert({"title": "Megalixir", "inventory_count": 5})
+        async with AIOTinyDB(storage=storage) as db:
+            db.table("users").insert({"username": "admin"})
+
+    run(scenario())
+
+    async def read():
+        async with AIOTinyDB(storage=SegmentStorage(segments_path)) as db:
+            return {
+                product["title"]: product["inventory_count"]
+                for product in db.table("products").all()
+            }, len(db.table("users"))
+
+    # the changes were compacted into a new segment file
+    assert read_segments(segments_path)["users"]
+    assert run(read()) == ({"Potion": 1, "Ether": 0, "Megalixir": 5}, 1)
@@ -1,9 +1,12 @@
+import hashlib
+import typing
 from datetime import datetime, timedelta
 
 import jwt
 import pytest
 
 from akara.models import User
+from akara.utils.password import hash_password, needs_rehash, verify_password
 
 from config.settings import SECRET_KEY, JWT_ALGORITHM
 from .conftest import StarletteGraphQlClient
@@ -165,3 +168,65 @@ def test_user_not_logged(client: StarletteGraphQlClient):
         response.get("errors")[0].get("message")
         == "you must be loged in to access your user data"
     )
+
+
+def test_password_hashes():
+    password_hash = hash_password("T3st_")
+    assert verify_password("T3st_", password_hash)
+    assert not verify_password("wrong_one", password_hash)
+    assert not needs_rehash(password_hash)
+    # cost parameters are part of the hash
+    assert needs_rehash(password_hash.replace("n=", "n=1", 1))
+
+
+def test_login_with_malformed_hash(
+    client: StarletteGraphQlClient, test_database: typing.Callable
+):
+    users = test_database("users")
+    for username, password_hash in [
+        ("missing", "$scrypt$r=8,p=1$00$00"),
+        ("garbled", "$scrypt$n$00$00"),
+        ("truncated", "$pbkdf2-sha256$i=1"),
+    ]:
+        users.insert({"username": username, "password_hash": password_hash})
+        assert not verify_password("T3st_", password_hash)
+        response = client.execute(
+            """
+            mutation($username: String!, $password: String!) {
+                login(username: $username, password: $password) {
+                    token
+                }
+            }
+            """,
+            variables={"username": username, "password": "T3st_"},
+        )
+        assert response.get("errors")[0].get("message") == "incorrect password"
+
+
+def test_login_rehashes_legacy_password(
+    client: StarletteGraphQlClient, test_database: typing.Callable
+):
+    salt = "0" * 32
+    legacy_hash = salt + hashlib.sha512(b"T3st_" + salt.encode()).hexdigest()
+    users = test_database("users")
+    users.insert({"username": "legacy", "password_hash": legacy_hash})
+    assert needs_rehash(legacy_hash)
+
+    for _ in range(2):
+        response = client.execute(
+            """
+            mutation($username: String!, $password: String!) {
+                login(username: $username, password: $password) {
+                    token
+                }
+            }
+            """,
+            variables={"username": "legacy", "password": "T3st_"},
+        )
+        assert response.get("data").get("login").get("token")
+
+    (password_hash,) = [
+        user["password_hash"] for user in users.all() if user["username"] == "legacy"
+    ]
+    assert not needs_rehash(password_hash)
+    assert verify_password("T3st_", password_hash)